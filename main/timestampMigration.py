@@ -0,0 +1,77 @@
+from django.db import models
+
+from utils.timeZone import fromISOString, isoformat
+
+
+def timestampFields(model, names: list[str]) -> list[tuple[models.Field, models.Field]]:
+    """
+    :return: [(字符串字段, 时间字段)]，与模型中字段的 null 相同
+    """
+    pairs = []
+    for name in names:
+        old = model._meta.get_field(name)
+        new = models.DateTimeField(null=old.null)
+        new.set_attributes_from_name(name)
+        new.model = model
+        pairs.append((old, new))
+    return pairs
+
+
+def rewriteValues(schema_editor, model, column: str, convert):
+    """
+    逐行转换列中的值，SQLite 等没有类型转换的数据库使用
+    """
+    table = schema_editor.quote_name(model._meta.db_table)
+    pk = schema_editor.quote_name(model._meta.pk.column)
+    quoted = schema_editor.quote_name(column)
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f'SELECT {pk}, {quoted} FROM {table} WHERE {quoted} IS NOT NULL')
+        rows = cursor.fetchall()
+        for id, value in rows:
+            cursor.execute(f'UPDATE {table} SET {quoted} = %s WHERE {pk} = %s', [convert(value), id])
+
+
+def toTimestampColumns(appLabel: str, columns: dict[str, list[str]]):
+    """
+    将旧版本的 ISO 字符串列（如 2023-07-11T05:00:00.000Z）转换为带时区的时间列，空字符串转换为 NULL
+
+    PostgreSQL 上由 ALTER COLUMN ... USING 在数据库中解析；其他数据库先修改列再在 Python 中逐行解析，
+    没有时区的时间视为 UTC
+
+    :param columns: {模型名: [字段名]}
+    :return: (forward, backward)，传给 RunPython
+    """
+
+    def forward(apps, schema_editor):
+        connection = schema_editor.connection
+        for modelName, names in columns.items():
+            model = apps.get_model(appLabel, modelName)
+            table = schema_editor.quote_name(model._meta.db_table)
+            for old, new in timestampFields(model, names):
+                column = schema_editor.quote_name(old.column)
+                if connection.vendor == 'postgresql':
+                    schema_editor.execute(f'ALTER TABLE {table} ALTER COLUMN {column} TYPE timestamp with time zone '
+                                          f"USING NULLIF({column}, '')::timestamp with time zone")
+                    continue
+                if new.null:
+                    schema_editor.execute(f"UPDATE {table} SET {column} = NULL WHERE {column} = ''")
+                schema_editor.alter_field(model, old, new)
+                rewriteValues(schema_editor, model, old.column,
+                              lambda value: connection.ops.adapt_datetimefield_value(fromISOString(value)))
+
+    def backward(apps, schema_editor):
+        connection = schema_editor.connection
+        for modelName, names in columns.items():
+            model = apps.get_model(appLabel, modelName)
+            table = schema_editor.quote_name(model._meta.db_table)
+            for old, new in timestampFields(model, names):
+                column = schema_editor.quote_name(old.column)
+                if connection.vendor == 'postgresql':
+                    schema_editor.execute(f'ALTER TABLE {table} ALTER COLUMN {column} TYPE varchar(255) '
+                                          f"USING to_char({column} AT TIME ZONE 'UTC', "
+                                          f'\'YYYY-MM-DD"T"HH24:MI:SS.MS"Z"\')')
+                    continue
+                schema_editor.alter_field(model, new, old)
+                rewriteValues(schema_editor, model, old.column, isoformat)
+
+    return forward, backward
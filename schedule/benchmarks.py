@@ -0,0 +1,491 @@
+"""
+时间码解析相关的性能基准
+
+完整的解析器基准：python manage.py bench_parser --output bench.json
+其他基准在 Django 环境中运行，例如：
+python manage.py shell -c "from schedule.benchmarks import benchExpansion; print(benchExpansion())"
+"""
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import uuid
+from datetime import datetime
+
+from dateutil import tz
+from django.conf import settings
+from django.db import connection, transaction
+from django.test import override_settings
+
+from schedule import timeCodeParser
+from schedule.timeCodeParserTypes import ParserSettings, TimeRange
+from utils.timeZone import utcNow, epochSecondsToDatetime
+from utils.utils import intersection, difference, keyedIntersection, keyedDifference
+
+benchSettings = ParserSettings(timeZone='Asia/Shanghai', wkst='MO')
+
+# 有代表性的时间码，(rTimeCode, exTimeCode)
+PARSER_CORPUS = {
+    'singleEvent': ('2024/1/1 9:00-10:00 Asia/Shanghai', ''),
+    'singleTodo': ('2024/1/1 23:59', ''),
+    'multiLine': ('2024/1/1-2024/6/30 9:00-10:00 Asia/Shanghai by[day[1,3,5]];'
+                  '2024/1/1-2024/6/30 14:00-15:30 Asia/Shanghai by[day[2,4]];'
+                  '2024/3/1-2024/3/31 20:00-21:00 America/Los_Angeles daily', ''),
+    'byRules': ('2024/1/1-2025/12/31 9:00-10:00 Asia/Shanghai weekly,i2 by[day[1,3,5]]',
+                '2024/1/1-2024/1/31 9:00-10:00 Asia/Shanghai by[day[1]]'),
+    'monthly': ('2020/1/31-2030/12/31 20:00 America/New_York monthly', ''),
+    'yearly': ('2000/2/29-2100/12/31 8:00-9:00 Europe/London yearly', ''),
+    'timeZoneAbbr': ('2024/1/1-2024/12/31 21:00-22:00 CST daily;2024/1/1-2024/12/31 8:00-9:00 PST daily', ''),
+    'dateSugar': ('tdy 22:00 America/Los_Angeles;tmr 8:00 America/Los_Angeles;1/1-12/31 7:00 UTC weekly', ''),
+    'timeSugar': ('2024/1/1-2024/1/31 s-e UTC;2024/2/1-2024/2/29 22.30-23.0 UTC;2024/3/1-2024/3/31 22:-: UTC', ''),
+    'longDaily': ('2000/1/1-2027/5/18 9:00-10:00 America/New_York daily', '2010/1/1-2010/12/31 9:00-10:00 America/New_York'),
+}
+
+# 每条规则约 1 万个时间片
+EXPANSION_CORPUS = {
+    'daily': '2000/1/1-2027/5/18 9:00-10:00 America/New_York daily',
+    'weekly': '1900/1/1-2091/8/20 9:00-10:00 Asia/Shanghai weekly',
+    'weeklyByDay': '1900/1/1-2027/10/1 21:00-23:00 Asia/Shanghai weekly,i2 by[day[1,3,5]]',
+    'dailyTodo': '2000/1/1-2027/5/18 23:59 Asia/Shanghai daily',
+}
+
+
+def timeIt(func: callable, repeat: int) -> float:
+    """
+    多次运行取最短耗时，单位秒
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def parseWithoutCache(code: str, exCode: str = ''):
+    timeCodeParser.timeCodeCache.clear()
+    return timeCodeParser.parseTimeCodes('', code, exCode, benchSettings)
+
+
+def benchExpansion(repeat: int = 5) -> dict:
+    """
+    比较 NumPy 批量展开与 dateutil 逐个展开的耗时
+    """
+    res = {}
+    vectorized = timeCodeParser.VECTORIZED_EXPANSION
+    try:
+        for name, code in EXPANSION_CORPUS.items():
+            occurrences = len(parseWithoutCache(code).rTimes)
+            timeCodeParser.VECTORIZED_EXPANSION = False
+            dateutilSeconds = timeIt(lambda: parseWithoutCache(code), repeat)
+            timeCodeParser.VECTORIZED_EXPANSION = True
+            numpySeconds = timeIt(lambda: parseWithoutCache(code), repeat)
+            res[name] = {
+                'occurrences': occurrences,
+                'dateutil': dateutilSeconds,
+                'numpy': numpySeconds,
+                'speedup': dateutilSeconds / numpySeconds,
+            }
+    finally:
+        timeCodeParser.VECTORIZED_EXPANSION = vectorized
+        timeCodeParser.timeCodeCache.clear()
+    return res
+
+
+def benchImport(repeat: int = 5) -> dict:
+    """
+    冷启动时 import schedule.timeCodeParser 的耗时，每次在新的进程中运行
+    """
+    script = ('import time, django; django.setup(); start = time.perf_counter(); '
+              'import schedule.timeCodeParser; from utils.timeZone import getTimeZoneIndex; getTimeZoneIndex(); '
+              'print(time.perf_counter() - start)')
+    env = {**os.environ, 'DJANGO_SETTINGS_MODULE': os.environ.get('DJANGO_SETTINGS_MODULE', 'main.settings_dev')}
+    samples = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', script], cwd=settings.BASE_DIR, env=env,
+                                capture_output=True, text=True, check=True).stdout
+        samples.append(float(output.strip().splitlines()[-1]))
+    return {
+        'min': min(samples),
+        'max': max(samples),
+        'samples': samples,
+    }
+
+
+def benchSetAlgebra(sizes: tuple[int, ...] = (100, 1000, 3000), repeat: int = 3) -> dict:
+    """
+    比较逐个比较的交集/差集与基于 key 的交集/差集，ex 的数量为 r 的十分之一
+    """
+    res = {}
+    for size in sizes:
+        rTimes = parseWithoutCache(f'2000/1/1-2100/1/1 9:00-10:00 Asia/Shanghai daily,c{size}').rTimes
+        exTimes = rTimes[::10]
+        res[size] = {
+            'nested': timeIt(lambda: (intersection(rTimes, exTimes, lambda a, b: a == b),
+                                      difference(rTimes, exTimes, lambda a, b: a == b)), repeat),
+            'keyed': timeIt(lambda: (keyedIntersection(rTimes, exTimes, TimeRange.key),
+                                     keyedDifference(rTimes, exTimes, TimeRange.key)), repeat),
+        }
+    return res
+
+
+class DictTimeRange:
+    """
+    旧的时间片表示：普通 __dict__ 对象，保存 ISO 字符串和 '11' 形式的 mark，只用于内存对比
+    """
+
+    def __init__(self, start: str | None, end: str, startMark: str, endMark: str):
+        self.start = start
+        self.end = end
+        self.startMark = startMark
+        self.endMark = endMark
+
+
+def measureMemory(func: callable) -> int:
+    """
+    func 返回的对象占用的内存，单位字节
+    """
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        res = func()
+        after, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del res
+    return after - before
+
+
+def benchMemory(occurrences: int = 5000) -> dict:
+    """
+    比较 occurrences 个时间片在紧凑表示（epoch 秒 + 压缩的 mark）和旧的字符串表示下占用的内存
+    """
+    code = f'2000/1/1-2100/1/1 9:00-10:00 Asia/Shanghai daily,c{occurrences}'
+    rLexes = lexTimeCodes(code)
+    times = semTimeCodes(rLexes)
+    compact = measureMemory(lambda: semTimeCodes(rLexes))
+    # 与旧的实现一样，每个时间片生成新的 ISO 字符串
+    legacy = measureMemory(lambda: [DictTimeRange(time.start, time.end, time.startMark, time.endMark)
+                                    for time in times])
+    return {
+        'occurrences': occurrences,
+        'compact': compact,
+        'legacy': legacy,
+        'ratio': legacy / compact if compact > 0 else None,
+    }
+
+
+def measurePeak(func: callable) -> int:
+    """
+    运行 func 时的峰值内存，单位字节
+    """
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def consumeStream(code: str):
+    timeCodeParser.timeCodeCache.clear()
+    for _ in timeCodeParser.streamTimeCodes('', code, '', benchSettings).times:
+        pass
+
+
+def benchStreaming(sizes: tuple[int, ...] = (10000, 100000)) -> dict:
+    """
+    比较完整列表和流式展开的峰值内存，流式展开的峰值不随时间片数量增长
+    """
+    res = {}
+    for size in sizes:
+        code = f'1900/1/1-2200/1/1 9:00-10:00 Asia/Shanghai daily,c{size}'
+        res[size] = {
+            'list': measurePeak(lambda: parseWithoutCache(code)),
+            'stream': measurePeak(lambda: consumeStream(code)),
+        }
+    timeCodeParser.timeCodeCache.clear()
+    return res
+
+
+def lexTimeCodes(timeCode: str) -> list:
+    return [timeCodeParser.parseTimeCodeLex(benchSettings, line)
+            for line in timeCodeParser.splitTimeCodeLines(timeCode)]
+
+
+def semTimeCodes(lexes: list) -> list[TimeRange]:
+    times = []
+    for lex in lexes:
+        times.extend(timeCodeParser.parseTimeCodeSem(benchSettings, lex.dateRangeObject, lex.timeRangeObject,
+                                                     lex.timeZone, lex.freqCode, lex.byCode).times)
+    return times
+
+
+def writeTimes(rTimes: list[TimeRange], exTimes: list[TimeRange], writer: callable = None):
+    """
+    在回滚的事务中为临时用户写入时间片
+
+    :param writer: writer(schedule, rTimes, exTimes)，默认为 createTimes
+    """
+    from schedule.models import Schedule
+    from schedule.service import createTimes
+    from user.models import ScheduleUser
+
+    if writer is None:
+        writer = createTimes
+    with transaction.atomic():
+        now = utcNow()
+        userId = uuid.uuid4().hex
+        ScheduleUser.objects.create_user(userId, f'{userId}@bench.local')
+        schedule = Schedule.objects.create(id=uuid.uuid4().hex, user_id=userId, type='event', name='bench',
+                                           rrules='', rTimeCode='', exTimeCode='', comment='',
+                                           created=now, updated=now)
+        writer(schedule, rTimes, exTimes)
+        transaction.set_rollback(True)
+
+
+def saveTimes(schedule, rTimes: list[TimeRange], exTimes: list[TimeRange]):
+    """
+    旧的写入方式：每个时间片单独生成时间戳并 INSERT 一次
+    """
+    from schedule.models import Time
+
+    for times, excluded in ((rTimes, False), (exTimes, True)):
+        for time in times:
+            Time(id=uuid.uuid4().hex, schedule_id=schedule.id, excluded=excluded,
+                 start=epochSecondsToDatetime(time.startTs), end=epochSecondsToDatetime(time.endTs),
+                 startMark=time.startMark, endMark=time.endMark, done=False,
+                 created=utcNow(), updated=utcNow()).save()
+
+
+def benchWrites(sizes: tuple[int, ...] = (365, 3650), repeat: int = 3) -> dict:
+    """
+    比较逐行 save、bulk_create 和 COPY（仅 PostgreSQL）写入时间片的吞吐量，单位 行/秒
+    """
+    from schedule import service
+
+    writers = {
+        'save': (saveTimes, {}),
+        'bulkCreate': (None, {'SCHEDULE_TIME_COPY': False}),
+    }
+    if connection.vendor == 'postgresql':
+        writers['copy'] = (None, {'SCHEDULE_TIME_COPY': True})
+    rowsPerSecond = {}
+    for size in sizes:
+        times = semTimeCodes(lexTimeCodes(f'2000/1/1-2100/1/1 9:00-10:00 Asia/Shanghai daily,c{size}'))
+        rowsPerSecond[size] = {}
+        for name, (writer, overrides) in writers.items():
+            with override_settings(**overrides):
+                seconds = timeIt(lambda: writeTimes(times, [], writer), repeat)
+            rowsPerSecond[size][name] = size / seconds if seconds > 0 else None
+    return {
+        'batchSize': service.getTimeBatchSize(),
+        'rowsPerSecond': rowsPerSecond,
+    }
+
+
+def seedTimes(rows: int, schedules: int, start: int | None = None, todoEvery: int = 0) -> tuple[str, int]:
+    """
+    为临时用户创建 schedules 个 schedule 和 rows 个每小时一次的时间片，需要在回滚的事务中调用
+
+    :param start: 第一个时间片的开始时间戳，默认为 2000/1/1
+    :param todoEvery: 每 todoEvery 个 schedule 中有一个是没有开始时间的 _todo，0 表示全部是 event
+    :return: (userId, 第一个时间片的开始时间戳)
+    """
+    from schedule.models import Schedule, Time
+    from schedule.service import insertTimes, getTimeBatchSize
+    from user.models import ScheduleUser
+
+    now = utcNow()
+    userId = uuid.uuid4().hex
+    ScheduleUser.objects.create_user(userId, f'{userId}@bench.local')
+    scheduleObjects = [Schedule(id=uuid.uuid4().hex, user_id=userId,
+                                type='todo' if todoEvery > 0 and i % todoEvery == 0 else 'event', name=f'bench {i}',
+                                rrules='', rTimeCode='', exTimeCode='', comment='', created=now, updated=now)
+                       for i in range(schedules)]
+    Schedule.objects.bulk_create(scheduleObjects)
+    if start is None:
+        start = int(datetime(2000, 1, 1, tzinfo=tz.gettz('UTC')).timestamp())
+    batch = []
+    for i in range(rows):
+        schedule = scheduleObjects[i % schedules]
+        if schedule.type == 'todo':
+            time = TimeRange.fromEpoch(None, start + i * 3600 + 1800, 0b0011)
+        else:
+            time = TimeRange.fromEpoch(start + i * 3600, start + i * 3600 + 1800, 0b1111)
+        batch.append(Time(id=uuid.uuid4().hex, schedule_id=schedule.id, user_id=userId,
+                          scheduleName=schedule.name, scheduleComment=schedule.comment,
+                          start=epochSecondsToDatetime(time.startTs), end=epochSecondsToDatetime(time.endTs),
+                          startMark=time.startMark, endMark=time.endMark,
+                          fingerprint=time.fingerprint(), created=now, updated=now))
+        if len(batch) == getTimeBatchSize():
+            insertTimes(batch)
+            batch = []
+    insertTimes(batch)
+    return userId, start
+
+
+def benchDenormalized(rows: int = 100000, schedules: int = 100, repeat: int = 3) -> dict:
+    """
+    在回滚的事务中为一个有 rows 个时间片的临时用户比较 findEventsBetween 的查询：
+    通过 join schedule 过滤 user_id、取 name / comment，和直接使用时间片上的冗余字段
+
+    :return: 两种查询的耗时（秒）和 EXPLAIN 输出
+    """
+    from schedule.models import Time
+
+    fields = ['id', 'schedule_id', 'start', 'end', 'startMark', 'endMark']
+    res = {'rows': rows}
+    with transaction.atomic():
+        userId, start = seedTimes(rows, schedules)
+
+        # 查询中间一个月的时间片
+        since = epochSecondsToDatetime(start + rows // 2 * 3600)
+        until = epochSecondsToDatetime(start + (rows // 2 + 24 * 30) * 3600)
+        filters = {'excluded': False, 'start__isnull': False, 'start__gte': since, 'end__lte': until,
+                   'done': False, 'deleted': False}
+        queries = {
+            'join': Time.objects.filter(schedule__user_id=userId, **filters).order_by('start')
+            .values(*fields, 'schedule__name', 'schedule__comment'),
+            'denormalized': Time.objects.filter(user_id=userId, **filters).order_by('start')
+            .values(*fields, 'scheduleName', 'scheduleComment'),
+        }
+        for name, query in queries.items():
+            res[name] = {
+                'seconds': timeIt(lambda: list(query.all()), repeat),
+                'plan': query.explain(),
+            }
+        transaction.set_rollback(True)
+    return res
+
+
+def benchRangeQuery(rows: int = 100000, schedules: int = 100, repeat: int = 3) -> dict:
+    """
+    在回滚的事务中为一个有 rows 个时间片的临时用户比较时间范围查询：
+    按字符串比较时间（以前时间以 ISO 字符串存储时的方式，无法使用 end 上的索引），和直接比较原生时间列
+
+    :return: 两种查询的耗时（秒）、行数和 EXPLAIN 输出
+    """
+    from django.db.models import TextField
+    from django.db.models.functions import Cast
+
+    from schedule.models import Time
+
+    res = {'rows': rows}
+    with transaction.atomic():
+        userId, start = seedTimes(rows, schedules)
+
+        # 查询中间一个月结束的时间片
+        since = epochSecondsToDatetime(start + rows // 2 * 3600)
+        until = epochSecondsToDatetime(start + (rows // 2 + 24 * 30) * 3600)
+        times = Time.objects.filter(user_id=userId, deleted=False)
+        queries = {
+            'text': times.annotate(endText=Cast('end', TextField()))
+            .filter(endText__gte=str(since), endText__lte=str(until)).values('id', 'end'),
+            'native': times.filter(end__gte=since, end__lte=until).values('id', 'end'),
+        }
+        for name, query in queries.items():
+            res[name] = {
+                'seconds': timeIt(lambda: list(query.all()), repeat),
+                'count': query.count(),
+                'plan': query.explain(),
+            }
+        transaction.set_rollback(True)
+    return res
+
+
+def benchEventIndex(rows: int = 100000, schedules: int = 100, windows: int = 52, repeat: int = 3) -> dict:
+    """
+    在回滚的事务中模拟按周滚动日历：比较每个窗口一次 SQL 范围查询，和从 EventIndex 中二分查找
+
+    :return: 每个窗口的平均耗时（秒）、构建 EventIndex 的耗时和估算的内存
+    """
+    from schedule.service import findEventTimes, filterOverlapping, toEventBrief, loadEventIndex
+
+    res = {'rows': rows, 'windows': windows}
+    with transaction.atomic():
+        userId, start = seedTimes(rows, schedules)
+        week = 7 * 24 * 3600
+        bounds = [(start + i * week, start + (i + 1) * week) for i in range(windows)]
+
+        def sql():
+            for since, until in bounds:
+                [toEventBrief(time) for time in filterOverlapping(findEventTimes(userId), userId,
+                                                                  epochSecondsToDatetime(since),
+                                                                  epochSecondsToDatetime(until)).order_by('start')]
+
+        index = loadEventIndex(userId, 0, epochSecondsToDatetime(bounds[-1][1]))
+
+        def cached():
+            for since, until in bounds:
+                index.between(since, until)
+
+        res['sql'] = timeIt(sql, repeat) / windows
+        res['build'] = timeIt(lambda: loadEventIndex(userId, 0, epochSecondsToDatetime(bounds[-1][1])), repeat)
+        res['index'] = timeIt(cached, repeat) / windows
+        res['nbytes'] = index.nbytes
+        transaction.set_rollback(True)
+    return res
+
+
+def benchCase(rTimeCode: str, exTimeCode: str, repeat: int, db: bool) -> dict:
+    """
+    单个时间码各阶段的耗时、吞吐量和峰值内存
+    """
+    rLexes = lexTimeCodes(rTimeCode)
+    exLexes = lexTimeCodes(exTimeCode)
+    rTimes = semTimeCodes(rLexes)
+    exTimes = semTimeCodes(exLexes)
+    stages = {
+        'lex': timeIt(lambda: (lexTimeCodes(rTimeCode), lexTimeCodes(exTimeCode)), repeat),
+        'sem': timeIt(lambda: (semTimeCodes(rLexes), semTimeCodes(exLexes)), repeat),
+        'setAlgebra': timeIt(lambda: (keyedIntersection(rTimes, exTimes, TimeRange.key),
+                                      keyedDifference(rTimes, exTimes, TimeRange.key)), repeat),
+    }
+    if db:
+        result = timeCodeParser.parseTimeCodes('', rTimeCode, exTimeCode, benchSettings)
+        stages['db'] = timeIt(lambda: writeTimes(result.rTimes, result.exTimes), repeat)
+
+    tracemalloc.start()
+    try:
+        parseWithoutCache(rTimeCode, exTimeCode)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    occurrences = len(rTimes) + len(exTimes)
+    parseSeconds = stages['lex'] + stages['sem'] + stages['setAlgebra']
+    return {
+        'occurrences': occurrences,
+        'stages': stages,
+        'occurrencesPerSecond': occurrences / parseSeconds if parseSeconds > 0 else None,
+        'peakMemory': peak,
+    }
+
+
+def benchParser(corpus: dict[str, tuple[str, str]] | None = None, repeat: int = 5, db: bool = False) -> dict:
+    """
+    对语料中的每个时间码运行 benchCase，结果可以直接序列化为 JSON 以便比较不同版本
+    """
+    if corpus is None:
+        corpus = PARSER_CORPUS
+    cases = {}
+    try:
+        for name, (rTimeCode, exTimeCode) in corpus.items():
+            cases[name] = benchCase(rTimeCode, exTimeCode, repeat, db)
+    finally:
+        timeCodeParser.timeCodeCache.clear()
+    res = {
+        'created': datetime.now().astimezone(tz.gettz('UTC')).isoformat(),
+        'python': platform.python_version(),
+        'vectorized': timeCodeParser.VECTORIZED_EXPANSION,
+        'repeat': repeat,
+        'cases': cases,
+        'memory': benchMemory(),
+    }
+    if db:
+        res['writes'] = benchWrites(repeat=repeat)
+    return res
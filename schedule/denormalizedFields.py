@@ -0,0 +1,34 @@
+from django.db.models import OuterRef, Subquery
+
+# 每条 UPDATE 回填的行数
+BATCH_SIZE = 1000
+
+
+def backfill(model, batchSize: int, **values) -> int:
+    """
+    分批回填 user_id 为空的行，每批一条 UPDATE ... SET ... = (SELECT ... FROM schedule)
+    """
+    count = 0
+    while True:
+        ids = list(model.objects.filter(user__isnull=True).values_list('id', flat=True)[:batchSize])
+        if len(ids) == 0:
+            return count
+        count += model.objects.filter(id__in=ids).update(**values)
+
+
+def backfillDenormalizedFields(Schedule, Time, Record, batchSize: int = BATCH_SIZE) -> tuple[int, int]:
+    """
+    为旧的时间片和记录回填冗余的 user_id、schedule name / comment
+
+    迁移 0005 和 backfill_denormalized_fields 命令共用，迁移中传入历史模型
+
+    :return: (回填的时间片数量, 回填的记录数量)
+    """
+    schedule = Schedule.objects.filter(id=OuterRef('schedule_id'))
+    times = backfill(Time, batchSize,
+                     user_id=Subquery(schedule.values('user_id')[:1]),
+                     scheduleName=Subquery(schedule.values('name')[:1]),
+                     scheduleComment=Subquery(schedule.values('comment')[:1]))
+    records = backfill(Record, batchSize,
+                       user_id=Subquery(schedule.values('user_id')[:1]))
+    return times, records
@@ -0,0 +1,98 @@
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from threading import Lock
+
+from cachetools import LRUCache
+
+
+class EventIndex:
+    """
+    一个用户所有未删除、未排除、未完成的 event 时间片，按开始时间排序
+
+    starts / ends 为开始、结束的时间戳，events 为对应的 EventBriefVO 字典，调用方不能修改
+    generation 为加载时用户的 event generation，不相等说明时间片已经变化
+    maxDuration 为最长的时间片的时长，用于限制重叠查询时 start 的下界
+    materializedUntil 为加载前用户所有 schedule 已经物化到的时间戳，结束时间在它之前的查询不需要补齐时间片
+    """
+    __slots__ = ('generation', 'starts', 'ends', 'events', 'maxDuration', 'materializedUntil', 'nbytes')
+
+    def __init__(self, generation: int, rows: list[tuple[float, float, dict]], materializedUntil: float = float('inf')):
+        rows = sorted(rows, key=lambda row: row[0])
+        self.generation = generation
+        self.materializedUntil = materializedUntil
+        self.starts = array('d', (row[0] for row in rows))
+        self.ends = array('d', (row[1] for row in rows))
+        self.events = [row[2] for row in rows]
+        self.maxDuration = max((end - start for start, end, _ in rows), default=0)
+        # 估算占用的内存，用于缓存按内存淘汰
+        self.nbytes = (sys.getsizeof(self.starts) + sys.getsizeof(self.ends) + sys.getsizeof(self.events)
+                       + sum(sys.getsizeof(event) + sum(sys.getsizeof(value) for value in event.values())
+                             for event in self.events))
+
+    def between(self, start: float, end: float) -> list[dict]:
+        """
+        与 findEventsBetween 的 SQL 相同：与窗口重叠，即 start < 窗口结束且 end > 窗口开始，按开始时间排序
+        """
+        # end <= start + maxDuration，开始时间不晚于 窗口开始 - maxDuration 的时间片不可能与窗口重叠
+        lo = bisect_right(self.starts, start - self.maxDuration)
+        hi = bisect_left(self.starts, end)
+        return [self.events[i] for i in range(lo, hi) if self.ends[i] > start]
+
+
+class EventIndexCache:
+    """
+    按用户缓存 EventIndex 的 LRU 缓存，总大小按估算的内存限制在 maxbytes 以内
+
+    每次查询带上用户当前的 event generation，与缓存中的不同时丢弃旧的 EventIndex
+    """
+
+    def __init__(self, maxbytes: int):
+        self.cache = LRUCache(maxsize=maxbytes, getsizeof=lambda index: index.nbytes)
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.tooLarge = 0
+
+    def get(self, userId: str, generation: int) -> EventIndex | None:
+        with self.lock:
+            index = self.cache.get(userId)
+            if index is not None and index.generation == generation:
+                self.hits += 1
+                return index
+            if index is not None:
+                self.stale += 1
+                del self.cache[userId]
+            self.misses += 1
+            return None
+
+    def set(self, userId: str, index: EventIndex):
+        with self.lock:
+            # 单个用户超过上限时不缓存
+            if index.nbytes > self.cache.maxsize:
+                self.tooLarge += 1
+                return
+            self.cache[userId] = index
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.hits = 0
+            self.misses = 0
+            self.stale = 0
+            self.tooLarge = 0
+
+    def info(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'tooLarge': self.tooLarge,
+                'hitRate': self.hits / total if total > 0 else None,
+                'size': len(self.cache),
+                'bytes': self.cache.currsize,
+                'maxbytes': self.cache.maxsize,
+            }
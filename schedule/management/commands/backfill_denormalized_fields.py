@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from schedule.denormalizedFields import backfillDenormalizedFields, BATCH_SIZE
+from schedule.models import Schedule, Time, Record
+
+
+class Command(BaseCommand):
+    help = '为旧的时间片和记录回填冗余的 user_id、schedule name / comment'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='每条 UPDATE 回填的行数')
+
+    def handle(self, *args, **options):
+        times, records = backfillDenormalizedFields(Schedule, Time, Record, options['batch_size'])
+        self.stdout.write(f'filled {times} times and {records} records')
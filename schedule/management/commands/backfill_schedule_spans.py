@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from schedule import service
+from schedule.models import Schedule
+
+
+class Command(BaseCommand):
+    help = '为旧的 schedule 统计 firstAt / lastAt / liveCount / maxDuration'
+
+    def handle(self, *args, **options):
+        count = 0
+        for schedule in Schedule.objects.all().iterator():
+            span = (schedule.firstAt, schedule.lastAt, schedule.liveCount, schedule.maxDuration)
+            service.updateScheduleSpan(schedule)
+            if (schedule.firstAt, schedule.lastAt, schedule.liveCount, schedule.maxDuration) != span:
+                count += 1
+        self.stdout.write(f'updated {count} schedule spans')
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from schedule import service
+from schedule.models import Schedule
+
+
+class Command(BaseCommand):
+    help = '为旧的 schedule 生成搜索文档'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='重新生成所有 schedule 的搜索文档，默认只处理搜索文档为空的')
+
+    def handle(self, *args, **options):
+        schedules = Schedule.objects.all() if options['all'] else Schedule.objects.filter(searchDocument='')
+        count = 0
+        for schedule in schedules.iterator():
+            document = schedule.searchDocument
+            service.updateSearchDocument(schedule)
+            if schedule.searchDocument != document:
+                count += 1
+        self.stdout.write(f'filled {count} search documents')
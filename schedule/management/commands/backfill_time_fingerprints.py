@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from schedule.models import Schedule, Time
+
+
+class Command(BaseCommand):
+    help = '为旧的时间片回填 fingerprint，重复的时间片只保留一个，没有删除的优先'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='每次 bulk_update 的时间片数量')
+
+    def handle(self, *args, **options):
+        scheduleIds = (Time.objects.filter(fingerprint__isnull=True)
+                       .values_list('schedule_id', flat=True).distinct())
+        schedules = 0
+        filled = 0
+        for scheduleId in scheduleIds.iterator():
+            with transaction.atomic():
+                # 锁住 schedule，避免与同步时间片的请求同时写入 fingerprint
+                Schedule.objects.select_for_update().filter(id=scheduleId).first()
+                times = Time.objects.filter(schedule_id=scheduleId)
+                seen = set(times.filter(fingerprint__isnull=False).values_list('fingerprint', flat=True))
+                toUpdate = []
+                for t in times.filter(fingerprint__isnull=True).order_by('deleted', 'created'):
+                    fingerprint = t.computeFingerprint()
+                    if fingerprint in seen:
+                        continue
+                    seen.add(fingerprint)
+                    t.fingerprint = fingerprint
+                    toUpdate.append(t)
+                Time.objects.bulk_update(toUpdate, ['fingerprint'], batch_size=options['batch_size'])
+            schedules += 1
+            filled += len(toUpdate)
+        self.stdout.write(f'filled {filled} fingerprints in {schedules} schedules')
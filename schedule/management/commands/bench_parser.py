@@ -0,0 +1,35 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from schedule.benchmarks import benchParser, PARSER_CORPUS
+
+
+class Command(BaseCommand):
+    help = '运行时间码解析器基准，输出 JSON 以便比较不同版本'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5, help='每个阶段运行的次数，取最短耗时')
+        parser.add_argument('--db', action='store_true', help='包括写入数据库的阶段，在回滚的事务中运行')
+        parser.add_argument('--case', action='append', choices=list(PARSER_CORPUS.keys()),
+                            help='只运行指定的时间码，可以重复')
+        parser.add_argument('--output', help='JSON 输出文件，默认输出到 stdout')
+
+    def handle(self, *args, **options):
+        corpus = PARSER_CORPUS
+        if options['case']:
+            corpus = {name: PARSER_CORPUS[name] for name in options['case']}
+        res = benchParser(corpus, repeat=options['repeat'], db=options['db'])
+        output = json.dumps(res, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+            for name, case in res['cases'].items():
+                stages = ', '.join(f'{stage} {seconds * 1000:.2f}ms' for stage, seconds in case['stages'].items())
+                self.stdout.write(f'{name}: {case["occurrences"]} occurrences, {stages}, '
+                                  f'peak {case["peakMemory"] / 1024:.0f}KiB')
+            for size, writers in res.get('writes', {}).get('rowsPerSecond', {}).items():
+                rates = ', '.join(f'{name} {rate:.0f} rows/s' for name, rate in writers.items())
+                self.stdout.write(f'write {size} rows: {rates}')
+        else:
+            self.stdout.write(output)
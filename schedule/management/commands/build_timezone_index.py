@@ -0,0 +1,21 @@
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from utils.timeZone import buildTimeZoneIndex, saveTimeZoneIndex, getTimeZoneIndexPath, TIME_ZONE_INDEX_PATH_ENV
+
+
+class Command(BaseCommand):
+    help = '生成时区名和时区缩写的索引，tzdata 更新后重新运行'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', help=f'索引文件的路径，默认为环境变量 {TIME_ZONE_INDEX_PATH_ENV}')
+
+    def handle(self, *args, **options):
+        path = Path(options['path']) if options['path'] else getTimeZoneIndexPath()
+        if path is None:
+            raise CommandError(f'set {TIME_ZONE_INDEX_PATH_ENV} or --path')
+        index = buildTimeZoneIndex()
+        saveTimeZoneIndex(index, path)
+        self.stdout.write(f'{len(index.zones)} zones, {len(index.abbrs)} abbreviations, '
+                          f'version {index.version} -> {path}')
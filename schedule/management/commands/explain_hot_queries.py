@@ -0,0 +1,92 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from schedule import service
+from schedule.benchmarks import seedTimes
+from schedule.models import Schedule, Time
+from setting import service as settingService
+from utils.timeZone import utcNow, isoformat
+
+# PostgreSQL 上热点查询必须能使用的索引，--check 时检查查询计划
+EXPECTED_INDEXES = {
+    'findEventsBetween': 'time_live_event_span',
+    'searchSchedules': 'schedule_search_trgm',
+}
+
+
+class Command(BaseCommand):
+    help = '在回滚的事务中生成数据，对每个热点查询运行 EXPLAIN，便于发现查询计划的退化'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100000, help='生成的时间片数量')
+        parser.add_argument('--schedules', type=int, default=100, help='生成的 schedule 数量')
+        parser.add_argument('--analyze', action='store_true', help='使用 EXPLAIN ANALYZE（仅 PostgreSQL）')
+        parser.add_argument('--sql', action='store_true', help='同时输出 SQL')
+        parser.add_argument('--check', action='store_true',
+                            help='禁用顺序扫描，检查查询计划使用了 EXPECTED_INDEXES 中的索引（仅 PostgreSQL）')
+
+    def handle(self, *args, **options):
+        if options['check'] and connection.vendor != 'postgresql':
+            raise CommandError('--check 仅支持 PostgreSQL')
+        explainOptions = {'analyze': True} if options['analyze'] else {}
+        prefix = connection.ops.explain_query_prefix(**explainOptions)
+        with transaction.atomic():
+            now = utcNow()
+            # 一半的时间片在过去，一半在将来，每 4 个 schedule 中有一个 _todo，每 5 个时间片删除一个
+            userId, _ = seedTimes(options['rows'], options['schedules'],
+                                  start=int(now.timestamp()) - options['rows'] // 2 * 3600, todoEvery=4)
+            ids = list(Time.objects.filter(user_id=userId).order_by('id').values_list('id', flat=True))
+            Time.objects.filter(id__in=ids[::5]).update(deleted=True)
+            scheduleId = Schedule.objects.filter(user_id=userId, type='todo').values_list('id', flat=True).first()
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+                if options['check']:
+                    # 数据量小时顺序扫描更快，禁用后才能确认索引可以用于这些查询
+                    cursor.execute('SET LOCAL enable_seqscan = off')
+
+            conditions = service.FindAllSchedulesConditions({
+                'search': 'bench 1',
+                'dateRange': [int(now.timestamp() * 1000), int((now + timedelta(days=30)).timestamp() * 1000)],
+                'type': 'event',
+                'star': None,
+            })
+            searchConditions = service.FindAllSchedulesConditions({
+                'search': 'Bench 1', 'dateRange': None, 'type': None, 'star': None})
+            lastSyncAt = isoformat(now - timedelta(days=1))
+            queries = {
+                'findEventsBetween': lambda: service.findEventsBetween(userId, isoformat(now),
+                                                                       isoformat(now + timedelta(days=30))),
+                'findAllTodos': lambda: service.findAllTodos(userId),
+                'findTimesByScheduleId': lambda: service.findTimesByScheduleId(scheduleId, userId),
+                'findRecordsByScheduleId': lambda: service.findRecordsByScheduleId(scheduleId, userId),
+                'findAllSchedules': lambda: service.findAllSchedules(userId, conditions, 1, 20),
+                'searchSchedules': lambda: service.findAllSchedules(userId, searchConditions, 1, 20),
+                'getUnSynced': lambda: service.getUnSynced(userId, lastSyncAt),
+                'getUnSyncedSettings': lambda: settingService.getUnSynced(userId, lastSyncAt),
+            }
+            missing = []
+            for name, query in queries.items():
+                self.stdout.write(f'== {name}')
+                with CaptureQueriesContext(connection) as captured:
+                    query()
+                plans = []
+                for sql in (q['sql'] for q in captured.captured_queries):
+                    if not sql.lstrip().upper().startswith('SELECT'):
+                        continue
+                    if options['sql']:
+                        self.stdout.write(sql)
+                    with connection.cursor() as cursor:
+                        cursor.execute(f'{prefix} {sql}')
+                        for row in cursor.fetchall():
+                            line = ' '.join(str(column) for column in row)
+                            plans.append(line)
+                            self.stdout.write('  ' + line)
+                index = EXPECTED_INDEXES.get(name)
+                if options['check'] and index is not None and not any(index in line for line in plans):
+                    missing.append(f'{name}: {index}')
+            transaction.set_rollback(True)
+        if missing:
+            raise CommandError('查询计划没有使用索引：' + ', '.join(missing))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from schedule import service
+from schedule.models import Schedule
+from utils.timeZone import isoformat
+
+
+class Command(BaseCommand):
+    help = '将所有 schedule 的时间片物化到新的 horizon，可由定时任务调用'
+
+    def handle(self, *args, **options):
+        horizon = service.getHorizon()
+        if horizon is None:
+            self.stdout.write('materialization horizon is disabled')
+            return
+        userIds = (Schedule.objects.filter(deleted=False, materializedUntil__isnull=False,
+                                           materializedUntil__lt=horizon)
+                   .values_list('user_id', flat=True).distinct())
+        count = 0
+        for userId in userIds:
+            service.extendHorizon(userId, horizon)
+            count += 1
+        self.stdout.write(f'extended {count} users to {isoformat(horizon)}')
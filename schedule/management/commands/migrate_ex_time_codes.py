@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from schedule import service
+from schedule.models import Schedule
+from schedule.timeCodeParser import loadParserSettings
+
+
+class Command(BaseCommand):
+    help = '将旧版本删除单个时间片时追加到 exTimeCode 的行移到 exFingerprints'
+
+    def handle(self, *args, **options):
+        settingsByUser = {}
+        schedules = count = 0
+        for schedule in Schedule.objects.filter(deleted=False).exclude(exTimeCode='').iterator():
+            if schedule.user_id not in settingsByUser:
+                settingsByUser[schedule.user_id] = loadParserSettings(schedule.user_id)
+            moved = service.migrateExTimeCode(schedule, settingsByUser[schedule.user_id])
+            if moved > 0:
+                schedules += 1
+                count += moved
+        self.stdout.write(f'moved {count} exclusions of {schedules} schedules')
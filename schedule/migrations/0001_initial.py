@@ -0,0 +1,72 @@
+# Generated by Django 5.0.1 on 2026-10-18 22:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Record',
+            fields=[
+                ('id', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('deleted', models.BooleanField(default=False)),
+                ('created', models.CharField(max_length=255)),
+                ('updated', models.CharField(max_length=255)),
+                ('syncAt', models.CharField(max_length=255, null=True)),
+                ('version', models.IntegerField(default=0)),
+                ('start', models.CharField(max_length=255)),
+                ('end', models.CharField(max_length=255)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='Schedule',
+            fields=[
+                ('id', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('deleted', models.BooleanField(default=False)),
+                ('created', models.CharField(max_length=255)),
+                ('updated', models.CharField(max_length=255)),
+                ('syncAt', models.CharField(max_length=255, null=True)),
+                ('version', models.IntegerField(default=0)),
+                ('type', models.CharField(choices=[('event', 'Event'), ('todo', 'Todo')], max_length=255)),
+                ('name', models.TextField()),
+                ('rrules', models.TextField()),
+                ('rTimeCode', models.TextField()),
+                ('exTimeCode', models.TextField()),
+                ('comment', models.TextField()),
+                ('star', models.BooleanField(default=False)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='Time',
+            fields=[
+                ('id', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('deleted', models.BooleanField(default=False)),
+                ('created', models.CharField(max_length=255)),
+                ('updated', models.CharField(max_length=255)),
+                ('syncAt', models.CharField(max_length=255, null=True)),
+                ('version', models.IntegerField(default=0)),
+                ('excluded', models.BooleanField(default=False)),
+                ('start', models.CharField(max_length=255, null=True)),
+                ('end', models.CharField(max_length=255)),
+                ('startMark', models.CharField(max_length=255)),
+                ('endMark', models.CharField(max_length=255)),
+                ('comment', models.CharField(default='', max_length=255)),
+                ('done', models.BooleanField(default=False)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
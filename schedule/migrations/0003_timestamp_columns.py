@@ -0,0 +1,94 @@
+# Generated by Django 5.0.1 on 2026-10-18 22:24
+
+from django.db import migrations, models
+
+from main.timestampMigration import toTimestampColumns
+
+# 旧版本中以 ISO 字符串保存的时间字段
+TIMESTAMP_COLUMNS = {
+    'schedule': ['created', 'updated', 'syncAt'],
+    'time': ['created', 'updated', 'syncAt', 'start', 'end'],
+    'record': ['created', 'updated', 'syncAt', 'start', 'end'],
+}
+forward, backward = toTimestampColumns('schedule', TIMESTAMP_COLUMNS)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('schedule', '0002_initial'),
+    ]
+
+    operations = [
+        # 已有的字符串由 RunPython 解析，模型状态与 AlterField 相同
+        migrations.SeparateDatabaseAndState(
+            database_operations=[migrations.RunPython(forward, backward)],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='schedule',
+                    name='created',
+                    field=models.DateTimeField(),
+                ),
+                migrations.AlterField(
+                    model_name='schedule',
+                    name='updated',
+                    field=models.DateTimeField(),
+                ),
+                migrations.AlterField(
+                    model_name='schedule',
+                    name='syncAt',
+                    field=models.DateTimeField(null=True),
+                ),
+                migrations.AlterField(
+                    model_name='time',
+                    name='created',
+                    field=models.DateTimeField(),
+                ),
+                migrations.AlterField(
+                    model_name='time',
+                    name='updated',
+                    field=models.DateTimeField(),
+                ),
+                migrations.AlterField(
+                    model_name='time',
+                    name='syncAt',
+                    field=models.DateTimeField(null=True),
+                ),
+                migrations.AlterField(
+                    model_name='time',
+                    name='start',
+                    field=models.DateTimeField(null=True),
+                ),
+                migrations.AlterField(
+                    model_name='time',
+                    name='end',
+                    field=models.DateTimeField(),
+                ),
+                migrations.AlterField(
+                    model_name='record',
+                    name='created',
+                    field=models.DateTimeField(),
+                ),
+                migrations.AlterField(
+                    model_name='record',
+                    name='updated',
+                    field=models.DateTimeField(),
+                ),
+                migrations.AlterField(
+                    model_name='record',
+                    name='syncAt',
+                    field=models.DateTimeField(null=True),
+                ),
+                migrations.AlterField(
+                    model_name='record',
+                    name='start',
+                    field=models.DateTimeField(),
+                ),
+                migrations.AlterField(
+                    model_name='record',
+                    name='end',
+                    field=models.DateTimeField(),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,115 @@
+# Generated by Django 5.0.1 on 2026-10-18 22:25
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('schedule', '0003_timestamp_columns'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='record',
+            name='user',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='records', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='schedule',
+            name='exFingerprints',
+            field=models.TextField(default=''),
+        ),
+        migrations.AddField(
+            model_name='schedule',
+            name='firstAt',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='schedule',
+            name='lastAt',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='schedule',
+            name='liveCount',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='schedule',
+            name='materializedUntil',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='schedule',
+            name='searchDocument',
+            field=models.TextField(default=''),
+        ),
+        migrations.AddField(
+            model_name='time',
+            name='fingerprint',
+            field=models.CharField(max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='time',
+            name='scheduleComment',
+            field=models.TextField(default=''),
+        ),
+        migrations.AddField(
+            model_name='time',
+            name='scheduleName',
+            field=models.TextField(default=''),
+        ),
+        migrations.AddField(
+            model_name='time',
+            name='user',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='times', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='record',
+            index=models.Index(fields=['user', 'updated'], name='record_user_updated'),
+        ),
+        migrations.AddIndex(
+            model_name='schedule',
+            index=models.Index(fields=['user', 'type', 'deleted'], name='schedule_user_type_deleted'),
+        ),
+        migrations.AddIndex(
+            model_name='schedule',
+            index=models.Index(fields=['user', 'updated'], name='schedule_user_updated'),
+        ),
+        migrations.AddIndex(
+            model_name='schedule',
+            index=models.Index(fields=['user', 'created', 'id'], name='schedule_user_created'),
+        ),
+        migrations.AddIndex(
+            model_name='schedule',
+            index=models.Index(condition=models.Q(('liveCount__gt', 0)), fields=['user', 'lastAt', 'firstAt'], name='schedule_live_span'),
+        ),
+        migrations.AddIndex(
+            model_name='schedule',
+            index=models.Index(condition=models.Q(('deleted', False), ('materializedUntil__isnull', False)), fields=['user', 'materializedUntil'], name='schedule_live_horizon'),
+        ),
+        migrations.AddIndex(
+            model_name='time',
+            index=models.Index(condition=models.Q(('deleted', False), ('done', False), ('excluded', False), ('start__isnull', False)), fields=['user', 'start'], name='time_live_event_start'),
+        ),
+        migrations.AddIndex(
+            model_name='time',
+            index=models.Index(condition=models.Q(('deleted', False), ('excluded', False)), fields=['user', 'end'], name='time_live_user_end'),
+        ),
+        migrations.AddIndex(
+            model_name='time',
+            index=models.Index(condition=models.Q(('deleted', False), ('excluded', False)), fields=['schedule', 'end'], name='time_live_schedule_end'),
+        ),
+        migrations.AddIndex(
+            model_name='time',
+            index=models.Index(fields=['user', 'updated'], name='time_user_updated'),
+        ),
+        migrations.AddConstraint(
+            model_name='time',
+            constraint=models.UniqueConstraint(fields=('schedule', 'fingerprint'), name='unique_schedule_time_fingerprint'),
+        ),
+    ]
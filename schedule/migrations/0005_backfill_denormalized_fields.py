@@ -0,0 +1,19 @@
+from django.db import migrations
+
+from schedule.denormalizedFields import backfillDenormalizedFields
+
+
+def forward(apps, schema_editor):
+    backfillDenormalizedFields(apps.get_model('schedule', 'Schedule'), apps.get_model('schedule', 'Time'),
+                               apps.get_model('schedule', 'Record'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('schedule', '0004_denormalized_fields_and_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(forward, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.0.1 on 2026-10-18 22:25
+
+from django.contrib.postgres.operations import BtreeGistExtension
+from django.db import migrations, models
+
+# 与 schedule.models 的 TIME_SPAN_EXPRESSION / TIME_SPAN_INDEX_CONDITION 相同，迁移中保留创建时的副本
+TIME_SPAN_EXPRESSION = 'tstzrange("start", greatest("start", "end"), \'[]\')'
+TIME_SPAN_INDEX_CONDITION = 'NOT "deleted" AND NOT "excluded" AND NOT "done" AND "start" IS NOT NULL'
+
+
+def createEventSpanIndex(apps, schema_editor):
+    """
+    event 时间片的 (user_id, tstzrange) GiST 索引，SQLite 不支持，只在 PostgreSQL 上创建
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    table = schema_editor.quote_name(apps.get_model('schedule', 'Time')._meta.db_table)
+    schema_editor.execute(f'CREATE INDEX IF NOT EXISTS time_live_event_span ON {table} '
+                          f'USING gist ("user_id", {TIME_SPAN_EXPRESSION}) WHERE {TIME_SPAN_INDEX_CONDITION}')
+
+
+def dropEventSpanIndex(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS time_live_event_span')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('schedule', '0005_backfill_denormalized_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='schedule',
+            name='maxDuration',
+            field=models.DurationField(null=True),
+        ),
+        # GiST 索引中的 user_id 需要 btree_gist
+        BtreeGistExtension(),
+        migrations.RunPython(createEventSpanIndex, dropEventSpanIndex),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.0.1 on 2026-10-18 23:10
+
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+def createSearchTrigramIndex(apps, schema_editor):
+    """
+    schedule 搜索文档的 trigram GIN 索引，SQLite 不支持，只在 PostgreSQL 上创建
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    table = schema_editor.quote_name(apps.get_model('schedule', 'Schedule')._meta.db_table)
+    schema_editor.execute(f'CREATE INDEX IF NOT EXISTS schedule_search_trgm ON {table} '
+                          f'USING gin ("searchDocument" gin_trgm_ops)')
+
+
+def dropSearchTrigramIndex(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS schedule_search_trgm')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('schedule', '0006_event_span_index'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.RunPython(createSearchTrigramIndex, dropSearchTrigramIndex),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.1 on 2026-10-18 23:14
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('schedule', '0007_search_trigram_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='schedule',
+            name='schedule_live_span',
+        ),
+        migrations.AddIndex(
+            model_name='schedule',
+            index=models.Index(condition=models.Q(('liveCount__gt', 0), ('materializedUntil__isnull', False), _connector='OR'), fields=['user', 'lastAt', 'firstAt'], name='schedule_live_span'),
+        ),
+    ]
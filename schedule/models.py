@@ -1,6 +1,11 @@
+from typing import Iterable
+
 from django.db import models
+from django.db.models import Func, Q, Value
 from main.models import Base
 from user.models import ScheduleUser
+from schedule.timeCodeParserTypes import packMarks, toFingerprint
+from utils.timeZone import toEpochMillis, isoformat, toUTCISOString
 
 
 class Schedule(Base):
@@ -16,10 +21,57 @@ class Schedule(Base):
     exTimeCode = models.TextField()
     comment = models.TextField()
     star = models.BooleanField(default=False)
+    # 时间片只物化到该时间，None 表示已全部物化
+    materializedUntil = models.DateTimeField(null=True)
+    # name、comment 和时间片 comment 组成的搜索文档，服务端维护，不参与同步
+    searchDocument = models.TextField(default='')
+    # 未删除、未排除的时间片中最早的开始（_todo 为结束）、最晚的结束和数量，服务端维护，不参与同步
+    # 没有物化完时 firstAt / lastAt 由 rrule 的范围得到
+    firstAt = models.DateTimeField(null=True)
+    lastAt = models.DateTimeField(null=True)
+    liveCount = models.IntegerField(default=0)
+    # 未删除、未排除的时间片中最长的时长，非 PostgreSQL 的重叠查询用它限制 start 的下界，服务端维护，不参与同步
+    maxDuration = models.DurationField(null=True)
+    # 删除单个时间片产生的排除，时间片 fingerprint 以 ; 分隔，参与同步，客户端按时间码生成时间片时同样排除
+    exFingerprints = models.TextField(default='')
+
+    class Meta:
+        indexes = [
+            # findAllSchedules / 物化 horizon 按类型和是否删除过滤
+            models.Index(fields=['user', 'type', 'deleted'], name='schedule_user_type_deleted'),
+            # getUnSynced
+            models.Index(fields=['user', 'updated'], name='schedule_user_updated'),
+            # findSchedulesAfter 的 keyset 分页
+            models.Index(fields=['user', 'created', 'id'], name='schedule_user_created'),
+            # findAllSchedules 按日期范围过滤，没有物化完的 schedule 可能还没有时间片
+            models.Index(fields=['user', 'lastAt', 'firstAt'], name='schedule_live_span',
+                         condition=Q(liveCount__gt=0) | Q(materializedUntil__isnull=False)),
+            # extendHorizon 只查还没有物化完的 schedule
+            models.Index(fields=['user', 'materializedUntil'], name='schedule_live_horizon',
+                         condition=Q(deleted=False, materializedUntil__isnull=False)),
+        ]
 
     def __str__(self):
         return self.name
 
+    def getExFingerprints(self) -> set[str]:
+        return set(self.exFingerprints.split(';')) if self.exFingerprints != '' else set()
+
+    def addExFingerprints(self, fingerprints: Iterable[str]):
+        """
+        追加排除的时间片，已经排除的不重复追加
+        """
+        existing = self.getExFingerprints()
+        added = [fingerprint for fingerprint in dict.fromkeys(fingerprints) if fingerprint not in existing]
+        self.exFingerprints = ';'.join(([self.exFingerprints] if self.exFingerprints != '' else []) + added)
+
+    def pruneExFingerprints(self, fingerprints: set[str]):
+        """
+        时间码修改后只保留仍然对应 fingerprints 中时间片的排除，之后重新出现的时间片不再被排除
+        """
+        self.exFingerprints = ';'.join(fingerprint for fingerprint in self.exFingerprints.split(';')
+                                       if fingerprint in fingerprints)
+
     def to_dict(self):
         return {
             'id': self.id,
@@ -29,52 +81,123 @@ class Schedule(Base):
             'rrules': self.rrules,
             'rTimeCode': self.rTimeCode,
             'exTimeCode': self.exTimeCode,
+            'exFingerprints': self.exFingerprints,
             'comment': self.comment,
             'star': self.star,
             'deleted': self.deleted,
-            'created': self.created,
-            'updated': self.updated,
-            'syncAt': self.syncAt,
+            'created': isoformat(self.created),
+            'updated': isoformat(self.updated),
+            'syncAt': isoformat(self.syncAt),
             'version': self.version,
         }
 
 
 class Time(Base):
     schedule = models.ForeignKey(Schedule, on_delete=models.CASCADE, related_name='times')
+    # 冗余 schedule 的 user_id、name、comment，热点查询不需要 join schedule，None 表示还没有回填的旧数据
+    user = models.ForeignKey(ScheduleUser, on_delete=models.CASCADE, related_name='times', null=True)
+    scheduleName = models.TextField(default='')
+    scheduleComment = models.TextField(default='')
     excluded = models.BooleanField(default=False)
-    start = models.CharField(max_length=255, null=True)
-    end = models.CharField(max_length=255)
+    start = models.DateTimeField(null=True)
+    end = models.DateTimeField()
     startMark = models.CharField(max_length=255)
     endMark = models.CharField(max_length=255)
     comment = models.CharField(max_length=255, default='')
     done = models.BooleanField(default=False)
+    # 规范化的 start / end / mark，同步时间片时按它匹配已有的时间片，None 表示还没有回填的旧数据或重复的时间片
+    fingerprint = models.CharField(max_length=255, null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['schedule', 'fingerprint'], name='unique_schedule_time_fingerprint'),
+        ]
+        # 热点查询只查没有删除、没有排除的时间片，部分索引只包含这些行
+        indexes = [
+            # findEventsBetween
+            models.Index(fields=['user', 'start'], name='time_live_event_start',
+                         condition=Q(deleted=False, excluded=False, done=False, start__isnull=False)),
+            # findAllTodos 今天的时间片
+            models.Index(fields=['user', 'end'], name='time_live_user_end',
+                         condition=Q(deleted=False, excluded=False)),
+            # findAllTodos 每个 schedule 下一个时间片、findTimesByScheduleId
+            models.Index(fields=['schedule', 'end'], name='time_live_schedule_end',
+                         condition=Q(deleted=False, excluded=False)),
+            # getUnSynced
+            models.Index(fields=['user', 'updated'], name='time_user_updated'),
+        ]
 
     def __str__(self):
         return f'{self.start}-{self.end}'
 
+    def key(self) -> tuple:
+        """
+        与 TimeRange.key 相同的可哈希 key
+        """
+        return toEpochMillis(self.start), toEpochMillis(self.end), packMarks(self.startMark, self.endMark)
+
+    def computeFingerprint(self) -> str:
+        """
+        由 start / end / mark 计算的 fingerprint，与 TimeRange.fingerprint 相同
+        """
+        return toFingerprint(self.key())
+
     def to_dict(self):
         return {
             'id': self.id,
             'scheduleId': self.schedule_id,
             'excluded': self.excluded,
-            'start': self.start,
-            'end': self.end,
+            'start': toUTCISOString(self.start),
+            'end': toUTCISOString(self.end),
             'startMark': self.startMark,
             'endMark': self.endMark,
             'comment': self.comment,
             'done': self.done,
             'deleted': self.deleted,
-            'created': self.created,
-            'updated': self.updated,
-            'syncAt': self.syncAt,
+            'created': isoformat(self.created),
+            'updated': isoformat(self.updated),
+            'syncAt': isoformat(self.syncAt),
             'version': self.version,
         }
 
 
+# PostgreSQL 上 event 时间片的 tstzrange GiST 索引，用于 findEventsBetween 的重叠查询
+# SQLite 不支持，由迁移 0006 只在 PostgreSQL 上创建，表达式必须与 SpanOverlaps 生成的相同
+# greatest 防止同步来的 end < start 的时间片构造 tstzrange 出错，闭区间使零长度的时间片也能匹配
+TIME_SPAN_EXPRESSION = 'tstzrange("start", greatest("start", "end"), \'[]\')'
+
+
+class SpanOverlaps(Func):
+    """
+    PostgreSQL 上时间片的 tstzrange 与窗口 [windowStart, windowEnd] 相交，只用于走 GiST 索引，
+    闭区间比 start < windowEnd AND end > windowStart 宽，调用方仍需精确过滤
+    """
+    output_field = models.BooleanField()
+
+    def __init__(self, windowStart, windowEnd):
+        super().__init__(Value(windowStart), Value(windowEnd))
+
+    def as_sql(self, compiler, connection, **extra_context):
+        windowStart, windowStartParams = compiler.compile(self.source_expressions[0])
+        windowEnd, windowEndParams = compiler.compile(self.source_expressions[1])
+        table = connection.ops.quote_name(Time._meta.db_table)
+        span = TIME_SPAN_EXPRESSION.replace('"start"', f'{table}."start"').replace('"end"', f'{table}."end"')
+        return (f"{span} && tstzrange({windowStart}, {windowEnd}, '[]')",
+                (*windowStartParams, *windowEndParams))
+
+
 class Record(Base):
     schedule = models.ForeignKey(Schedule, on_delete=models.CASCADE, related_name='record')
-    start = models.CharField(max_length=255)
-    end = models.CharField(max_length=255)
+    # 冗余 schedule 的 user_id，None 表示还没有回填的旧数据
+    user = models.ForeignKey(ScheduleUser, on_delete=models.CASCADE, related_name='records', null=True)
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            # getUnSynced
+            models.Index(fields=['user', 'updated'], name='record_user_updated'),
+        ]
 
     def __str__(self):
         return f'{self.start}-{self.end}'
@@ -83,11 +206,11 @@ class Record(Base):
         return {
             'id': self.id,
             'scheduleId': self.schedule_id,
-            'start': self.start,
-            'end': self.end,
+            'start': isoformat(self.start),
+            'end': isoformat(self.end),
             'deleted': self.deleted,
-            'created': self.created,
-            'updated': self.updated,
-            'syncAt': self.syncAt,
+            'created': isoformat(self.created),
+            'updated': isoformat(self.updated),
+            'syncAt': isoformat(self.syncAt),
             'version': self.version,
         }
@@ -0,0 +1,6 @@
+def toSearchDocument(name: str, comment: str, timeComments: list[str]) -> str:
+    """
+    schedule 的搜索文档：name、comment 和时间片的 comment，小写，每项一行
+    """
+    return '\n'.join(part.lower() for part in [name, comment, *timeComments] if part != '')
+
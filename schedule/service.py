@@ -1,48 +1,268 @@
+import json
+import re
 import uuid
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from copy import deepcopy
-from datetime import datetime
+from hashlib import sha1
+from functools import lru_cache
+from datetime import datetime, timedelta
+from itertools import islice
+from typing import Iterable, Iterator
 from django.core.paginator import Paginator
 
 from dateutil import tz
 from dateutil.relativedelta import relativedelta
-from django.db import transaction
-from django.db.models import F
-
-from schedule.models import Schedule, Time, Record, Base
-from schedule.timeCodeParser import parseTimeCodes
-from schedule.timeCodeParserTypes import TimeRange, EventType
-from setting.service import getSettingByPath
-from utils.utils import difference, union
-from utils.timeZone import isoformat
+from django.conf import settings as djangoSettings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Count, DurationField, F, Max, Min, Q, QuerySet, Window
+from django.db.models.functions import Coalesce, Length, RowNumber
+from django_redis import get_redis_connection
+
+from schedule.eventIndexCache import EventIndex, EventIndexCache
+from schedule.searchDocument import toSearchDocument
+from schedule.models import Schedule, Time, Record, Base, SpanOverlaps
+from schedule.timeCodeParser import parseTimeCodes, streamTimeCodes, loadParserSettings, diffTimeCodeLines, \
+    splitTimeCodeLines, timeCodeParser, timeCodeBounds
+from schedule.timeCodeParserTypes import TimeRange, EventType, TimeCodeDao, ParserSettings, toFingerprint
+from setting.service import getSettingsSnapshot
+from utils.utils import keyedUnion
+from utils.timeZone import isoformat, utcNow, fromISOString, toUTCISOString, epochSecondsToDatetime
 from utils.vo import EventBriefVO, TodoBriefVO, ScheduleBriefVO
 
+# 只物化该范围内的时间片，之后的时间片在查询或定时任务中按需补齐，None 表示全部物化
+MATERIALIZE_HORIZON: relativedelta | None = relativedelta(days=90)
+
+
+def getHorizon(until: datetime | None = None) -> datetime | None:
+    """
+    新的物化边界，不早于 until
+    """
+    if MATERIALIZE_HORIZON is None:
+        return None
+    horizon = datetime.now().astimezone(tz.gettz('UTC')) + MATERIALIZE_HORIZON
+    if until is not None and until > horizon:
+        return until
+    return horizon
+
+
+def withinHorizon(times: list[TimeRange], horizon: datetime | None, since: datetime | None = None) -> list[TimeRange]:
+    """
+    结束时间在 (since, horizon] 内的时间片
+    """
+    if horizon is None and since is None:
+        return times
+    sinceTs = since.timestamp() if since is not None else None
+    horizonTs = horizon.timestamp() if horizon is not None else None
+    return [time for time in times
+            if (sinceTs is None or time.endTs > sinceTs) and (horizonTs is None or time.endTs <= horizonTs)]
+
+
+def beyondHorizon(times: list[TimeRange], horizon: datetime | None) -> datetime | None:
+    """
+    还有时间片在 horizon 之后时返回新的 materializedUntil，否则返回 None
+    """
+    if horizon is None:
+        return None
+    horizonTs = horizon.timestamp()
+    if any(time.endTs > horizonTs for time in times):
+        return horizon
+    return None
+
+
+# 每批写入的时间片数量，可以在 Django 设置中用 SCHEDULE_TIME_BATCH_SIZE 覆盖
+TIME_BATCH_SIZE = 1000
+
+
+def getTimeBatchSize() -> int:
+    return getattr(djangoSettings, 'SCHEDULE_TIME_BATCH_SIZE', TIME_BATCH_SIZE)
+
+
+def useCopy() -> bool:
+    """
+    PostgreSQL（psycopg 3）上使用 COPY 写入时间片，可以在 Django 设置中用 SCHEDULE_TIME_COPY = False 关闭
+    """
+    return connection.vendor == 'postgresql' and getattr(djangoSettings, 'SCHEDULE_TIME_COPY', True)
+
+
+# 每个 worker 按用户缓存 event 时间片的 EventIndex，可以在 Django 设置中用 SCHEDULE_EVENT_INDEX_CACHE_BYTES 设置内存上限，
+# 0 表示不缓存
+EVENT_INDEX_CACHE_BYTES = 0
+eventIndexCache = EventIndexCache(maxbytes=getattr(djangoSettings, 'SCHEDULE_EVENT_INDEX_CACHE_BYTES',
+                                                   EVENT_INDEX_CACHE_BYTES))
+# event generation 保存在 redis 中，所有 worker 共享，时间片变化后加一，各 worker 的 EventIndex 随之失效
+# 只在启用 EventIndex 后第一次使用时连接，未启用时不需要 redis
+generationConnection = None
+
+
+def eventIndexEnabled() -> bool:
+    return eventIndexCache.cache.maxsize > 0
+
+
+def getGenerationConnection():
+    global generationConnection
+    if generationConnection is None:
+        generationConnection = get_redis_connection('default')
+    return generationConnection
+
+
+def getEventGeneration(userId: str) -> int:
+    generation = getGenerationConnection().get(f'eventGeneration:{userId}')
+    return int(generation) if generation is not None else 0
+
+
+def bumpEventGeneration(userId: str):
+    """
+    用户的 event 时间片可能变化时调用，事务提交后才增加 generation，其他 worker 不会在提交前重新加载到旧数据
+    """
+    if eventIndexEnabled():
+        transaction.on_commit(lambda: getGenerationConnection().incr(f'eventGeneration:{userId}'))
+
+
+def insertTimes(times: list[Time]):
+    """
+    一次写入一批时间片，COPY 按模型的所有字段写入，与 bulk_create 的结果相同
+    """
+    if not useCopy():
+        Time.objects.bulk_create(times)
+        return
+    fields = Time._meta.concrete_fields
+    columns = ', '.join(connection.ops.quote_name(field.column) for field in fields)
+    with connection.cursor() as cursor:
+        with cursor.copy(f'COPY {connection.ops.quote_name(Time._meta.db_table)} ({columns}) FROM STDIN') as copy:
+            for time in times:
+                copy.write_row([field.get_db_prep_save(getattr(time, field.attname), connection) for field in fields])
+
+
+def bulkCreateTimes(schedule: Schedule, times: Iterable[tuple[TimeRange, bool]], now: datetime | None = None,
+                    revive: bool = True):
+    """
+    分批写入 (时间片, excluded)，可以传入生成器，内存占用不随时间片数量增长
+
+    按结束时间排序的流中重复的时间片相邻，只写入一次
+
+    :param now: 所有时间片共用的 created / updated，默认为当前时间
+    :param revive: 每批先按 fingerprint 查询已有的时间片并恢复，确定没有已有时间片时（新的 schedule）可以跳过
+    """
+    if now is None:
+        now = utcNow()
+    batchSize = getTimeBatchSize()
+    times = iter(times)
+    lastFingerprint: str | None = None
+    while True:
+        items = list(islice(times, batchSize))
+        if len(items) == 0:
+            return
+        batch: dict[str, tuple[TimeRange, bool]] = {}
+        for time, excluded in items:
+            fingerprint = time.fingerprint()
+            if fingerprint != lastFingerprint:
+                batch[fingerprint] = (time, excluded)
+                lastFingerprint = fingerprint
+        toUpdate: list[Time] = []
+        if revive:
+            for t in Time.objects.filter(schedule_id=schedule.id, fingerprint__in=list(batch.keys())):
+                _, excluded = batch.pop(t.fingerprint)
+                if reviveTime(t, t.fingerprint, excluded, now):
+                    toUpdate.append(t)
+        applyTimeChanges(schedule, toUpdate, batch.values(), [], now)
+
+
+def createTimes(schedule: Schedule, rTimes: list[TimeRange], exTimes: list[TimeRange]):
+    """
+    为新的 schedule 创建时间片，exTimes 标记为 excluded
+    """
+    times = {time.fingerprint(): (time, False) for time in rTimes}
+    times.update({time.fingerprint(): (time, True) for time in exTimes})
+    bulkCreateTimes(schedule, times.values(), revive=False)
+
+
+def reviveTime(t: Time, fingerprint: str, excluded: bool, now: datetime) -> bool:
+    """
+    恢复已有的时间片，同步 excluded，补上旧数据缺少的 fingerprint
+
+    :return: 是否有变化，需要写回数据库
+    """
+    changed = t.deleted or t.excluded != excluded
+    if not changed and t.fingerprint == fingerprint:
+        return False
+    t.fingerprint = fingerprint
+    # 只补 fingerprint 不算修改，不增加 version
+    if changed:
+        t.deleted = False
+        t.excluded = excluded
+        t.version += 1
+        t.updated = now
+    return True
+
+
+def applyTimeChanges(schedule: Schedule, toUpdate: list[Time], toCreate: Iterable[tuple[TimeRange, bool]],
+                     toDelete: list[str], now: datetime):
+    """
+    集合式地写入一次同步的结果：一次 bulk_update 写回恢复、修改 excluded 的时间片，bulk_create 创建新的时间片，
+    一次 UPDATE ... WHERE fingerprint IN (...) 删除不再需要的时间片
+    """
+    if len(toUpdate) > 0:
+        Time.objects.bulk_update(toUpdate, ['fingerprint', 'deleted', 'excluded', 'version', 'updated'])
+    toCreate = iter(toCreate)
+    batchSize = getTimeBatchSize()
+    while True:
+        batch = [Time(id=uuid.uuid4().hex, schedule_id=schedule.id, user_id=schedule.user_id,
+                      scheduleName=schedule.name, scheduleComment=schedule.comment, excluded=excluded,
+                      start=epochSecondsToDatetime(time.startTs), end=epochSecondsToDatetime(time.endTs),
+                      startMark=time.startMark, endMark=time.endMark, done=False,
+                      fingerprint=time.fingerprint(), created=now, updated=now)
+                 for time, excluded in islice(toCreate, batchSize)]
+        if len(batch) == 0:
+            break
+        insertTimes(batch)
+    for i in range(0, len(toDelete), RECONCILE_CHUNK_SIZE):
+        (Time.objects.filter(schedule_id=schedule.id, fingerprint__in=toDelete[i:i + RECONCILE_CHUNK_SIZE])
+         .update(deleted=True, version=F('version') + 1, updated=now))
+
+
+def materializeTimes(schedule: Schedule, times: Iterator[tuple[TimeRange, bool]], horizon: datetime | None,
+                     since: datetime | None = None, now: datetime | None = None,
+                     revive: bool = True) -> datetime | None:
+    """
+    写入按结束时间排序的时间片流中 (since, horizon] 内的部分，遇到 horizon 之后的时间片就停止展开
+
+    :return: 新的 materializedUntil
+    """
+    sinceTs = since.timestamp() if since is not None else None
+    horizonTs = horizon.timestamp() if horizon is not None else None
+    beyond = False
+
+    def within():
+        nonlocal beyond
+        for time, excluded in times:
+            if horizonTs is not None and time.endTs > horizonTs:
+                beyond = True
+                return
+            if sinceTs is None or time.endTs > sinceTs:
+                yield time, excluded
+
+    bulkCreateTimes(schedule, within(), now, revive)
+    return horizon if beyond else None
+
 
 @transaction.atomic
 def createSchedule(userId: str, name: str, timeCodes: str, comment: str, exTimeCodes: str):
-    parseRes = parseTimeCodes(userId, timeCodes, exTimeCodes)
-    eventType, rTimes, exTimes, rruleStr, code, exCode = parseRes.eventType, parseRes.rTimes, parseRes.exTimes, parseRes.rruleStr, parseRes.rTimeCodes, parseRes.exTimeCodes
+    stream = streamTimeCodes(userId, timeCodes, exTimeCodes)
 
-    schedule = Schedule(id=uuid.uuid4().hex, user_id=userId, type=eventType, name=name, rrules=rruleStr, rTimeCode=code,
-                        exTimeCode=exCode, comment=comment,
-                        created=isoformat(datetime.now().astimezone(tz.gettz('UTC'))),
-                        updated=isoformat(datetime.now().astimezone(tz.gettz('UTC'))))
+    # schedule 和它的所有时间片共用一个时间戳
+    now = utcNow()
+    schedule = Schedule(id=uuid.uuid4().hex, user_id=userId, type=stream.eventType, name=name, rrules=stream.rruleStr,
+                        rTimeCode=stream.rTimeCodes, exTimeCode=stream.exTimeCodes, comment=comment,
+                        searchDocument=toSearchDocument(name, comment, []), created=now, updated=now)
     schedule.save()
 
-    allTimes = {
-        'rTimes': rTimes,
-        'exTimes': exTimes
-    }
-
-    for key, value in allTimes.items():
-        for time in value:
-            time = Time(id=uuid.uuid4().hex, schedule_id=schedule.id,
-                        excluded=False if key == 'rTimes' else True,
-                        start=time.start, end=time.end,
-                        startMark=time.startMark,
-                        endMark=time.endMark, done=False,
-                        created=isoformat(datetime.now().astimezone(tz.gettz('UTC'))),
-                        updated=isoformat(datetime.now().astimezone(tz.gettz('UTC'))))
-            time.save()
+    # 时间片边展开边写入，写完才知道是否超出 horizon
+    schedule.materializedUntil = materializeTimes(schedule, stream.times, getHorizon(), now=now, revive=False)
+    if schedule.materializedUntil is not None:
+        schedule.save(update_fields=['materializedUntil'])
+    updateScheduleSpan(schedule)
+    bumpEventGeneration(userId)
 
     return schedule.to_dict()
 
@@ -54,12 +274,18 @@ def updateScheduleById(id: str, userId: str, name: str, timeCodes: str, comment:
     if oldSchedule.deleted:
         raise Exception('try to update a deleted schedule')
 
-    parseRes = parseTimeCodes(userId, timeCodes, exTimeCodes)
+    settings = loadParserSettings(userId)
+    # 删除单个时间片产生的排除按 fingerprint 匹配，只有用户编写的 exTimeCodes 需要解析
+    exFingerprints = oldSchedule.getExFingerprints()
+    parseRes = parseTimeCodes(userId, timeCodes, exTimeCodes, settings, exFingerprints)
     eventType, rTimes, exTimes, rruleStr, code, exCode = parseRes.eventType, parseRes.rTimes, parseRes.exTimes, parseRes.rruleStr, parseRes.rTimeCodes, parseRes.exTimeCodes
 
     if oldSchedule.type != eventType:
         raise Exception('try to change schedule type')
 
+    # 如果时间片没有变化，不需要重新物化
+    changed = oldSchedule.rTimeCode != code or oldSchedule.exTimeCode != exCode
+
     schedule = deepcopy(oldSchedule)
     schedule.name = name
     schedule.rrules = rruleStr
@@ -67,163 +293,481 @@ def updateScheduleById(id: str, userId: str, name: str, timeCodes: str, comment:
     schedule.exTimeCode = exCode
     schedule.comment = comment
     schedule.version += 1
-    schedule.updated = isoformat(datetime.now().astimezone(tz.gettz('UTC')))
+    schedule.updated = utcNow()
+
+    # 只处理新增、删除的行，旧的时间码依赖于“今天”或无法解析时全部重新同步
+    oldParseRes: TimeCodeDao | None = None
+    if changed and not parseRes.relative:
+        try:
+            oldParseRes = parseTimeCodes(userId, oldSchedule.rTimeCode, oldSchedule.exTimeCode, settings,
+                                         exFingerprints)
+        except Exception:
+            oldParseRes = None
+    incremental = oldParseRes is not None and not oldParseRes.relative and not hasUnfingerprintedTimes(id)
+
+    materializedUntil = oldSchedule.materializedUntil
+    if incremental and materializedUntil is not None:
+        # 没有变化的行只物化到了 materializedUntil，horizon 保持不变，之后的时间片在查询时补齐
+        horizon = materializedUntil
+    else:
+        # horizon 只向后推进，已经物化的时间片不会超出新的 horizon
+        horizon = getHorizon(materializedUntil)
+    if changed:
+        schedule.materializedUntil = beyondHorizon(rTimes + exTimes, horizon)
+        # 删除的行中被排除的时间片不再保留排除，行改回来后时间片重新出现
+        schedule.pruneExFingerprints({time.fingerprint() for time in rTimes + exTimes})
     schedule.save()
+    if schedule.name != oldSchedule.name or schedule.comment != oldSchedule.comment:
+        updateTimeScheduleFields(schedule)
+    bumpEventGeneration(userId)
 
     # 如果时间片没有变化，直接返回
-    if oldSchedule.rTimeCode == code and oldSchedule.exTimeCode == exCode:
+    if not changed:
+        updateSearchDocument(schedule)
         return oldSchedule.to_dict()
 
-    # 获取所有和该 Schedule 相关的时间片, Schedule 已经限定了 user_id，所以不需要再限定
-    times = Time.objects.filter(schedule__id=id)
-
-    def equal(time1: TimeRange | Time, time2: TimeRange | Time):
-        """
-        两个时间片相等的条件
-        """
-        if time1.start is not None and time1.end is not None:
-            if datetime.fromisoformat(time1.start) != datetime.fromisoformat(time2.start):
-                return False
-        if datetime.fromisoformat(time1.end) != datetime.fromisoformat(time2.end):
-            return False
-        if time1.startMark != time2.startMark:
-            return False
-        if time1.endMark != time2.endMark:
-            return False
-        return True
-
-    allTimes: {str: list[TimeRange]} = {
-        'rTimes': rTimes,
-        'exTimes': exTimes
-    }
+    if incremental:
+        reconcileTimeLines(schedule, oldParseRes, parseRes, horizon, exFingerprints)
+    else:
+        reconcileAllTimes(schedule, withinHorizon(rTimes, horizon), withinHorizon(exTimes, horizon))
+    # 删除的时间片的 comment 不再参与搜索
+    updateSearchDocument(schedule)
+    updateScheduleSpan(schedule)
+
+    return schedule.to_dict()
+
+
+def buildSearchDocument(schedule: Schedule) -> str:
+    timeComments = (Time.objects.filter(schedule_id=schedule.id, deleted=False)
+                    .exclude(comment='')
+                    .order_by('comment')
+                    .values_list('comment', flat=True)
+                    .distinct())
+    return toSearchDocument(schedule.name, schedule.comment, list(timeComments))
+
+
+def updateSearchDocument(schedule: Schedule):
+    """
+    schedule 的 name / comment 或时间片的 comment 修改后重新生成搜索文档，搜索文档不参与同步，不增加 version
+    """
+    document = buildSearchDocument(schedule)
+    if document != schedule.searchDocument:
+        schedule.searchDocument = document
+        Schedule.objects.filter(id=schedule.id).update(searchDocument=document)
+
+
+def updateScheduleSpan(schedule: Schedule, settings: ParserSettings | None = None):
+    """
+    时间片增加、删除、排除后重新统计 schedule 的 firstAt / lastAt / liveCount / maxDuration，不增加 version
+
+    还没有物化完的 schedule 的时间片只到 materializedUntil，firstAt / lastAt 由 rrule 的范围得到
+    """
+    span = (Time.objects.filter(schedule_id=schedule.id, deleted=False, excluded=False)
+            .aggregate(firstAt=Min(Coalesce('start', 'end')), lastAt=Max('end'), liveCount=Count('id'),
+                       maxDuration=Max(F('end') - F('start'), output_field=DurationField())))
+    if schedule.materializedUntil is not None:
+        if settings is None:
+            settings = loadParserSettings(schedule.user_id)
+        first, last = timeCodeBounds(settings, schedule.rTimeCode)
+        if span['firstAt'] is None and first is not None:
+            span['firstAt'] = epochSecondsToDatetime(first)
+        span['lastAt'] = epochSecondsToDatetime(last)
+    if any(getattr(schedule, field) != value for field, value in span.items()):
+        for field, value in span.items():
+            setattr(schedule, field, value)
+        Schedule.objects.filter(id=schedule.id).update(**span)
+
+
+def updateTimeScheduleFields(schedule: Schedule):
+    """
+    schedule 的 name / comment 修改后同步到时间片的冗余字段，冗余字段不参与同步，不增加时间片的 version
+    """
+    (Time.objects.filter(schedule_id=schedule.id)
+     .exclude(scheduleName=schedule.name, scheduleComment=schedule.comment)
+     .update(scheduleName=schedule.name, scheduleComment=schedule.comment))
+
+
+def reconcileAllTimes(schedule: Schedule, rTimes: list[TimeRange], exTimes: list[TimeRange]):
+    """
+    将 schedule 的所有时间片同步为 rTimes 和 exTimes
+    """
+    now = utcNow()
+    wanted: dict[str, tuple[TimeRange, bool]] = {time.fingerprint(): (time, False) for time in rTimes}
+    wanted.update({time.fingerprint(): (time, True) for time in exTimes})
 
-    for key, value in allTimes.items():
-        # 遍历 rTimes 和 exTimes
-        for time in value:
+    # 获取所有和该 Schedule 相关的时间片, Schedule 已经限定了 user_id，所以不需要再限定
+    # 已有 fingerprint 的时间片优先，其次是没有删除的旧数据，同样的时间片只保留第一个
+    times = sorted(Time.objects.filter(schedule__id=schedule.id), key=lambda t: (t.fingerprint is None, t.deleted))
+    seen: set[str] = set()
+    toUpdate: list[Time] = []
+    toDelete: list[str] = []
+    for t in times:
+        fingerprint = t.fingerprint if t.fingerprint is not None else t.computeFingerprint()
+        if fingerprint in seen:
+            # 重复的旧数据，没有 fingerprint，直接删除
+            if not t.deleted:
+                t.deleted = True
+                t.version += 1
+                t.updated = now
+                toUpdate.append(t)
+            continue
+        seen.add(fingerprint)
+        item = wanted.get(fingerprint)
+        if item is not None:
             # 如果曾创建过一样的时间片，恢复 deleted 为 false
-            if any(equal(time, t) for t in times):
-                for _t in times:
-                    if equal(time, _t):
-                        t = _t
-                        break
-                t.excluded = False if key == 'rTimes' else True
-                t.deleted = False
+            if reviveTime(t, fingerprint, item[1], now):
+                toUpdate.append(t)
+        elif t.fingerprint is None:
+            # 不包括在 rTimes 和 exTimes 的内容要彻底删除，只标记 deleted 为 true 会导致 exTime 多出意外值
+            t.fingerprint = fingerprint
+            if not t.deleted:
+                t.deleted = True
                 t.version += 1
-                t.updated = isoformat(datetime.now().astimezone(tz.gettz('UTC')))
-                t.save()
-            # 如果没有创建过，创建新的时间片
-            else:
-                t = Time(id=uuid.uuid4().hex, schedule_id=schedule.id,
-                         excluded=False if key == 'rTimes' else True,
-                         start=time.start, end=time.end,
-                         startMark=time.startMark, endMark=time.endMark, done=False,
-                         created=isoformat(datetime.now().astimezone(tz.gettz('UTC'))),
-                         updated=isoformat(datetime.now().astimezone(tz.gettz('UTC'))))
-                t.save()
-
-    # 不包括在 rTimes 和 exTimes 的内容要彻底删除，只标记 deleted 为 true 会导致 exTime 多出意外值
-    toDel = difference(times, rTimes + exTimes, equal)
-
-    # 需要删除的时间片
-    for time in toDel:
-        time.deleted = True
-        time.version += 1
-        time.updated = isoformat(datetime.now().astimezone(tz.gettz('UTC')))
-        time.save()
+                t.updated = now
+            toUpdate.append(t)
+        elif not t.deleted:
+            toDelete.append(fingerprint)
+
+    # 如果没有创建过，创建新的时间片
+    toCreate = [item for fingerprint, item in wanted.items() if fingerprint not in seen]
+    applyTimeChanges(schedule, toUpdate, toCreate, toDelete, now)
+
+
+# 按 fingerprint 查询、删除时间片时每次最多带的参数数量
+RECONCILE_CHUNK_SIZE = 500
+
+
+def findTimesByFingerprints(scheduleId: str, fingerprints: list[str]) -> dict[str, Time]:
+    """
+    按 fingerprint 查询 schedule 已有的时间片
+    """
+    timesByFingerprint: dict[str, Time] = {}
+    for i in range(0, len(fingerprints), RECONCILE_CHUNK_SIZE):
+        for t in Time.objects.filter(schedule__id=scheduleId,
+                                     fingerprint__in=fingerprints[i:i + RECONCILE_CHUNK_SIZE]):
+            timesByFingerprint[t.fingerprint] = t
+    return timesByFingerprint
+
+
+def hasUnfingerprintedTimes(scheduleId: str) -> bool:
+    """
+    是否还有没有回填 fingerprint 的时间片，有的话只能全部重新同步
+    """
+    return Time.objects.filter(schedule__id=scheduleId, fingerprint__isnull=True, deleted=False).exists()
+
+
+def reconcileTimeLines(schedule: Schedule, oldParseRes: TimeCodeDao, parseRes: TimeCodeDao, horizon: datetime | None,
+                       exFingerprints: set[str]):
+    """
+    只同步新增、删除的行涉及的时间片，没有变化的行对应的时间片不会被修改
+    """
+    keys = diffTimeCodeLines(oldParseRes.rLines, parseRes.rLines) | diffTimeCodeLines(oldParseRes.exLines, parseRes.exLines)
+    if len(keys) == 0:
+        return
+    now = utcNow()
+    rLines = list(parseRes.rLines.values())
+    exLines = list(parseRes.exLines.values())
+    horizonTs = horizon.timestamp() if horizon is not None else None
+    fingerprints = {toFingerprint(key): key for key in keys}
+    timesByFingerprint = findTimesByFingerprints(schedule.id, list(fingerprints.keys()))
+
+    toUpdate: list[Time] = []
+    toCreate: list[tuple[TimeRange, bool]] = []
+    toDelete: list[str] = []
+    for fingerprint, key in fingerprints.items():
+        # 与 parseTimeCodes 相同：在 r 中的为时间片，同时在 ex 中或已经被删除的为 excluded 的时间片
+        inR = any(key in timeCodeSem.keySet() for timeCodeSem in rLines)
+        excluded = inR and (fingerprint in exFingerprints
+                            or any(key in timeCodeSem.keySet() for timeCodeSem in exLines))
+        t = timesByFingerprint.get(fingerprint)
+        if t is not None:
+            # 如果曾创建过一样的时间片，恢复并同步 excluded；不再需要的时间片删除
+            if inR:
+                if reviveTime(t, fingerprint, excluded, now):
+                    toUpdate.append(t)
+            elif not t.deleted:
+                toDelete.append(fingerprint)
+        elif inR:
+            time = TimeRange.fromEpoch(key[0] // 1000 if key[0] is not None else None, key[1] // 1000, key[2])
+            # horizon 之后的时间片在物化时创建
+            if horizonTs is not None and time.endTs > horizonTs:
+                continue
+            toCreate.append((time, excluded))
+    applyTimeChanges(schedule, toUpdate, toCreate, toDelete, now)
 
-    return schedule.to_dict()
+
+@transaction.atomic
+def materializeSchedule(id: str, until: datetime, settings=None):
+    """
+    将 schedule 的时间片物化到不早于 until 的新 horizon
+    """
+    # 锁住 schedule，避免并发补齐时重复创建时间片
+    schedule = Schedule.objects.select_for_update().get(id=id)
+    if schedule.deleted or schedule.materializedUntil is None:
+        return
+    since = schedule.materializedUntil
+    if since >= until:
+        return
+
+    stream = streamTimeCodes(schedule.user_id, schedule.rTimeCode, schedule.exTimeCode, settings,
+                             schedule.getExFingerprints())
+
+    # materializedUntil 是服务端内部状态，不增加 version
+    schedule.materializedUntil = materializeTimes(schedule, stream.times, getHorizon(until), since)
+    schedule.save(update_fields=['materializedUntil'])
+    updateScheduleSpan(schedule, settings)
+    bumpEventGeneration(schedule.user_id)
+
+
+def extendHorizon(userId: str, until: datetime):
+    """
+    查询范围超出 horizon 时，先补齐该用户的时间片
+    """
+    until = until.astimezone(tz.gettz('UTC'))
+    ids = list(Schedule.objects.filter(user_id=userId, deleted=False,
+                                       materializedUntil__isnull=False,
+                                       materializedUntil__lt=until)
+               .values_list('id', flat=True))
+    if len(ids) == 0:
+        return
+    settings = loadParserSettings(userId)
+    for id in ids:
+        materializeSchedule(id, until, settings)
+
+
+# 预览接口一次最多解析的时间码数量和每个时间码最多返回的时间片数量
+PREVIEW_MAX_ITEMS = 50
+PREVIEW_MAX_LIMIT = 100
+
+
+def previewTimeCodes(userId: str, items: list[dict], limit: int):
+    """
+    只解析时间码，不写数据库，每一项单独返回错误
+
+    每一项只按结束时间展开前 limit 个时间片，hasMore 表示之后还有时间片；展开结果不写入解析缓存，
+    输入中的时间码不会挤掉已有 schedule 的缓存
+    """
+    if len(items) > PREVIEW_MAX_ITEMS:
+        raise ValueError(f'too many time codes, at most {PREVIEW_MAX_ITEMS}')
+    limit = max(0, min(limit, PREVIEW_MAX_LIMIT))
+    # 所有时间码共用一份设置
+    settings = loadParserSettings(userId)
+    res = []
+    for item in items:
+        try:
+            stream = streamTimeCodes(userId, item['rTime'], item.get('exTime', ''), settings)
+            # 多展开一个判断是否还有时间片
+            times = list(islice(stream.times, limit + 1))
+        except Exception as e:
+            res.append({'success': False, 'error': str(e)})
+            continue
+        res.append({
+            'success': True,
+            'data': {
+                'type': stream.eventType,
+                'rTimeCode': stream.rTimeCodes,
+                'exTimeCode': stream.exTimeCodes,
+                'rTimes': [time.to_dict() for time, excluded in times[:limit] if not excluded],
+                'exTimes': [time.to_dict() for time, excluded in times[:limit] if excluded],
+                'hasMore': len(times) > limit,
+            }
+        })
+    return res
+
+
+# 时间码展开的 event 不超过一天，加上夏令时切换的一小时，SQLite 上用它把重叠查询改写为 start 上的有界范围
+EVENT_MAX_DURATION = timedelta(hours=25)
+
+
+def getMaxEventDuration(userId: str) -> timedelta:
+    """
+    用户的时间片中最长的时长，不短于 EVENT_MAX_DURATION，同步来的时间片可能超过解析器生成的最长时长
+    """
+    maxDuration = (Schedule.objects.filter(user_id=userId, deleted=False, liveCount__gt=0)
+                   .aggregate(maxDuration=Max('maxDuration'))['maxDuration'])
+    return max(EVENT_MAX_DURATION, maxDuration) if maxDuration is not None else EVENT_MAX_DURATION
+
+
+def filterOverlapping(times: QuerySet, userId: str, start: datetime, end: datetime) -> QuerySet:
+    """
+    与窗口重叠的时间片：start < 窗口结束且 end > 窗口开始，包括跨过窗口边界的时间片
+
+    PostgreSQL 上使用 tstzrange 的 && 走 GiST 索引，其他数据库按用户最长的时间片限制 start 的下界，走 (user, start) 索引
+    """
+    times = times.filter(start__lt=end, end__gt=start)
+    if connection.vendor == 'postgresql':
+        return times.filter(SpanOverlaps(start, end))
+    return times.filter(start__gt=start - getMaxEventDuration(userId))
 
 
 def findEventsBetween(userId: str, start: str, end: str):
-    times = (Time.objects.filter(
-        schedule__user_id=userId,
+    # 跨过窗口结束的时间片也要物化
+    until = fromISOString(end) + EVENT_MAX_DURATION
+    if eventIndexEnabled():
+        generation = getEventGeneration(userId)
+        index = eventIndexCache.get(userId, generation)
+        # 命中且已经物化到 until 时不需要查询 horizon
+        if index is None or index.materializedUntil < until.timestamp():
+            extendHorizon(userId, until)
+            # 补齐时间片会增加 generation；先读 generation 再加载时间片，加载期间提交的修改会使下一次查询重新加载
+            generation = getEventGeneration(userId)
+            index = loadEventIndex(userId, generation, until)
+            eventIndexCache.set(userId, index)
+        return index.between(fromISOString(start).timestamp(), fromISOString(end).timestamp())
+
+    extendHorizon(userId, until)
+    times = filterOverlapping(findEventTimes(userId), userId, fromISOString(start), fromISOString(end)).order_by('start')
+    return [toEventBrief(time) for time in times]
+
+
+def findEventTimes(userId: str) -> QuerySet:
+    """
+    用户所有未删除、未排除、未完成的 event 时间片
+    """
+    return (Time.objects.filter(
+        user_id=userId,
         excluded=False,
         start__isnull=False,
-        start__gte=isoformat(datetime.fromisoformat(start).astimezone(tz.gettz('UTC'))),
-        end__lte=isoformat(datetime.fromisoformat(end).astimezone(tz.gettz('UTC'))),
         done=False,
         deleted=False)
-             .order_by('start')
-             .values('id', 'schedule_id',
-                     'schedule__name', 'schedule__comment',
-                     'start', 'end',
-                     'startMark', 'endMark'))
-    res: list[EventBriefVO] = []
-    for time in times:
-        res.append(EventBriefVO(id=time['id'], scheduleId=time['schedule_id'],
-                                name=time['schedule__name'], comment=time['schedule__comment'],
-                                start=time['start'], end=time['end'],
-                                startMark=time['startMark'], endMark=time['endMark']).to_dict())
-    return res
+            .values('id', 'schedule_id',
+                    'scheduleName', 'scheduleComment',
+                    'start', 'end',
+                    'startMark', 'endMark'))
+
+
+def toEventBrief(time: dict) -> dict:
+    return EventBriefVO(id=time['id'], scheduleId=time['schedule_id'],
+                        name=time['scheduleName'], comment=time['scheduleComment'],
+                        start=toUTCISOString(time['start']), end=toUTCISOString(time['end']),
+                        startMark=time['startMark'], endMark=time['endMark']).to_dict()
+
+
+def loadEventIndex(userId: str, generation: int, materializedUntil: datetime) -> EventIndex:
+    return EventIndex(generation, [(time['start'].timestamp(), time['end'].timestamp(), toEventBrief(time))
+                                   for time in findEventTimes(userId).iterator()], materializedUntil.timestamp())
+
+
+# 待办列表用到的设置
+TODO_SETTING_PATHS = ['preferences.startTime.hour', 'preferences.startTime.minute']
+
+
+def findNextTodoTimes(times: QuerySet) -> QuerySet:
+    """
+    每个 schedule 结束时间最早的一个时间片，PostgreSQL 上使用 DISTINCT ON，其他数据库使用窗口函数 ROW_NUMBER
+
+    结果按 schedule_id 排序
+    """
+    if connection.features.can_distinct_on_fields:
+        return times.order_by('schedule_id', 'end').distinct('schedule_id')
+    return (times.annotate(rank=Window(RowNumber(), partition_by=F('schedule_id'), order_by=F('end').asc()))
+            .filter(rank=1)
+            .order_by('schedule_id'))
+
+
+def extendNextTodos(userId: str, scheduleIds: set[str]) -> bool:
+    """
+    没有出现在 scheduleIds 中、materializedUntil 之后还有时间片的 _todo，物化到下一个没有排除的时间片
+
+    lastAt 不晚于 materializedUntil 的 _todo 已经没有之后的时间片，不需要展开；
+    物化后下一个时间片出现在查询结果中，之后的查询不会再展开同一个 _todo
+
+    :return: 是否有 _todo 被物化
+    """
+    schedules = list(Schedule.objects.filter(user_id=userId, type=EventType.TODO, deleted=False,
+                                             materializedUntil__isnull=False, lastAt__gt=F('materializedUntil'))
+                     .exclude(id__in=scheduleIds))
+    if len(schedules) == 0:
+        return False
+    settings = loadParserSettings(userId)
+    for schedule in schedules:
+        stream = streamTimeCodes(userId, schedule.rTimeCode, schedule.exTimeCode, settings,
+                                 schedule.getExFingerprints())
+        sinceTs = schedule.materializedUntil.timestamp()
+        lastTime = None
+        for time, excluded in stream.times:
+            if time.endTs <= sinceTs:
+                continue
+            lastTime = time
+            if not excluded:
+                break
+        # 之后的时间片都被排除时物化到最后一个，materializedUntil 变为 None
+        if lastTime is not None:
+            materializeSchedule(schedule.id, epochSecondsToDatetime(lastTime.endTs), settings)
+    return True
 
 
 def findAllTodos(userId: str):
-    firstTodos: list[TodoBriefVO] = []
-    todayTodos: list[TodoBriefVO] = []
-    todos = Schedule.objects.filter(user_id=userId, type=EventType.TODO, deleted=False).values('id', 'name')
-    for todo in todos:
-        time = (Time.objects.filter(
-            schedule__id=todo['id'],
-            excluded=False,
-            # 每天的 start time 作为逻辑上的次日开始时间，未达次日 start time 就过期的 _todo 显示 expired，而不是直接消失
-            end__gte=isoformat((datetime.now()
-                                + relativedelta(
-                        hour=getSettingByPath(userId, 'preferences.startTime.hour'),
-                        minute=getSettingByPath(userId, 'preferences.startTime.minute')))
-                               .astimezone(tz.gettz('UTC'))),
-            deleted=False)
-                .order_by('end')
-                .values('id', 'end', 'done')).first()
-        if time is not None:
-            firstTodos.append(TodoBriefVO(id=time['id'], scheduleId=todo['id'],
-                                          name=todo['name'], end=time['end'], done=time['done']))
-
-    times = (Time.objects.filter(
-        schedule__user_id=userId,
+    extendHorizon(userId, datetime.now().astimezone(tz.gettz('UTC')) + relativedelta(days=2))
+    settings = getSettingsSnapshot(userId, TODO_SETTING_PATHS)
+    # 每天的 start time 作为逻辑上的次日开始时间，未达次日 start time 就过期的 _todo 显示 expired，而不是直接消失
+    dayStart = datetime.now() + relativedelta(hour=settings['preferences.startTime.hour'],
+                                              minute=settings['preferences.startTime.minute'])
+    dayEnd = dayStart + relativedelta(days=1)
+
+    times = Time.objects.filter(
+        user_id=userId,
         schedule__type=EventType.TODO,
         schedule__deleted=False,
         excluded=False,
-        # 每天的 start time 作为逻辑上的次日开始时间，未达次日 start time 就过期的 _todo 显示 expired，而不是直接消失
-        end__gte=isoformat((datetime.now()
-                            + relativedelta(
-                    hour=getSettingByPath(userId, 'preferences.startTime.hour'),
-                    minute=getSettingByPath(userId, 'preferences.startTime.minute')))
-                           .astimezone(tz.gettz('UTC'))),
-        end__lte=isoformat((datetime.now()
-                            + relativedelta(days=1)
-                            + relativedelta(
-                    hour=getSettingByPath(userId, 'preferences.startTime.hour'),
-                    minute=getSettingByPath(userId, 'preferences.startTime.minute')))
-                           .astimezone(tz.gettz('UTC'))),
+        end__gte=dayStart.astimezone(tz.gettz('UTC')),
         deleted=False)
-             .order_by('end')
-             .values('id', 'schedule_id', 'end', 'done'))
-
-    for time in times:
-        todo = Schedule.objects.values('id', 'name').get(id=time['schedule_id'], user_id=userId)  # 上面已经保证 deleted 为 false
-        todayTodos.append(
-            TodoBriefVO(id=time['id'], scheduleId=time['schedule_id'],
-                        name=todo['name'], end=time['end'], done=time['done']))
-
-    res = union(firstTodos, todayTodos, lambda a, b: a.id == b.id)
+    fields = ['id', 'schedule_id', 'scheduleName', 'end', 'done']
+
+    # 每个 _todo 下一个要完成的时间片和今天的时间片，各一条 SQL，数量与 _todo 的个数无关
+    nextTimes = list(findNextTodoTimes(times).values(*fields))
+    # 下一个时间片在 materializedUntil 之后的 _todo 先物化到下一个时间片
+    if extendNextTodos(userId, {time['schedule_id'] for time in nextTimes}):
+        nextTimes = list(findNextTodoTimes(times).values(*fields))
+    firstTodos: list[TodoBriefVO] = [
+        TodoBriefVO(id=time['id'], scheduleId=time['schedule_id'], name=time['scheduleName'],
+                    end=toUTCISOString(time['end']), done=time['done'])
+        for time in sorted(nextTimes, key=lambda time: time['end'])]
+    todayTodos: list[TodoBriefVO] = [
+        TodoBriefVO(id=time['id'], scheduleId=time['schedule_id'], name=time['scheduleName'],
+                    end=toUTCISOString(time['end']), done=time['done'])
+        for time in (times.filter(end__lte=dayEnd.astimezone(tz.gettz('UTC')))
+                     .order_by('end')
+                     .values(*fields))]
+
+    res = keyedUnion(firstTodos, todayTodos, lambda todo: todo.id)
     res = list(map(lambda todo: todo.to_dict(), res))
 
     return res
 
 
+def ownedBy(userId: str) -> Q:
+    """
+    按 id 查询用户的时间片、记录时的条件，user_id 还没有回填的旧数据按 schedule 的 user_id 判断
+
+    使用子查询而不是 join，可以与 select_for_update 一起使用（update_or_create）；
+    user_id 由 0005 迁移回填，范围查询只按 user_id 过滤，以使用 user_id 上的部分索引
+    """
+    return Q(user_id=userId) | Q(user_id__isnull=True, schedule__in=Schedule.objects.filter(user_id=userId))
+
+
 def findScheduleById(id: str, userId: str):
     schedule = Schedule.objects.get(id=id, user_id=userId)
     return schedule.to_dict()
 
 
 def findTimesByScheduleId(scheduleId: str, userId: str):
-    times = Time.objects.filter(schedule_id=scheduleId, schedule__user_id=userId, excluded=False, deleted=False)
+    """
+    schedule 未删除、未排除的时间片，先物化到当前的 horizon
+
+    还没有物化完的 schedule 只返回到 materializedUntil 为止的时间片，之后的时间片由 findEventsBetween 按窗口补齐
+    """
+    horizon = getHorizon()
+    if horizon is not None and Schedule.objects.filter(id=scheduleId, user_id=userId,
+                                                       materializedUntil__lt=horizon).exists():
+        materializeSchedule(scheduleId, horizon)
+    times = Time.objects.filter(ownedBy(userId), schedule_id=scheduleId, excluded=False, deleted=False)
     times = list(map(lambda time: time.to_dict(), times))
     return times
 
 
 def findRecordsByScheduleId(scheduleId: str, userId: str):
-    records = Record.objects.filter(schedule_id=scheduleId, schedule__user_id=userId, deleted=False)
+    records = Record.objects.filter(ownedBy(userId), schedule_id=scheduleId, deleted=False)
     records = list(map(lambda record: record.to_dict(), records))
     return records
 
@@ -234,56 +778,105 @@ def deleteScheduleById(id: str, userId: str):
     schedule = Schedule.objects.get(id=id, user_id=userId)
     schedule.deleted = True
     schedule.version += 1
-    schedule.updated = isoformat(datetime.now().astimezone(tz.gettz('UTC')))
+    schedule.updated = utcNow()
     schedule.save()
     Time.objects.filter(schedule__id=id).update(deleted=True, version=F('version') + 1,
-                                                updated=isoformat(datetime.now().astimezone(tz.gettz('UTC'))))
+                                                updated=utcNow())
     Record.objects.filter(schedule__id=id).update(deleted=True, version=F('version') + 1,
-                                                  updated=isoformat(datetime.now().astimezone(tz.gettz('UTC'))))
+                                                  updated=utcNow())
+    updateScheduleSpan(schedule)
+    bumpEventGeneration(userId)
     return schedule.to_dict()
 
 
-@transaction.atomic
 def deleteTimeById(userId: str, id: str):
-    time = Time.objects.get(schedule__user_id=userId, id=id)
-    time.excluded = True
-    time.updated = isoformat(datetime.now().astimezone(tz.gettz('UTC')))
-    time.save()
+    return deleteTimeByIds(userId, [id])[0]
 
-    startTime: datetime
-    endTime = datetime.fromisoformat(time.end).astimezone(tz.gettz('UTC'))
-    endHour = endTime.hour if time.endMark[0] == '1' else '?'
-    endMinute = endTime.minute if time.endMark[1] == '1' else '?'
-    exTimeCode: str
-    if time.start is not None:
-        startTime = datetime.fromisoformat(time.start).astimezone(tz.gettz('UTC'))
-        startHour = startTime.hour if time.startMark[0] == '1' else '?'
-        startMinute = startTime.minute if time.startMark[1] == '1' else '?'
-        exTimeCode = f'{startTime.strftime("%Y/%m/%d")} {startHour}:{startMinute}-{endHour}:{endMinute} UTC'
-    else:
-        exTimeCode = f'{endTime.strftime("%Y/%m/%d")} {endHour}:{endMinute} UTC'
 
-    schedule = Schedule.objects.get(id=time.schedule.id, user_id=userId)
+@transaction.atomic
+def deleteTimeByIds(userId: str, ids: list[str]):
+    """
+    排除多个时间片：一次查询所有时间片，一条 UPDATE 排除，每个 schedule 追加一次排除的 fingerprint
+
+    排除记录在 Schedule.exFingerprints 中，不修改 exTimeCode，重新同步时间片时不需要解析；任意一个时间片不存在时全部回滚
+    """
+    times = {time.id: time for time in Time.objects.filter(ownedBy(userId), id__in=ids)}
+    if any(id not in times for id in ids):
+        raise Time.DoesNotExist('Time matching query does not exist.')
+
+    now = utcNow()
+    toExclude: dict[str, list[Time]] = {}
+    for id in dict.fromkeys(ids):
+        time = times[id]
+        if time.excluded:
+            continue
+        time.excluded = True
+        time.version += 1
+        time.updated = now
+        toExclude.setdefault(time.schedule_id, []).append(time)
+    # excluded 参与同步，增加 version，客户端旧的时间片不会覆盖排除
+    (Time.objects.filter(id__in=[time.id for group in toExclude.values() for time in group])
+     .update(excluded=True, version=F('version') + 1, updated=now))
 
-    schedule.exTimeCode = exTimeCode if schedule.exTimeCode == '' else f'{schedule.exTimeCode};{exTimeCode}'
+    schedules = list(Schedule.objects.filter(user_id=userId, id__in=list(toExclude)))
+    for schedule in schedules:
+        schedule.addExFingerprints(time.fingerprint if time.fingerprint is not None else time.computeFingerprint()
+                                   for time in toExclude[schedule.id])
+        schedule.version += 1
+        schedule.updated = now
+    # exFingerprints 参与同步，增加 version，客户端按时间码重新生成时间片时不会恢复删除的时间片
+    Schedule.objects.bulk_update(schedules, ['exFingerprints', 'version', 'updated'])
+    for schedule in schedules:
+        updateScheduleSpan(schedule)
+    if len(schedules) > 0:
+        bumpEventGeneration(userId)
+
+    return [times[id].to_dict() for id in ids]
+
+
+# 旧版本 deleteTimeById 追加到 exTimeCode 的行，如 2024/01/05 9:0-10:0 UTC、2024/01/05 ?:?-10:0 UTC
+LEGACY_EX_TIME_CODE = re.compile(r'^\d{4}/\d{2}/\d{2} (?:[\d?]+:[\d?]+-)?[\d?]+:[\d?]+ UTC$')
+
+
+def migrateExTimeCode(schedule: Schedule, settings=None) -> int:
+    """
+    将 exTimeCode 中旧版本删除单个时间片追加的行移到 exFingerprints，时间片已经是 excluded，不需要重新同步
+
+    :return: 移走的行数
+    """
+    if settings is None:
+        settings = loadParserSettings(schedule.user_id)
+    kept: list[str] = []
+    fingerprints: list[str] = []
+    for line in splitTimeCodeLines(schedule.exTimeCode):
+        times: list[TimeRange] = []
+        if LEGACY_EX_TIME_CODE.match(line):
+            try:
+                times = timeCodeParser(settings, line).times
+            except Exception:
+                times = []
+        if len(times) == 1:
+            fingerprints.append(times[0].fingerprint())
+        else:
+            kept.append(line)
+    if len(fingerprints) == 0:
+        return 0
+    schedule.exTimeCode = ';'.join(kept)
+    schedule.addExFingerprints(fingerprints)
+    # exTimeCode 变短了，增加 version 同步给客户端
     schedule.version += 1
-    schedule.updated = isoformat(datetime.now().astimezone(tz.gettz('UTC')))
-    schedule.save()
-
-    return time.to_dict()
-
-
-def deleteTimeByIds(userId: str, ids: list[str]):
-    for id in ids:
-        deleteTimeById(userId, id)
+    schedule.updated = utcNow()
+    schedule.save(update_fields=['exTimeCode', 'exFingerprints', 'version', 'updated'])
+    return len(fingerprints)
 
 
 def updateTimeCommentById(userId: str, id: str, comment: str):
-    time = Time.objects.get(schedule__user_id=userId, id=id)
+    time = Time.objects.get(ownedBy(userId), id=id)
     time.comment = comment
     time.version += 1
-    time.updated = isoformat(datetime.now().astimezone(tz.gettz('UTC')))
+    time.updated = utcNow()
     time.save()
+    updateSearchDocument(time.schedule)
     return time.to_dict()
 
 
@@ -303,55 +896,119 @@ class FindAllSchedulesConditions:
             self.star = conditions['star']
 
 
-def findAllSchedules(userId: str, conditions: FindAllSchedulesConditions, page: int, pageSize: int):
+def filterSchedules(userId: str, conditions: FindAllSchedulesConditions) -> QuerySet:
+    """
+    按条件过滤用户的 schedule，有搜索词时带有 rank 注解，越大越相关
+    """
     schedules = Schedule.objects.filter(user_id=userId)
-    schedules = (schedules.filter(name__icontains=conditions.search)
-                 | schedules.filter(comment__icontains=conditions.search)
-                 | schedules.filter(times__comment__icontains=conditions.search))
+    # 搜索 name、comment 和时间片 comment 组成的搜索文档，文档已经是小写，搜索词也转为小写后区分大小写匹配，
+    # PostgreSQL 上 LIKE '%...%' 可以使用 gin_trgm_ops 索引，icontains 生成的 UPPER(...) LIKE 不能
+    if conditions.search != '':
+        search = conditions.search.lower()
+        schedules = schedules.filter(searchDocument__contains=search)
+        if connection.vendor == 'postgresql':
+            # pg_trgm 由迁移 0007 安装，搜索文档上有 trigram GIN 索引
+            from django.contrib.postgres.search import TrigramSimilarity
+
+            schedules = schedules.annotate(rank=TrigramSimilarity('searchDocument', search))
+        else:
+            # 搜索词是文档的子串，trigram 相似度近似为搜索词与文档长度之比，同样在数据库中按文档长度排序
+            schedules = schedules.annotate(rank=-Length('searchDocument'))
     if conditions.dateRange is not None:
-        schedules = (schedules.filter(times__start__isnull=True,
-                                      times__end__gte=isoformat(datetime.fromtimestamp(
-                                          conditions.dateRange[0] / 1000).astimezone(tz.gettz('UTC'))),
-                                      times__end__lte=isoformat(datetime.combine(
-                                          datetime.fromtimestamp(conditions.dateRange[1] / 1000), datetime.max.time())
-                                                                .astimezone(tz.gettz('UTC'))))
-                     | schedules.filter(times__start__isnull=False,
-                                        times__start__gte=isoformat(datetime.fromtimestamp(
-                                            conditions.dateRange[0] / 1000).astimezone(tz.gettz('UTC'))),
-                                        times__end__lte=isoformat(datetime.combine(
-                                            datetime.fromtimestamp(conditions.dateRange[1] / 1000), datetime.max.time())
-                                                                  .astimezone(tz.gettz('UTC')))))
-        schedules = schedules.filter(times__deleted=False)
-    schedules = schedules.distinct()
+        rangeStart = datetime.fromtimestamp(conditions.dateRange[0] / 1000).astimezone(tz.gettz('UTC'))
+        rangeEnd = datetime.combine(datetime.fromtimestamp(conditions.dateRange[1] / 1000),
+                                    datetime.max.time()).astimezone(tz.gettz('UTC'))
+        # 由 schedule 上的 firstAt / lastAt 判断，不需要查询时间片；没有物化完的 schedule 在 horizon 之后还有时间片
+        schedules = schedules.filter(Q(liveCount__gt=0) | Q(materializedUntil__isnull=False),
+                                     lastAt__gte=rangeStart, firstAt__lte=rangeEnd)
     if conditions.type is not None:
         schedules = schedules.filter(type=conditions.type)
     if conditions.star is not None:
         schedules = schedules.filter(star=conditions.star)
-    schedules = schedules.order_by('created').values('id', 'type', 'name', 'star', 'deleted', 'created', 'updated')
+    return schedules
 
-    count = schedules.count()
 
+SCHEDULE_BRIEF_FIELDS = ['id', 'type', 'name', 'star', 'deleted', 'created', 'updated']
+
+
+def toScheduleBrief(schedule: dict) -> dict:
+    return ScheduleBriefVO(id=schedule['id'], type=schedule['type'], name=schedule['name'],
+                           star=schedule['star'], deleted=schedule['deleted'],
+                           created=isoformat(schedule['created']),
+                           updated=isoformat(schedule['updated'])).to_dict()
+
+
+def findAllSchedules(userId: str, conditions: FindAllSchedulesConditions, page: int, pageSize: int):
+    schedules = filterSchedules(userId, conditions)
+    if 'rank' in schedules.query.annotations:
+        schedules = schedules.order_by('-rank', 'created').values(*SCHEDULE_BRIEF_FIELDS)
+    else:
+        schedules = schedules.order_by('created').values(*SCHEDULE_BRIEF_FIELDS)
+
+    # Paginator 只 count 一次
     paginator = Paginator(schedules, pageSize)
     schedules = paginator.get_page(page)
 
-    res: list[ScheduleBriefVO] = []
-    for schedule in schedules:
-        res.append(ScheduleBriefVO(id=schedule['id'], type=schedule['type'], name=schedule['name'],
-                                   star=schedule['star'], deleted=schedule['deleted'], created=schedule['created'],
-                                   updated=schedule['updated']).to_dict())
-
     return {
-        'data': res,
-        'total': count
+        'data': [toScheduleBrief(schedule) for schedule in schedules],
+        'total': paginator.count
     }
 
 
+# cursor 模式下缓存 total 的秒数
+SCHEDULE_COUNT_TIMEOUT = 60
+
+
+def encodeCursor(schedule: dict) -> str:
+    return urlsafe_b64encode(json.dumps([toUTCISOString(schedule['created']), schedule['id']]).encode()).decode()
+
+
+def decodeCursor(cursor: str) -> tuple[datetime, str]:
+    try:
+        created, id = json.loads(urlsafe_b64decode(cursor.encode()))
+        if not isinstance(id, str):
+            raise TypeError(id)
+        return fromISOString(created), id
+    except (ValueError, TypeError, AttributeError, KeyError):
+        raise ValueError('invalid cursor')
+
+
+def countSchedules(userId: str, conditions: FindAllSchedulesConditions, schedules: QuerySet) -> int:
+    """
+    满足条件的 schedule 数量，按用户和条件缓存 SCHEDULE_COUNT_TIMEOUT 秒，翻页时不重复计算
+    """
+    key = f'scheduleCount:{userId}:{sha1(json.dumps(vars(conditions), sort_keys=True).encode()).hexdigest()}'
+    return cache.get_or_set(key, schedules.count, SCHEDULE_COUNT_TIMEOUT)
+
+
+def findSchedulesAfter(userId: str, conditions: FindAllSchedulesConditions, after: str | None, pageSize: int,
+                       withTotal: bool = False):
+    """
+    按 (created, id) 排序的 keyset 分页，after 为上一页返回的 nextCursor，第一页为 None
+
+    有搜索词时同样按 (created, id) 排序，不按相关度排序；只有 withTotal 时才计算 total
+    """
+    schedules = filterSchedules(userId, conditions)
+    res = {}
+    if withTotal:
+        res['total'] = countSchedules(userId, conditions, schedules)
+    if after:
+        created, id = decodeCursor(after)
+        schedules = schedules.filter(Q(created__gt=created) | Q(created=created, id__gt=id))
+    # 多取一条判断是否还有下一页
+    rows = list(schedules.order_by('created', 'id').values(*SCHEDULE_BRIEF_FIELDS)[:pageSize + 1])
+    res['data'] = [toScheduleBrief(schedule) for schedule in rows[:pageSize]]
+    res['nextCursor'] = encodeCursor(rows[pageSize - 1]) if len(rows) > pageSize else None
+    return res
+
+
 def updateDoneById(userId: str, id: str, done: bool):
-    time = Time.objects.get(schedule__user_id=userId, id=id)
+    time = Time.objects.get(ownedBy(userId), id=id)
     time.done = done
     time.version += 1
-    time.updated = isoformat(datetime.now().astimezone(tz.gettz('UTC')))
+    time.updated = utcNow()
     time.save()
+    bumpEventGeneration(userId)
     return time.to_dict()
 
 
@@ -359,20 +1016,32 @@ def updateStarById(userId: str, id: str, star: bool):
     schedule = Schedule.objects.get(user_id=userId, id=id)
     schedule.star = star
     schedule.version += 1
-    schedule.updated = isoformat(datetime.now().astimezone(tz.gettz('UTC')))
+    schedule.updated = utcNow()
     schedule.save()
     return schedule.to_dict()
 
 
 def createRecord(scheduleId: str, userId: str, startTime: str, endTime: str):
-    record = Record(id=uuid.uuid4().hex, schedule_id=scheduleId,
-                    start=startTime, end=endTime,
-                    created=isoformat(datetime.now().astimezone(tz.gettz('UTC'))),
-                    updated=isoformat(datetime.now().astimezone(tz.gettz('UTC'))))
+    record = Record(id=uuid.uuid4().hex, schedule_id=scheduleId, user_id=userId,
+                    start=fromISOString(startTime), end=fromISOString(endTime),
+                    created=utcNow(),
+                    updated=utcNow())
     record.save()
     return record.to_dict()
 
 
+def syncFingerprint(t: Time):
+    """
+    客户端修改的时间片重新计算 fingerprint，与已有时间片重复时不设置
+    """
+    fingerprint = t.computeFingerprint()
+    if Time.objects.filter(schedule_id=t.schedule_id, fingerprint=fingerprint).exclude(id=t.id).exists():
+        fingerprint = None
+    if t.fingerprint != fingerprint:
+        t.fingerprint = fingerprint
+        t.save(update_fields=['fingerprint'])
+
+
 @transaction.atomic
 def sync(userId: str, schedules: list[dict], times: list[dict], records: list[dict], syncAt: str):
     print(schedules, times, records, syncAt)
@@ -390,7 +1059,7 @@ def sync(userId: str, schedules: list[dict], times: list[dict], records: list[di
             return True
         if server.version <= client['version']:
             return True
-        if server.updated <= client['updated']:
+        if server.updated <= fromISOString(client['updated']):
             return True
         return False
 
@@ -400,34 +1069,54 @@ def sync(userId: str, schedules: list[dict], times: list[dict], records: list[di
             schedule['user_id'] = userId
             schedule['syncAt'] = syncAt
             schedule['version'] += 1
-            Schedule.objects.update_or_create(id=schedule['id'], user_id=userId, defaults=schedule)
+            saved, _ = Schedule.objects.update_or_create(id=schedule['id'], user_id=userId, defaults=schedule)
+            updateTimeScheduleFields(saved)
             updated['schedules'].append(schedule['id'])
 
+    @lru_cache(maxsize=None)
+    def scheduleFields(scheduleId: str) -> tuple[str, str]:
+        schedule = Schedule.objects.filter(id=scheduleId).values('name', 'comment').first()
+        return (schedule['name'], schedule['comment']) if schedule is not None else ('', '')
+
     for time in times:
-        timeServer = Time.objects.filter(schedule__user_id=userId, id=time['id']).first()
+        timeServer = Time.objects.filter(ownedBy(userId), id=time['id']).first()
         if update(timeServer, time):
             time['schedule_id'] = time.pop('scheduleId')
             time['syncAt'] = syncAt
             time['version'] += 1
-            Time.objects.update_or_create(schedule__user_id=userId, id=time['id'], defaults=time)
+            time.pop('fingerprint', None)
+            # 冗余字段由服务端维护
+            time['user_id'] = userId
+            time['scheduleName'], time['scheduleComment'] = scheduleFields(time['schedule_id'])
+            t, _ = Time.objects.filter(ownedBy(userId)).update_or_create(id=time['id'], defaults=time)
+            syncFingerprint(t)
             updated['times'].append(time['id'])
 
     for record in records:
-        recordServer = Record.objects.filter(schedule__user_id=userId, id=record['id']).first()
+        recordServer = Record.objects.filter(ownedBy(userId), id=record['id']).first()
         if update(recordServer, record):
             record['schedule_id'] = record.pop('scheduleId')
             record['syncAt'] = syncAt
             record['version'] += 1
-            Record.objects.update_or_create(schedule__user_id=userId, id=record['id'], defaults=record)
+            record['user_id'] = userId
+            Record.objects.filter(ownedBy(userId)).update_or_create(id=record['id'], defaults=record)
             updated['records'].append(record['id'])
 
+    if len(updated['schedules']) > 0 or len(updated['times']) > 0:
+        bumpEventGeneration(userId)
+    updatedTimes = set(updated['times'])
+    scheduleIds = set(updated['schedules']) | {time['schedule_id'] for time in times if time['id'] in updatedTimes}
+    for schedule in Schedule.objects.filter(user_id=userId, id__in=scheduleIds):
+        updateSearchDocument(schedule)
+        updateScheduleSpan(schedule)
     return updated
 
 
 def getUnSynced(userId: str, lastSyncAt: str):
+    lastSyncAt = fromISOString(lastSyncAt)
     schedules = Schedule.objects.filter(user_id=userId, updated__gt=lastSyncAt)
-    times = Time.objects.filter(schedule__user_id=userId, updated__gt=lastSyncAt)
-    records = Record.objects.filter(schedule__user_id=userId, updated__gt=lastSyncAt)
+    times = Time.objects.filter(user_id=userId, updated__gt=lastSyncAt)
+    records = Record.objects.filter(user_id=userId, updated__gt=lastSyncAt)
 
     return {
         'schedules': list(map(lambda schedule: schedule.to_dict(), schedules)),
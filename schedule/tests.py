@@ -1,34 +1,77 @@
+import json
+import os
+import tempfile
+from base64 import urlsafe_b64encode
 from datetime import datetime
+from time import tzset
+from unittest import mock
 
 from dateutil.rrule import rrule, DAILY, MONTHLY, YEARLY, WEEKLY, MO, TU, WE, TH, FR, SA, SU, weekday
 from dateutil.tz import tz
 from dateutil.relativedelta import relativedelta
-from django.test import TestCase
-from schedule.timeCodeParser import parseDateRange, parseTimeRange, parseFreq, parseBy, parseTimeCodes
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from schedule import service, timeCodeParser
+from schedule.timeCodeParser import (parseDateRange, parseTimeRange, parseFreq, parseBy, parseTimeCodes, timeCodeCache,
+                                     diffTimeCodeLines, streamTimeCodes, parseTimeCodeLex)
+from schedule.eventIndexCache import EventIndex, EventIndexCache
+from schedule.timeCodeCache import TimeCodeCache
+from schedule.denormalizedFields import backfillDenormalizedFields
+from schedule.models import Schedule, Time, Record
+from schedule.searchDocument import toSearchDocument
+from user.models import ScheduleUser
+from utils import timeZone
+from utils.utils import intersection, difference, union, keyedIntersection, keyedDifference, keyedUnion
+from utils.timeZone import (isoformat, fromISOString, toUTCISOString, toEpochMillis, epochSecondsToDatetime,
+                            resolveTimeZone, toEpochSeconds)
 from schedule.timeCodeParserTypes import (EventType, DateRangeObject, TimeRangeObject, TimeUnit, TimeRange,
                                               FreqObject, ByObject,
-                                              TimeCodeLex, TimeCodeSem, TimeCodeParseResult, TimeCodeDao, DateUnit)
-from schedule.userSettings import getSettingByPath
+                                              TimeCodeLex, TimeCodeSem, TimeCodeParseResult, TimeCodeDao, DateUnit,
+                                              ParserSettings, TimeCodeSyntaxError)
+
+# 测试不依赖 redis，直接使用设置快照
+userId = 'test'
+settings = ParserSettings(timeZone='Asia/Shanghai', wkst='MO')
+# tdy / tmr 和省略年份的日期依赖于当天日期，固定为 2023/8/15
+fixedSettings = ParserSettings(timeZone='Asia/Shanghai', wkst='MO',
+                               now=datetime(2023, 8, 15, 12, tzinfo=tz.gettz('Asia/Shanghai')))
 
 
 # Create your tests here.
 class ParseDateTest(TestCase):
     def test_parseDate(self):
-        self.assertEqual(parseDateRange('2021/10/1'), DateRangeObject(dtstart=DateUnit(2021, 10, 1)))
+        self.assertEqual(parseDateRange(settings, '2021/10/1'), DateRangeObject(dtstart=DateUnit(2021, 10, 1)))
 
     def test_parseDateRange(self):
-        self.assertEqual(parseDateRange('2021/10/1-2021/10/2'),
+        self.assertEqual(parseDateRange(settings, '2021/10/1-2021/10/2'),
                          DateRangeObject(dtstart=DateUnit(2021, 10, 1), until=DateUnit(2021, 10, 2)))
 
     def test_parseDateSugar(self):
-        self.assertEqual(parseDateRange('2021/10/1-11/1'),
+        self.assertEqual(parseDateRange(settings, '2021/10/1-11/1'),
                          DateRangeObject(dtstart=DateUnit(2021, 10, 1), until=DateUnit(2021, 11, 1)))
-        year = datetime.now().year
-        if datetime.now().month >= 10 and datetime.now().day >= 1:
-            year += 1
-        self.assertEqual(parseDateRange('10/1-25'),
-                         DateRangeObject(dtstart=DateUnit(year, 10, 1), until=DateUnit(year, 10, 25)))
-        self.assertEqual(parseDateRange('10/1'), DateRangeObject(dtstart=DateUnit(year, 10, 1)))
+        self.assertEqual(parseDateRange(fixedSettings, '10/1-25'),
+                         DateRangeObject(dtstart=DateUnit(2023, 10, 1), until=DateUnit(2023, 10, 25)))
+        self.assertEqual(parseDateRange(fixedSettings, '10/1'), DateRangeObject(dtstart=DateUnit(2023, 10, 1)))
+        # 早于今天的日期为下一年
+        self.assertEqual(parseDateRange(fixedSettings, '8/1'), DateRangeObject(dtstart=DateUnit(2024, 8, 1)))
+        self.assertEqual(parseDateRange(fixedSettings, '8/15'), DateRangeObject(dtstart=DateUnit(2023, 8, 15)))
+
+    def test_yearRollover(self):
+        # 只有早于今天的日期才是下一年，今天仍是今年；按月、日整体比较，不是分别比较月和日
+        for code, year in [('8/14', 2024), ('8/15', 2023), ('8/16', 2023),
+                           ('7/20', 2024), ('9/1', 2023), ('1/1', 2024), ('12/31', 2023)]:
+            self.assertEqual(parseDateRange(fixedSettings, code).dtstart, DateUnit(year, *map(int, code.split('/'))))
+        # 今天按用户时区计算，上海 8/15 0:30 时 UTC 仍是 8/14
+        earlySettings = ParserSettings(timeZone='Asia/Shanghai', wkst='MO',
+                                       now=datetime(2023, 8, 14, 16, 30, tzinfo=tz.gettz('UTC')))
+        self.assertEqual(parseDateRange(earlySettings, '8/14').dtstart, DateUnit(2024, 8, 14))
+        self.assertEqual(parseDateRange(earlySettings, '8/15').dtstart, DateUnit(2023, 8, 15))
+        # 年末：12/31 当天 1/1 为下一年
+        lastDaySettings = ParserSettings(timeZone='Asia/Shanghai', wkst='MO',
+                                         now=datetime(2023, 12, 31, 12, tzinfo=tz.gettz('Asia/Shanghai')))
+        self.assertEqual(parseDateRange(lastDaySettings, '12/31').dtstart, DateUnit(2023, 12, 31))
+        self.assertEqual(parseDateRange(lastDaySettings, '1/1-1/2').until, DateUnit(2024, 1, 2))
 
 
 class ParseTimeTest(TestCase):
@@ -89,82 +132,84 @@ class ParseFreqTest(TestCase):
 
 class ParseByTest(TestCase):
     def test_parseBy(self):
-        self.assertEqual(parseBy('by[day[1,2,3]]'), ByObject(byweekday=[MO, TU, WE]))
+        self.assertEqual(parseBy(settings, 'by[day[1,2,3]]'), ByObject(byweekday=[MO, TU, WE]))
 
     def test_parseByDayMonth(self):
-        self.assertEqual(parseBy('by[day[1,2,3],month[1,2,3]]'), ByObject(byweekday=[MO, TU, WE], bymonth=[1, 2, 3]))
+        self.assertEqual(parseBy(settings, 'by[day[1,2,3],month[1,2,3]]'), ByObject(byweekday=[MO, TU, WE], bymonth=[1, 2, 3]))
+
+    def test_parseByMonthDayYearDay(self):
+        self.assertEqual(parseBy(settings, 'by[monthday[15],yearday[-1]]'), ByObject(bymonthday=[15], byyearday=[-1]))
+
+    def test_parseByInvalid(self):
+        self.assertRaises(TimeCodeSyntaxError, parseBy, settings, 'by[foo[1]]')
+        self.assertRaises(TimeCodeSyntaxError, parseBy, settings, 'by[day[1,2]')
+        self.assertRaises(TimeCodeSyntaxError, parseBy, settings, 'by[day[]]')
 
 
 class ParseTimeCodeTest(TestCase):
     def test_parseTimeCode(self):
-        times = parseTimeCodes('2023/7/10 22:00 America/Los_Angeles;', '').rTimes
+        times = parseTimeCodes(userId, '2023/7/10 22:00 America/Los_Angeles;', '', settings).rTimes
         self.assertEqual(len(times), 1)
         for time in times:
             tEnd = datetime.fromisoformat(time.end).astimezone(tz.gettz('America/Los_Angeles'))
             self.assertEqual(tEnd.strftime('%Y/%m/%d %H:%M'), '2023/07/10 22:00')
 
     def test_parseTimeCodeSpaces(self):
-        times = parseTimeCodes('2023/7/10    22:00    America/Los_Angeles;  ', '').rTimes
+        times = parseTimeCodes(userId, '2023/7/10    22:00    America/Los_Angeles;  ', '', settings).rTimes
         self.assertEqual(len(times), 1)
         for time in times:
             tEnd = datetime.fromisoformat(time.end).astimezone(tz.gettz('America/Los_Angeles'))
             self.assertEqual(tEnd.strftime('%Y/%m/%d %H:%M'), '2023/07/10 22:00')
 
     def test_parseTimeCodeAbbr(self):
-        times = parseTimeCodes('2023/7/10 22:00 CST;', '').rTimes
+        times = parseTimeCodes(userId, '2023/7/10 22:00 CST;', '', settings).rTimes
         self.assertEqual(len(times), 1)
         for time in times:
             tEnd = datetime.fromisoformat(time.end).astimezone(tz.gettz('America/Chicago'))
             self.assertEqual(tEnd.strftime('%Y/%m/%d %H:%M'), '2023/07/10 22:00')
 
     def test_paseTimeCodeDateSugar1(self):
-        times = parseTimeCodes('tdy 22:00 America/Los_Angeles;', '').rTimes
+        times = parseTimeCodes(userId, 'tdy 22:00 America/Los_Angeles;', '', fixedSettings).rTimes
         self.assertEqual(len(times), 1)
         for time in times:
             tEnd = datetime.fromisoformat(time.end).astimezone(tz.gettz('America/Los_Angeles'))
-            self.assertEqual(tEnd.strftime('%Y/%m/%d %H:%M'), datetime.now().strftime('%Y/%m/%d') + ' 22:00')
+            self.assertEqual(tEnd.strftime('%Y/%m/%d %H:%M'), '2023/08/15 22:00')
 
     def test_paseTimeCodeDateSugar2(self):
-        times = parseTimeCodes('tmr 22:00 America/Los_Angeles;', '').rTimes
+        times = parseTimeCodes(userId, 'tmr 22:00 America/Los_Angeles;', '', fixedSettings).rTimes
         self.assertEqual(len(times), 1)
         for time in times:
             tEnd = datetime.fromisoformat(time.end).astimezone(tz.gettz('America/Los_Angeles'))
-            self.assertEqual(tEnd.strftime('%Y/%m/%d %H:%M'), (datetime.now() + relativedelta(days=1)).strftime('%Y/%m/%d') + ' 22:00')
+            self.assertEqual(tEnd.strftime('%Y/%m/%d %H:%M'), '2023/08/16 22:00')
 
     def test_paseTimeCodeDateSugar3(self):
-        times = parseTimeCodes('7/10 22:00 America/Los_Angeles;', '').rTimes
+        times = parseTimeCodes(userId, '7/10 22:00 America/Los_Angeles;', '', fixedSettings).rTimes
         self.assertEqual(len(times), 1)
         for time in times:
             tEnd = datetime.fromisoformat(time.end).astimezone(tz.gettz('America/Los_Angeles'))
-            if datetime.now().month > 7 or (datetime.now().month == 7 and datetime.now().day > 10):
-                self.assertEqual(tEnd.strftime('%Y/%m/%d %H:%M'), f'{datetime.now().year + 1}/07/10 22:00')
-            else:
-                self.assertEqual(tEnd.strftime('%Y/%m/%d %H:%M'), f'{datetime.now().year}/07/10 22:00')
+            self.assertEqual(tEnd.strftime('%Y/%m/%d %H:%M'), '2024/07/10 22:00')
 
     def test_paseTimeCodeDateSugar4(self):
-        times = parseTimeCodes('7/20-30 22:00 America/Los_Angeles;', '').rTimes
+        times = parseTimeCodes(userId, '7/20-30 22:00 America/Los_Angeles;', '', fixedSettings).rTimes
         self.assertEqual(len(times), 11)
         day = 20
         for time in times:
             tEnd = datetime.fromisoformat(time.end).astimezone(tz.gettz('America/Los_Angeles'))
-            if datetime.now().month > 7 or (datetime.now().month == 7 and datetime.now().day > day):
-                self.assertEqual(tEnd.strftime('%Y/%m/%d %H:%M'), f'{datetime.now().year + 1}/07/{day} 22:00')
-            else:
-                self.assertEqual(tEnd.strftime('%Y/%m/%d %H:%M'), f'{datetime.now().year}/07/{day} 22:00')
+            self.assertEqual(tEnd.strftime('%Y/%m/%d %H:%M'), f'2024/07/{day} 22:00')
             day += 1
 
     def test_paseTimeCodeTimeZoneSugar1(self):
-        times = parseTimeCodes('2023/7/10 22:00;', '').rTimes
+        times = parseTimeCodes(userId, '2023/7/10 22:00;', '', settings).rTimes
         self.assertEqual(len(times), 1)
-        timeZone = getSettingByPath('rrule.timeZone')
+        timeZone = settings.timeZone
         for time in times:
             tEnd = datetime.fromisoformat(time.end).astimezone(tz.gettz(timeZone))
             self.assertEqual(tEnd.strftime('%Y/%m/%d %H:%M'), '2023/07/10 22:00')
 
     def test_paseTimeCodeTimeZoneSugar2(self):
-        times = parseTimeCodes('2023/7/10-2023/7/25 22:00 by[day[1]];', '').rTimes
+        times = parseTimeCodes(userId, '2023/7/10-2023/7/25 22:00 by[day[1]];', '', settings).rTimes
         self.assertEqual(len(times), 3)
-        timeZone = getSettingByPath('rrule.timeZone')
+        timeZone = settings.timeZone
         day = 10
         for time in times:
             tEnd = datetime.fromisoformat(time.end).astimezone(tz.gettz(timeZone))
@@ -172,9 +217,9 @@ class ParseTimeCodeTest(TestCase):
             day += 7
 
     def test_paseTimeCodeDateRangeSugar1(self):
-        times = parseTimeCodes('2023/7/10-8/10 22:00 by[day[1]];', '').rTimes
+        times = parseTimeCodes(userId, '2023/7/10-8/10 22:00 by[day[1]];', '', settings).rTimes
         self.assertEqual(len(times), 5)
-        timeZone = getSettingByPath('rrule.timeZone')
+        timeZone = settings.timeZone
         month = 7
         day = 10
         for time in times:
@@ -186,9 +231,9 @@ class ParseTimeCodeTest(TestCase):
                 month += 1
 
     def test_paseTimeCodeDateRangeSugar2(self):
-        times = parseTimeCodes('2023/7/10-31 22:00 by[day[1]];', '').rTimes
+        times = parseTimeCodes(userId, '2023/7/10-31 22:00 by[day[1]];', '', settings).rTimes
         self.assertEqual(len(times), 4)
-        timeZone = getSettingByPath('rrule.timeZone')
+        timeZone = settings.timeZone
         day = 10
         for time in times:
             tEnd = datetime.fromisoformat(time.end).astimezone(tz.gettz(timeZone))
@@ -196,9 +241,9 @@ class ParseTimeCodeTest(TestCase):
             day += 7
 
     def test_paseTimeCodeTimeRangeSugar1(self):
-        times = parseTimeCodes('2023/7/10 22-23 by[day[1]];', '').rTimes
+        times = parseTimeCodes(userId, '2023/7/10 22-23 by[day[1]];', '', settings).rTimes
         self.assertEqual(len(times), 1)
-        timeZone = getSettingByPath('rrule.timeZone')
+        timeZone = settings.timeZone
         for time in times:
             tStart = datetime.fromisoformat(time.start).astimezone(tz.gettz(timeZone))
             tEnd = datetime.fromisoformat(time.end).astimezone(tz.gettz(timeZone))
@@ -206,9 +251,9 @@ class ParseTimeCodeTest(TestCase):
             self.assertEqual(tEnd.strftime('%Y/%m/%d %H:%M'), '2023/07/10 23:00')
 
     def test_paseTimeCodeTimeRangeSugar2(self):
-        times = parseTimeCodes('2023/7/10 22-23:30 by[day[1]];', '').rTimes
+        times = parseTimeCodes(userId, '2023/7/10 22-23:30 by[day[1]];', '', settings).rTimes
         self.assertEqual(len(times), 1)
-        timeZone = getSettingByPath('rrule.timeZone')
+        timeZone = settings.timeZone
         for time in times:
             tStart = datetime.fromisoformat(time.start).astimezone(tz.gettz(timeZone))
             tEnd = datetime.fromisoformat(time.end).astimezone(tz.gettz(timeZone))
@@ -216,23 +261,23 @@ class ParseTimeCodeTest(TestCase):
             self.assertEqual(tEnd.strftime('%Y/%m/%d %H:%M'), '2023/07/10 23:30')
 
     def test_paseTimeCodeTimeRangeSugar3(self):
-        times = parseTimeCodes('2023/7/10 22-?:? by[day[1]];', '').rTimes
+        times = parseTimeCodes(userId, '2023/7/10 22-?:? by[day[1]];', '', settings).rTimes
         self.assertEqual(len(times), 1)
-        timeZone = getSettingByPath('rrule.timeZone')
+        timeZone = settings.timeZone
         for time in times:
             tStart = datetime.fromisoformat(time.start).astimezone(tz.gettz(timeZone))
             self.assertEqual(tStart.strftime('%Y/%m/%d %H:%M'), '2023/07/10 22:00')
             self.assertEqual(time.endMark, '00')
 
     def test_paseTimeCodeTimeRangeSugar4(self):
-        times = parseTimeCodes('2023/7/10 end America/Los_Angeles;', '').rTimes
+        times = parseTimeCodes(userId, '2023/7/10 end America/Los_Angeles;', '', settings).rTimes
         self.assertEqual(len(times), 1)
         for time in times:
             tEnd = datetime.fromisoformat(time.end).astimezone(tz.gettz('America/Los_Angeles'))
             self.assertEqual(tEnd.strftime('%Y/%m/%d %H:%M'), '2023/07/10 23:59')
 
     def test_paseTimeCodeTimeRangeSugar5(self):
-        times = parseTimeCodes('2023/7/10 22:30-e America/Los_Angeles;', '').rTimes
+        times = parseTimeCodes(userId, '2023/7/10 22:30-e America/Los_Angeles;', '', settings).rTimes
         self.assertEqual(len(times), 1)
         for time in times:
             tStart = datetime.fromisoformat(time.start).astimezone(tz.gettz('America/Los_Angeles'))
@@ -241,7 +286,7 @@ class ParseTimeCodeTest(TestCase):
             self.assertEqual(tEnd.strftime('%Y/%m/%d %H:%M'), '2023/07/10 23:59')
 
     def test_paseTimeCodeTimeRangeSugar6(self):
-        times = parseTimeCodes('2023/7/10 s-2:00 America/Los_Angeles;', '').rTimes
+        times = parseTimeCodes(userId, '2023/7/10 s-2:00 America/Los_Angeles;', '', settings).rTimes
         self.assertEqual(len(times), 1)
         for time in times:
             tStart = datetime.fromisoformat(time.start).astimezone(tz.gettz('America/Los_Angeles'))
@@ -250,7 +295,7 @@ class ParseTimeCodeTest(TestCase):
             self.assertEqual(tEnd.strftime('%Y/%m/%d %H:%M'), '2023/07/10 02:00')
 
     def test_paseTimeCodeTimeRangeSugar7(self):
-        times = parseTimeCodes('2023/7/10 start-end America/Los_Angeles;', '').rTimes
+        times = parseTimeCodes(userId, '2023/7/10 start-end America/Los_Angeles;', '', settings).rTimes
         self.assertEqual(len(times), 1)
         for time in times:
             tStart = datetime.fromisoformat(time.start).astimezone(tz.gettz('America/Los_Angeles'))
@@ -259,7 +304,7 @@ class ParseTimeCodeTest(TestCase):
             self.assertEqual(tEnd.strftime('%Y/%m/%d %H:%M'), '2023/07/10 23:59')
 
     def test_paseTimeCodeTimeRangeSugar8(self):
-        times = parseTimeCodes('2023/7/10 22.30-23.0 America/Los_Angeles;', '').rTimes
+        times = parseTimeCodes(userId, '2023/7/10 22.30-23.0 America/Los_Angeles;', '', settings).rTimes
         self.assertEqual(len(times), 1)
         for time in times:
             tStart = datetime.fromisoformat(time.start).astimezone(tz.gettz('America/Los_Angeles'))
@@ -268,7 +313,7 @@ class ParseTimeCodeTest(TestCase):
             self.assertEqual(tEnd.strftime('%Y/%m/%d %H:%M'), '2023/07/10 23:00')
 
     def test_paseTimeCodeTimeRangeSugar9(self):
-        times = parseTimeCodes('2023/7/10 22:-: America/Los_Angeles;', '').rTimes
+        times = parseTimeCodes(userId, '2023/7/10 22:-: America/Los_Angeles;', '', settings).rTimes
         self.assertEqual(len(times), 1)
         for time in times:
             tStart = datetime.fromisoformat(time.start).astimezone(tz.gettz('America/Los_Angeles'))
@@ -277,7 +322,7 @@ class ParseTimeCodeTest(TestCase):
             self.assertEqual(time.endMark, '00')
 
     def test_parseTimeCodeDateRangeTime(self):
-        times = parseTimeCodes('2023/7/10-2023/7/11 22:00 America/Los_Angeles;', '').rTimes
+        times = parseTimeCodes(userId, '2023/7/10-2023/7/11 22:00 America/Los_Angeles;', '', settings).rTimes
         self.assertEqual(len(times), 2)
         day = 10
         for time in times:
@@ -286,7 +331,7 @@ class ParseTimeCodeTest(TestCase):
             day += 1
 
     def test_parseTimeCodeDateTimeRange(self):
-        times = parseTimeCodes('2023/7/10 21:00-22:00 America/Los_Angeles;', '').rTimes
+        times = parseTimeCodes(userId, '2023/7/10 21:00-22:00 America/Los_Angeles;', '', settings).rTimes
         self.assertEqual(len(times), 1)
         day = 10
         for time in times:
@@ -297,7 +342,7 @@ class ParseTimeCodeTest(TestCase):
             day += 1
 
     def test_parseTimeCodeDateRangeTimeRange(self):
-        times = parseTimeCodes('2023/7/10-2023/7/12 21:00-22:00 America/Los_Angeles;', '').rTimes
+        times = parseTimeCodes(userId, '2023/7/10-2023/7/12 21:00-22:00 America/Los_Angeles;', '', settings).rTimes
         self.assertEqual(len(times), 3)
         day = 10
         for time in times:
@@ -308,7 +353,7 @@ class ParseTimeCodeTest(TestCase):
             day += 1
 
     def test_parseTimeCodeDateRangeTimeRangeFreq(self):
-        times = parseTimeCodes('2023/7/10-2023/7/15 21:00-22:00 America/Los_Angeles daily,i2;', '')
+        times = parseTimeCodes(userId, '2023/7/10-2023/7/15 21:00-22:00 America/Los_Angeles daily,i2;', '', settings)
         self.assertEqual(len(times.rTimes), 3)
         day = 10
         for time in times.rTimes:
@@ -319,7 +364,7 @@ class ParseTimeCodeTest(TestCase):
             day += 2
 
     def test_parseTimeCodeDateRangeTimeRangeFreq2(self):
-        times = parseTimeCodes('2023/7/10-2023/7/15 21:00-22:00 America/Los_Angeles daily,i2,c2;', '')
+        times = parseTimeCodes(userId, '2023/7/10-2023/7/15 21:00-22:00 America/Los_Angeles daily,i2,c2;', '', settings)
         self.assertEqual(len(times.rTimes), 2)
         day = 10
         for time in times.rTimes:
@@ -330,7 +375,7 @@ class ParseTimeCodeTest(TestCase):
             day += 2
 
     def test_parseTimeCodeDateRangeTimeRangeByDay(self):
-        times = parseTimeCodes('2023/7/10-2023/7/15 21:00-22:00 America/Los_Angeles by[day[2,3]];', '')
+        times = parseTimeCodes(userId, '2023/7/10-2023/7/15 21:00-22:00 America/Los_Angeles by[day[2,3]];', '', settings)
         self.assertEqual(len(times.rTimes), 2)
         day = 11
         for time in times.rTimes:
@@ -341,7 +386,7 @@ class ParseTimeCodeTest(TestCase):
             day += 1
 
     def test_parseTimeCodeDateRangeTimeRangeByMonth(self):
-        times = parseTimeCodes('2023/7/10-2023/8/12 21:00-22:00 America/Los_Angeles by[month[6,7]];', '')
+        times = parseTimeCodes(userId, '2023/7/10-2023/8/12 21:00-22:00 America/Los_Angeles by[month[6,7]];', '', settings)
         self.assertEqual(len(times.rTimes), 22)
         day = 10
         for time in times.rTimes:
@@ -352,7 +397,7 @@ class ParseTimeCodeTest(TestCase):
             day += 1
 
     def test_parseTimeCodeNextDay(self):
-        times = parseTimeCodes('2023/7/10 23:00-01:00 CST;', '').rTimes
+        times = parseTimeCodes(userId, '2023/7/10 23:00-01:00 CST;', '', settings).rTimes
         self.assertEqual(len(times), 1)
         for time in times:
             tStart = datetime.fromisoformat(time.start).astimezone(tz.gettz('America/Chicago'))
@@ -361,7 +406,7 @@ class ParseTimeCodeTest(TestCase):
             self.assertEqual(tEnd.strftime('%Y/%m/%d %H:%M'), '2023/07/11 01:00')
 
     def test_parseTimeCodeDateRangeTimeRange_RTime(self):
-        times = parseTimeCodes('2023/7/10-2023/7/11 21:00-22:00 America/Los_Angeles; 2023/7/10-2023/7/11 15:00-16:00 America/Los_Angeles;', '').rTimes
+        times = parseTimeCodes(userId, '2023/7/10-2023/7/11 21:00-22:00 America/Los_Angeles; 2023/7/10-2023/7/11 15:00-16:00 America/Los_Angeles;', '', settings).rTimes
         self.assertEqual(len(times), 4)
         day = 10
         for i in range(2):
@@ -378,7 +423,7 @@ class ParseTimeCodeTest(TestCase):
             self.assertEqual(tEnd.strftime('%Y/%m/%d %H:%M'), f'2023/07/{str(day + i - 2).zfill(2)} 16:00')
 
     def test_parseTimeCodeDateRangeTimeRange_ExTime(self):
-        res = parseTimeCodes('2023/7/10-2023/7/12 21:00-22:00 America/Los_Angeles;', '2023/7/11 21:00-22:00 America/Los_Angeles;')
+        res = parseTimeCodes(userId, '2023/7/10-2023/7/12 21:00-22:00 America/Los_Angeles;', '2023/7/11 21:00-22:00 America/Los_Angeles;', settings)
         rTimes = res.rTimes
         exTimes = res.exTimes
         self.assertEqual(len(rTimes), 2)
@@ -399,27 +444,297 @@ class ParseTimeCodeTest(TestCase):
             day += 1
 
     def test_parseTimeCode_nextDay(self):
-        times = parseTimeCodes('2023/8/9 23:59 America/Los_Angeles;\n', '').rTimes
+        times = parseTimeCodes(userId, '2023/8/9 23:59 America/Los_Angeles;\n', '', settings).rTimes
         self.assertEqual(len(times), 1)
         for time in times:
             tEnd = datetime.fromisoformat(time.end).astimezone(tz.gettz('America/Los_Angeles'))
             self.assertEqual(tEnd.strftime('%Y/%m/%d %H:%M'), '2023/08/09 23:59')
 
     def test_parseTimeCodeInvalid(self):
-        self.assertRaises(Exception, parseTimeCodes, '2023/11/30', '')
-        self.assertRaises(Exception, parseTimeCodes, '2023/11/30/1 22:00 America/Chicago', '')
-        self.assertRaises(Exception, parseTimeCodes, '2023/11/30 22:00:00 America/Chicago', '')
-        self.assertRaises(Exception, parseTimeCodes, '2023/11/30 ?:20 America/Chicago', '')
-        self.assertRaises(Exception, parseTimeCodes, '2023/11/30-12/21 22:00 America/Chicago dly;', '')
-        self.assertRaises(Exception, parseTimeCodes, '2023/11/30-12/21 22:00 America/Chicago dly,i2,c2;', '')
-        self.assertRaises(Exception, parseTimeCodes, '2023/11/30-12/21 22:00 America/Chicago daily,ia;', '')
-        self.assertRaises(Exception, parseTimeCodes, '2023/11/30-12/21 22:00 America/Chicago daily,i2,ca;', '')
-        self.assertRaises(Exception, parseTimeCodes, '2023/11/30-12/21 22:00 America/Chicago daily,i2,c2 monthly.i2;', '')
-        self.assertRaises(IndexError, parseTimeCodes, '2023/11/30-12/21 22:00 America/Chicago by[day[8]];', '')
-        self.assertRaises(Exception, parseTimeCodes, '2023/11/30-12/21 22:00 America/Chicago;', '2023/11/30-12/21 22:00-23:00 America/Chicago;')
-        self.assertRaises(Exception, parseTimeCodes, '2023/11/30-12/21 22:00-23:00 America/Chicago;', '2023/11/30-12/21 22:00 America/Chicago;')
-        self.assertRaises(Exception, parseTimeCodes, '', '2023/11/30-12/21 22:00-23:00 America/Chicago;')
-        self.assertRaises(Exception, parseTimeCodes, '2023/11/30-12/21 22:00-23:00 America/Chicago; 2023/11/30-12/21 22:00 America/Chicago;', '')
+        self.assertRaises(Exception, parseTimeCodes, userId, '2023/11/30', '', settings)
+        self.assertRaises(Exception, parseTimeCodes, userId, '2023/11/30/1 22:00 America/Chicago', '', settings)
+        self.assertRaises(Exception, parseTimeCodes, userId, '2023/11/30 22:00:00 America/Chicago', '', settings)
+        self.assertRaises(Exception, parseTimeCodes, userId, '2023/11/30 ?:20 America/Chicago', '', settings)
+        self.assertRaises(Exception, parseTimeCodes, userId, '2023/11/30-12/21 22:00 America/Chicago dly;', '', settings)
+        self.assertRaises(Exception, parseTimeCodes, userId, '2023/11/30-12/21 22:00 America/Chicago dly,i2,c2;', '', settings)
+        self.assertRaises(Exception, parseTimeCodes, userId, '2023/11/30-12/21 22:00 America/Chicago daily,ia;', '', settings)
+        self.assertRaises(Exception, parseTimeCodes, userId, '2023/11/30-12/21 22:00 America/Chicago daily,i2,ca;', '', settings)
+        self.assertRaises(Exception, parseTimeCodes, userId, '2023/11/30-12/21 22:00 America/Chicago daily,i2,c2 monthly.i2;', '', settings)
+        self.assertRaises(IndexError, parseTimeCodes, userId, '2023/11/30-12/21 22:00 America/Chicago by[day[8]];', '', settings)
+        self.assertRaises(Exception, parseTimeCodes, userId, '2023/11/30-12/21 22:00 America/Chicago;', '2023/11/30-12/21 22:00-23:00 America/Chicago;', settings)
+        self.assertRaises(Exception, parseTimeCodes, userId, '2023/11/30-12/21 22:00-23:00 America/Chicago;', '2023/11/30-12/21 22:00 America/Chicago;', settings)
+        self.assertRaises(Exception, parseTimeCodes, userId, '', '2023/11/30-12/21 22:00-23:00 America/Chicago;', settings)
+        self.assertRaises(Exception, parseTimeCodes, userId, '2023/11/30-12/21 22:00-23:00 America/Chicago; 2023/11/30-12/21 22:00 America/Chicago;', '', settings)
+
+    def test_parseTimeCodeSyntaxErrorColumn(self):
+        with self.assertRaises(TimeCodeSyntaxError) as cm:
+            parseTimeCodeLex(settings, '2023/7/10  22:00 UTC daily,x')
+        self.assertEqual(cm.exception.column, 27)
+        self.assertEqual(str(cm.exception), 'invalid option: x (column 28)')
+
+    def test_parseTimeCodeSyntaxErrorLine(self):
+        with self.assertRaises(TimeCodeSyntaxError) as cm:
+            parseTimeCodes(userId, '2023/7/10 22:00 UTC;2023/7/10 22:00 UTC dly;', '', settings)
+        self.assertEqual((cm.exception.line, cm.exception.column), (1, 20))
+
+
+class TimeCodeCacheTest(TestCase):
+    def setUp(self):
+        timeCodeCache.clear()
+
+    def test_cacheHit(self):
+        code = '2023/7/10-2023/7/15 21:00-22:00 America/Los_Angeles daily,i2;'
+        first = parseTimeCodes(userId, code, '', settings).rTimes
+        second = parseTimeCodes(userId, code, '', settings).rTimes
+        self.assertEqual(first, second)
+        self.assertEqual(timeCodeCache.info()['misses'], 1)
+        self.assertEqual(timeCodeCache.info()['hits'], 1)
+
+    def test_cacheKeyWkst(self):
+        code = '2023/7/10-2023/7/25 22:00 by[day[1]];'
+        parseTimeCodes(userId, code, '', settings)
+        times = parseTimeCodes(userId, code, '', ParserSettings(timeZone=settings.timeZone, wkst='SU')).rTimes
+        self.assertEqual(timeCodeCache.info()['misses'], 2)
+        for time in times:
+            tEnd = datetime.fromisoformat(time.end).astimezone(tz.gettz(settings.timeZone))
+            self.assertEqual(tEnd.weekday(), 6)
+
+    def test_occurrenceBudget(self):
+        cache = TimeCodeCache(maxOccurrences=10)
+        times = parseTimeCodes(userId, '2023/7/1-2023/7/20 9:00-10:00 UTC daily', '', settings).rTimes
+        for i in range(3):
+            cache.set((i,), TimeCodeSem(None, tuple(times[:4])))
+        # 按时间片总数淘汰最久没有使用的行
+        self.assertIsNone(cache.get((0,)))
+        self.assertIsNotNone(cache.get((2,)))
+        self.assertEqual(cache.info()['occurrences'], 8)
+        # 没有时间片的行也占一个位置，超过上限的行不缓存
+        cache.set((3,), TimeCodeSem(None, ()))
+        cache.set((4,), TimeCodeSem(None, tuple(times[:11])))
+        self.assertIsNone(cache.get((4,)))
+        self.assertEqual(cache.info()['size'], 3)
+        self.assertEqual(cache.info()['occurrences'], 9)
+
+
+class EventIndexCacheTest(TestCase):
+    def setUp(self):
+        # 每个时间片开始 1 小时后结束
+        self.index = EventIndex(1, [(start, start + 3600, {'id': str(start)}) for start in (7200, 0, 3600, 10800)])
+
+    def test_between(self):
+        self.assertEqual([event['id'] for event in self.index.between(0, 7200)], ['0', '3600'])
+        # 跨过窗口边界的时间片也在结果中
+        self.assertEqual([event['id'] for event in self.index.between(1, 7201)], ['0', '3600', '7200'])
+        self.assertEqual([event['id'] for event in self.index.between(5000, 5001)], ['3600'])
+        self.assertEqual(self.index.between(14400, 20000), [])
+
+    def test_generation(self):
+        cache = EventIndexCache(maxbytes=10 ** 6)
+        self.assertIsNone(cache.get(userId, 1))
+        cache.set(userId, self.index)
+        self.assertIs(cache.get(userId, 1), self.index)
+        self.assertIsNone(cache.get(userId, 2))
+        info = cache.info()
+        self.assertEqual((info['hits'], info['misses'], info['stale'], info['size']), (1, 2, 1, 0))
+
+    def test_maxbytes(self):
+        cache = EventIndexCache(maxbytes=self.index.nbytes - 1)
+        cache.set(userId, self.index)
+        self.assertIsNone(cache.get(userId, 1))
+        self.assertEqual(cache.info()['tooLarge'], 1)
+
+
+class SearchDocumentTest(TestCase):
+    def test_toSearchDocument(self):
+        self.assertEqual(toSearchDocument('Weekly Meeting', '', ['room 3']), 'weekly meeting\nroom 3')
+        self.assertEqual(toSearchDocument('Meeting', 'with Bob', []), 'meeting\nwith bob')
+
+
+class DiffTimeCodeLinesTest(TestCase):
+    def test_changedLines(self):
+        daily = '2023/7/10-2023/7/15 21:00-22:00 America/Los_Angeles daily'
+        old = parseTimeCodes(userId, f'{daily};2023/7/20 9:00-10:00 UTC', '', settings)
+        new = parseTimeCodes(userId, f'{daily};2023/7/21 9:00-10:00 UTC', '', settings)
+        keys = diffTimeCodeLines(old.rLines, new.rLines)
+        self.assertEqual(keys, {old.rTimes[-1].key(), new.rTimes[-1].key()})
+
+    def test_unchanged(self):
+        old = parseTimeCodes(userId, '2023/7/10-2023/7/15 21:00-22:00 America/Los_Angeles daily', '', settings)
+        self.assertFalse(old.relative)
+        self.assertEqual(diffTimeCodeLines(old.rLines, old.rLines), set())
+
+
+class StreamTimeCodesTest(TestCase):
+    def test_equivalence(self):
+        code = '2023/7/1-2023/8/30 21:00-22:00 America/Los_Angeles daily;2023/7/1-2023/9/30 9:00-10:00 UTC by[day[1,3]]'
+        exCode = '2023/8/1-2023/9/30 9:00-10:00 UTC by[day[1]]'
+        parseRes = parseTimeCodes(userId, code, exCode, settings)
+        for cached in [True, False]:
+            if not cached:
+                timeCodeCache.clear()
+            with self.subTest(cached=cached):
+                stream = streamTimeCodes(userId, code, exCode, settings)
+                times = list(stream.times)
+                self.assertEqual([time.sortKey() for time, _ in times], sorted(time.sortKey() for time, _ in times))
+                self.assertEqual(sorted(time.key() for time, excluded in times if not excluded),
+                                 sorted(time.key() for time in parseRes.rTimes))
+                self.assertEqual(sorted(time.key() for time, excluded in times if excluded),
+                                 sorted(time.key() for time in parseRes.exTimes))
+                self.assertEqual(stream.rruleStr, parseRes.rruleStr)
+
+    def test_lexErrorBeforeIteration(self):
+        with self.assertRaises(ValueError):
+            streamTimeCodes(userId, '2023/7/1 9:00-10:00 UTC;2023/7/1 10:00 UTC', '', settings)
+
+
+class ExFingerprintsTest(TestCase):
+    code = '2023/7/1-2023/7/10 9:00-10:00 UTC daily'
+
+    def test_parseAndStream(self):
+        rTimes = parseTimeCodes(userId, self.code, '', settings).rTimes
+        exFingerprints = {rTimes[2].fingerprint(), rTimes[5].fingerprint()}
+        parseRes = parseTimeCodes(userId, self.code, '', settings, exFingerprints)
+        self.assertEqual({time.fingerprint() for time in parseRes.exTimes}, exFingerprints)
+        self.assertEqual(len(parseRes.rTimes), len(rTimes) - 2)
+        stream = streamTimeCodes(userId, self.code, '', settings, exFingerprints)
+        self.assertEqual({time.fingerprint() for time, excluded in stream.times if excluded}, exFingerprints)
+
+    def test_legacyExTimeCode(self):
+        # 旧版本删除单个时间片追加的行与 exFingerprints 排除的时间片相同
+        rTimes = parseTimeCodes(userId, self.code, '', settings).rTimes
+        exTimes = parseTimeCodes(userId, self.code, '2023/07/03 9:0-10:0 UTC', settings).exTimes
+        self.assertEqual([time.fingerprint() for time in exTimes], [rTimes[2].fingerprint()])
+
+    def test_addExFingerprints(self):
+        schedule = Schedule()
+        schedule.addExFingerprints(['a', 'b'])
+        schedule.addExFingerprints(['b', 'c', 'c'])
+        self.assertEqual(schedule.exFingerprints, 'a;b;c')
+        self.assertEqual(schedule.getExFingerprints(), {'a', 'b', 'c'})
+        schedule.pruneExFingerprints({'c', 'd'})
+        self.assertEqual(schedule.exFingerprints, 'c')
+        schedule.pruneExFingerprints(set())
+        self.assertEqual(schedule.getExFingerprints(), set())
+
+
+class VectorizedExpansionTest(TestCase):
+    codes = [
+        '2023/7/10-2023/7/15 21:00-22:00 America/Los_Angeles daily,i2;',
+        '2023/7/10-2023/7/15 21:00-22:00 America/Los_Angeles daily,i2,c2;',
+        '2023/1/1-2024/12/31 9:00-10:00 Asia/Shanghai weekly by[day[1,3,5]];',
+        '2023/1/1-2024/12/31 23:00-1:00 Europe/London weekly,i2 by[day[2,6]];',
+        '2023/1/31-2024/12/31 20:00 America/New_York monthly;',
+        '2023/1/31-2025/12/31 8:?-9:00 Australia/Sydney monthly,i3,c4;',
+        '2023/3/1-2023/3/31 2:30-3:30 America/Chicago daily;',
+        '2023/10/20-2023/11/10 1:30 America/Chicago daily;',
+        '2023/7/10-2023/8/12 21:00-22:00 America/Los_Angeles by[month[6,7]];',
+        '2023/7/10-2023/7/25 22:00 by[day[1]];',
+        '2023/7/20-2023/7/1 22:00 UTC daily;',
+        '2020/1/1-2030/12/31 12:00 Asia/Kolkata daily,i7;',
+    ]
+
+    def setUp(self):
+        timeCodeCache.clear()
+
+    def tearDown(self):
+        timeCodeParser.VECTORIZED_EXPANSION = True
+        timeCodeCache.clear()
+
+    def parse(self, code: str, wkst: str, vectorized: bool):
+        timeCodeParser.VECTORIZED_EXPANSION = vectorized
+        timeCodeCache.clear()
+        return parseTimeCodes(userId, code, '', ParserSettings(timeZone=settings.timeZone, wkst=wkst)).rTimes
+
+    def test_equivalence(self):
+        for code in self.codes:
+            for wkst in ['MO', 'TU']:
+                with self.subTest(code=code, wkst=wkst):
+                    self.assertEqual(self.parse(code, wkst, True), self.parse(code, wkst, False))
+
+
+class TimeZoneIndexTest(TestCase):
+    def setUp(self):
+        timeZone.getTimeZoneIndex.cache_clear()
+        self.addCleanup(timeZone.getTimeZoneIndex.cache_clear)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'timezones.json')
+        patcher = mock.patch.dict(os.environ, {timeZone.TIME_ZONE_INDEX_PATH_ENV: self.path})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_versionIgnoresDate(self):
+        version = timeZone.getTimeZoneIndexVersion()
+        with mock.patch.object(timeZone, 'datetime', wraps=datetime) as mockDatetime:
+            mockDatetime.now.return_value = datetime(2099, 1, 1)
+            self.assertEqual(timeZone.getTimeZoneIndexVersion(), version)
+            self.assertEqual(timeZone.buildTimeZoneIndex().to_dict(), timeZone.buildTimeZoneIndex().to_dict())
+
+    def test_loadFile(self):
+        index = timeZone.buildTimeZoneIndex()
+        timeZone.saveTimeZoneIndex(index, timeZone.getTimeZoneIndexPath())
+        with mock.patch.object(timeZone, 'buildTimeZoneIndex') as build:
+            self.assertEqual(timeZone.getTimeZoneIndex().to_dict(), index.to_dict())
+            build.assert_not_called()
+
+    def test_rejectFile(self):
+        with open(self.path, 'w') as f:
+            json.dump({'version': '1-2023c-2023', 'zones': [], 'abbrs': {}}, f)
+        with self.assertLogs('utils.timeZone', 'WARNING') as logs:
+            self.assertEqual(timeZone.resolveTimeZone('CST'), 'America/Chicago')
+        self.assertIn('1-2023c-2023', logs.output[0])
+
+        timeZone.getTimeZoneIndex.cache_clear()
+        with open(self.path, 'w') as f:
+            f.write('[]')
+        with self.assertLogs('utils.timeZone', 'WARNING'):
+            self.assertEqual(timeZone.resolveTimeZone('CST'), 'America/Chicago')
+
+
+class CompactTimeRangeTest(TestCase):
+    def test_boundary(self):
+        time = TimeRange('2023-07-10T21:00:00.000Z', '2023-07-10T22:00:00+00:00', startMark='10', endMark='01')
+        self.assertEqual(time.startTs, 1689022800)
+        self.assertEqual(time.to_dict(), {
+            'start': '2023-07-10T21:00:00+00:00',
+            'end': '2023-07-10T22:00:00+00:00',
+            'startMark': '10',
+            'endMark': '01',
+        })
+        self.assertEqual(TimeRange.fromEpoch(None, -2208988800, 0b0011).to_dict(), {
+            'start': None,
+            'end': '1900-01-01T00:00:00+00:00',
+            'startMark': '00',
+            'endMark': '11',
+        })
+
+    def test_slots(self):
+        with self.assertRaises(AttributeError):
+            TimeRange(None, '2023-07-10T22:00:00+00:00').extra = 1
+        with self.assertRaises(AttributeError):
+            TimeUnit(9, 0).second = 0
+
+
+class KeyedSetAlgebraTest(TestCase):
+    def test_timeRangeKey(self):
+        self.assertEqual(TimeRange('2023-07-10T21:00:00+00:00', '2023-07-10T22:00:00+00:00').key(),
+                         TimeRange('2023-07-10T21:00:00.000Z', '2023-07-10T22:00:00.000Z').key())
+        self.assertNotEqual(TimeRange(None, '2023-07-10T22:00:00+00:00').key(),
+                            TimeRange(None, '2023-07-10T22:00:00+00:00', endMark='10').key())
+
+    def test_fingerprint(self):
+        time = Time(start=fromISOString('2023-07-10T21:00:00.000Z'), end=fromISOString('2023-07-10T22:00:00.000Z'),
+                    startMark='11', endMark='10')
+        self.assertEqual(time.computeFingerprint(),
+                         TimeRange('2023-07-10T21:00:00+00:00', '2023-07-10T22:00:00+00:00', endMark='10').fingerprint())
+        self.assertEqual(TimeRange(None, '2023-07-10T22:00:00+00:00').fingerprint(), ':1689026400000:15')
+
+    def test_equivalence(self):
+        a = parseTimeCodes(userId, '2023/7/1-2023/8/30 21:00-22:00 America/Los_Angeles daily;', '', settings).rTimes
+        b = parseTimeCodes(userId, '2023/8/1-2023/9/30 21:00-22:00 America/Los_Angeles by[day[1,3]];', '', settings).rTimes
+        self.assertEqual(keyedIntersection(a, b, TimeRange.key), intersection(a, b, lambda x, y: x == y))
+        self.assertEqual(keyedDifference(a, b, TimeRange.key), difference(a, b, lambda x, y: x == y))
+        self.assertEqual(keyedUnion(a, b, TimeRange.key), union(a, b, lambda x, y: x == y))
 
 
 class TimeTest(TestCase):
@@ -436,4 +751,432 @@ class TimeTest(TestCase):
         tDelta2 = t + relativedelta(day=11)
         self.assertEqual(tDelta2.isoformat(), '2023-07-11T21:00:00+00:00')
         tDelta3 = t + relativedelta(hour=10, minute=30)
-        self.assertEqual(tDelta3.isoformat(), '2023-07-10T10:30:00+00:00')
\ No newline at end of file
+        self.assertEqual(tDelta3.isoformat(), '2023-07-10T10:30:00+00:00')
+
+    def test_isoformat(self):
+        t = fromISOString('2023-07-11T05:00:00+08:00')
+        self.assertEqual(isoformat(t), '2023-07-10T21:00:00.000Z')
+        self.assertEqual(toUTCISOString(t), '2023-07-10T21:00:00+00:00')
+        self.assertEqual(fromISOString(isoformat(t)), t)
+        self.assertEqual(fromISOString('2023-07-10T21:00:00'), t)
+        self.assertEqual(epochSecondsToDatetime(toEpochMillis(t) // 1000), t)
+        self.assertIsNone(isoformat(None))
+
+    def test_naiveTimeIsUTC(self):
+        # 与进程的本地时区无关，环境变量恢复后再重新读取时区
+        self.addCleanup(tzset)
+        with mock.patch.dict(os.environ, {'TZ': 'Asia/Shanghai'}):
+            tzset()
+            self.assertEqual(fromISOString('2023-07-10T21:00:00'), datetime(2023, 7, 10, 21, tzinfo=tz.UTC))
+            self.assertEqual(toEpochSeconds('2023-07-10T21:00:00'), 1689022800)
+            self.assertEqual(toEpochSeconds('2023-07-11T05:00:00+08:00'), 1689022800)
+            self.assertEqual(TimeRange(None, '2023-07-10T21:00:00').endTs, 1689022800)
+
+    def test_resolveTimeZone(self):
+        self.assertEqual(resolveTimeZone('CST'), 'America/Chicago')
+        self.assertEqual(resolveTimeZone('IST'), 'Asia/Kolkata')
+        self.assertEqual(resolveTimeZone('Asia/Shanghai'), 'Asia/Shanghai')
+        self.assertIsNone(resolveTimeZone('XYZ'))
+
+
+class ServiceTestCase(TestCase):
+    """
+    service 的测试，用户设置使用快照，不依赖 redis
+    """
+
+    def setUp(self):
+        ScheduleUser.objects.create_user(userId, f'{userId}@example.com')
+        for target in ['schedule.service.loadParserSettings', 'schedule.timeCodeParser.loadParserSettings']:
+            patcher = mock.patch(target, return_value=settings)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch('schedule.service.getSettingsSnapshot', return_value={
+            'preferences.startTime.hour': 0, 'preferences.startTime.minute': 0})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def dateCode(t: datetime) -> str:
+        return f'{t.year}/{t.month}/{t.day}'
+
+
+class HorizonTest(ServiceTestCase):
+    def test_findEventsBetween(self):
+        now = datetime.now(tz.gettz('UTC'))
+        service.createSchedule(userId, 'daily', f'{self.dateCode(now)}-{self.dateCode(now + relativedelta(years=2))} '
+                                                f'9:00-10:00 UTC daily', '', '')
+        start = now + relativedelta(years=1)
+        events = service.findEventsBetween(userId, isoformat(start), isoformat(start + relativedelta(days=7)))
+        self.assertEqual(len(events), 7)
+
+    def test_findTimesByScheduleId(self):
+        now = datetime.now(tz.gettz('UTC'))
+        schedule = service.createSchedule(userId, 'daily', f'{self.dateCode(now)}-{self.dateCode(now + relativedelta(years=2))} '
+                                                           f'9:00-10:00 UTC daily', '', '')
+        # 模拟上次物化之后过了 60 天，horizon 已经向后推进
+        materializedUntil = now + relativedelta(days=30)
+        Time.objects.filter(schedule_id=schedule['id'], end__gt=materializedUntil).delete()
+        Schedule.objects.filter(id=schedule['id']).update(materializedUntil=materializedUntil)
+        times = service.findTimesByScheduleId(schedule['id'], userId)
+        horizon = service.getHorizon()
+        self.assertGreater(max(fromISOString(time['end']) for time in times), materializedUntil)
+        self.assertTrue(all(fromISOString(time['end']) <= horizon for time in times))
+
+    def test_findAllTodosBeyondHorizon(self):
+        nextTime = datetime.now(tz.gettz('UTC')) + relativedelta(days=200)
+        schedule = service.createSchedule(userId, 'yearly', f'{self.dateCode(nextTime)}-'
+                                                            f'{self.dateCode(nextTime + relativedelta(years=3))} '
+                                                            f'12:00 UTC yearly', '', '')
+        self.assertFalse(Time.objects.filter(schedule_id=schedule['id']).exists())
+        todos = service.findAllTodos(userId)
+        self.assertEqual([todo['scheduleId'] for todo in todos], [schedule['id']])
+        self.assertEqual(fromISOString(todos[0]['end']).date(), nextTime.date())
+
+    def test_extendNextTodosOnce(self):
+        nextTime = datetime.now(tz.gettz('UTC')) + relativedelta(days=200)
+        service.createSchedule(userId, 'yearly', f'{self.dateCode(nextTime)}-'
+                                                 f'{self.dateCode(nextTime + relativedelta(years=3))} '
+                                                 f'12:00 UTC yearly', '', '')
+        # 已经全部物化的 _todo 不展开
+        service.createSchedule(userId, 'once', f'{self.dateCode(nextTime - relativedelta(days=150))} 12:00 UTC',
+                               '', '')
+        with mock.patch.object(service, 'streamTimeCodes', wraps=service.streamTimeCodes) as streamTimeCodes:
+            service.findAllTodos(userId)
+            self.assertEqual(streamTimeCodes.call_count, 2)
+            streamTimeCodes.reset_mock()
+            self.assertEqual(len(service.findAllTodos(userId)), 2)
+            streamTimeCodes.assert_not_called()
+
+    def test_findAllTodosQueryCount(self):
+        def createTodos(count: int):
+            for i in range(count):
+                date = datetime.now(tz.gettz('UTC')) + relativedelta(days=i + 1)
+                service.createSchedule(userId, f'todo{i}', f'{self.dateCode(date)} 12:00 UTC', '', '')
+
+        createTodos(2)
+        with self.assertNumQueries(4):
+            self.assertEqual(len(service.findAllTodos(userId)), 2)
+        createTodos(20)
+        with self.assertNumQueries(4):
+            self.assertEqual(len(service.findAllTodos(userId)), 22)
+
+    def test_spanBeyondHorizon(self):
+        start = datetime.now(tz.gettz('UTC')) + relativedelta(days=1)
+        until = start + relativedelta(years=3)
+        # until 是星期几不确定，最后一个时间片不一定在 until 当天
+        code = f'{self.dateCode(start)}-{self.dateCode(until)} 9:00-10:00 Asia/Shanghai weekly by[day[2,4]]'
+        schedule = service.createSchedule(userId, 'weekly', code, '', '')
+        saved = Schedule.objects.get(id=schedule['id'])
+        self.assertIsNotNone(saved.materializedUntil)
+        rTimes = parseTimeCodes(userId, code, '', settings).rTimes
+        self.assertEqual(saved.firstAt, epochSecondsToDatetime(rTimes[0].startTs))
+        self.assertEqual(saved.lastAt, epochSecondsToDatetime(rTimes[-1].endTs))
+        self.assertEqual(timeCodeParser.timeCodeBounds(settings, code), (rTimes[0].startTs, rTimes[-1].endTs))
+
+    def test_spanFallsBackToUntil(self):
+        # 不能批量展开的 rrule 以 until 当天作为最后一个时间片
+        code = '2030/1/15-2040/12/31 9:00-10:00 UTC yearly'
+        with mock.patch.object(timeCodeParser.rrule, 'before', side_effect=AssertionError):
+            first, last = timeCodeParser.timeCodeBounds(settings, code)
+        self.assertEqual(epochSecondsToDatetime(first), datetime(2030, 1, 15, 9, tzinfo=tz.gettz('UTC')))
+        self.assertEqual(epochSecondsToDatetime(last), datetime(2040, 12, 31, 10, tzinfo=tz.gettz('UTC')))
+
+    def test_dateRangeBeyondHorizon(self):
+        now = datetime.now(tz.gettz('UTC'))
+        until = now + relativedelta(years=2)
+        daily = service.createSchedule(userId, 'daily', f'{self.dateCode(now)}-{self.dateCode(until)} '
+                                                        f'9:00-10:00 UTC daily', '', '')
+        # 在 horizon 之后才开始，还没有时间片
+        later = service.createSchedule(userId, 'later', f'{self.dateCode(now + relativedelta(years=1))} '
+                                                        f'9:00-10:00 UTC', '', '')
+        self.assertEqual(Schedule.objects.get(id=daily['id']).lastAt.date(), until.date())
+
+        def findIds(start: datetime, end: datetime) -> set[str]:
+            conditions = service.FindAllSchedulesConditions({
+                'search': '', 'dateRange': [int(start.timestamp() * 1000), int(end.timestamp() * 1000)],
+                'type': None, 'star': None})
+            return {schedule['id'] for schedule in service.findAllSchedules(userId, conditions, 1, 20)['data']}
+
+        start = now + relativedelta(years=1, days=-3)
+        self.assertEqual(findIds(start, start + relativedelta(days=7)), {daily['id'], later['id']})
+        start = now + relativedelta(months=18)
+        self.assertEqual(findIds(start, start + relativedelta(days=7)), {daily['id']})
+        start = now + relativedelta(years=3)
+        self.assertEqual(findIds(start, start + relativedelta(days=7)), set())
+
+
+@override_settings(SCHEDULE_TIME_BATCH_SIZE=10)
+class BulkWriteTest(ServiceTestCase):
+    def setUp(self):
+        super().setUp()
+        start = datetime.now(tz.gettz('UTC')) + relativedelta(days=1)
+        self.code = f'{self.dateCode(start)}-{self.dateCode(start + relativedelta(days=24))} 9:00-10:00 UTC daily'
+
+    def test_createBatches(self):
+        with CaptureQueriesContext(connection) as queries:
+            schedule = service.createSchedule(userId, 'daily', self.code, '', '')
+        inserts = [query for query in queries.captured_queries
+                   if query['sql'].startswith(f'INSERT INTO "{Time._meta.db_table}"')]
+        # 25 个时间片每批 10 个
+        self.assertEqual(len(inserts), 3)
+        self.assertEqual(Time.objects.filter(schedule_id=schedule['id']).count(), 25)
+
+    def test_reviveBatches(self):
+        schedule = service.createSchedule(userId, 'daily', self.code, '', '')
+        Time.objects.filter(schedule_id=schedule['id']).update(deleted=True)
+        rTimes = parseTimeCodes(userId, self.code, '', settings).rTimes
+        scheduleObj = Schedule.objects.get(id=schedule['id'])
+        # 每批一次查询已有的时间片，一次 bulk_update
+        with self.assertNumQueries(6):
+            service.bulkCreateTimes(scheduleObj, ((time, False) for time in rTimes))
+        self.assertEqual(Time.objects.filter(schedule_id=schedule['id'], deleted=False).count(), 25)
+        self.assertEqual(Time.objects.filter(schedule_id=schedule['id']).count(), 25)
+
+
+class BackfillTest(ServiceTestCase):
+    def test_backfillLegacyRows(self):
+        start = datetime.now(tz.gettz('UTC')).replace(hour=9, minute=0, second=0, microsecond=0) + relativedelta(days=1)
+        code = f'{self.dateCode(start)}-{self.dateCode(start + relativedelta(days=4))} 9:00-10:00 UTC daily'
+        schedule = service.createSchedule(userId, 'daily', code, 'comment', '')
+        service.createRecord(schedule['id'], userId, isoformat(start), isoformat(start + relativedelta(hours=1)))
+        window = (isoformat(start - relativedelta(days=1)), isoformat(start + relativedelta(days=7)))
+        lastSyncAt = isoformat(start - relativedelta(years=1))
+        # 旧版本的行没有冗余字段，按 user_id 过滤的查询找不到
+        Time.objects.filter(schedule_id=schedule['id']).update(user=None, scheduleName='', scheduleComment='')
+        Record.objects.filter(schedule_id=schedule['id']).update(user=None)
+        self.assertEqual(service.findEventsBetween(userId, *window), [])
+        unSynced = service.getUnSynced(userId, lastSyncAt)
+        self.assertEqual((len(unSynced['times']), len(unSynced['records'])), (0, 0))
+
+        self.assertEqual(backfillDenormalizedFields(Schedule, Time, Record, batchSize=2), (5, 1))
+        events = service.findEventsBetween(userId, *window)
+        self.assertEqual(len(events), 5)
+        self.assertTrue(all(event['name'] == 'daily' and event['comment'] == 'comment' for event in events))
+        unSynced = service.getUnSynced(userId, lastSyncAt)
+        self.assertEqual((len(unSynced['times']), len(unSynced['records'])), (5, 1))
+        self.assertEqual(backfillDenormalizedFields(Schedule, Time, Record), (0, 0))
+
+
+class DeleteTimeTest(ServiceTestCase):
+    def setUp(self):
+        super().setUp()
+        start = datetime.now(tz.gettz('UTC')) + relativedelta(days=10)
+        self.start = start
+        self.code = f'{self.dateCode(start)}-{self.dateCode(start + relativedelta(days=4))} 9:00-10:00 UTC daily'
+
+    @staticmethod
+    def findTimes(scheduleId: str) -> list[dict]:
+        # findTimesByScheduleId 不返回排除的时间片
+        return [time.to_dict() for time in Time.objects.filter(schedule_id=scheduleId, deleted=False).order_by('end')]
+
+    def test_delete(self):
+        schedule = service.createSchedule(userId, 'daily', self.code, '', '')
+        time = self.findTimes(schedule['id'])[2]
+        deleted = service.deleteTimeByIds(userId, [time['id']])[0]
+        self.assertTrue(deleted['excluded'])
+        self.assertEqual(deleted['version'], time['version'] + 1)
+        self.assertEqual(Time.objects.get(id=time['id']).version, time['version'] + 1)
+        self.assertEqual(Schedule.objects.get(id=schedule['id']).liveCount, 4)
+
+    def test_syncExclusion(self):
+        schedule = service.createSchedule(userId, 'daily', self.code, '', '')
+        time = self.findTimes(schedule['id'])[2]
+        service.deleteTimeByIds(userId, [time['id']])
+        # 排除随 schedule 同步给客户端，exTimeCode 不变
+        synced = next(item for item in service.getUnSynced(userId, schedule['updated'])['schedules']
+                      if item['id'] == schedule['id'])
+        self.assertEqual(synced['version'], schedule['version'] + 1)
+        self.assertEqual(synced['exTimeCode'], '')
+        self.assertEqual(synced['exFingerprints'], Time.objects.get(id=time['id']).fingerprint)
+
+        # 客户端修改的排除同步回服务端
+        synced.pop('userId')
+        synced['exFingerprints'] = ''
+        service.sync(userId, [synced], [], [], isoformat(datetime.now(tz.gettz('UTC'))))
+        self.assertEqual(Schedule.objects.get(id=schedule['id']).exFingerprints, '')
+
+    def test_pruneOnUpdate(self):
+        schedule = service.createSchedule(userId, 'daily', self.code, '', '')
+        service.deleteTimeByIds(userId, [self.findTimes(schedule['id'])[2]['id']])
+        # 删除所在的行后再改回来，时间片重新出现
+        code = f'{self.dateCode(self.start)}-{self.dateCode(self.start + relativedelta(days=1))} 9:00-10:00 UTC daily'
+        service.updateScheduleById(schedule['id'], userId, 'daily', code, '', '')
+        self.assertEqual(Schedule.objects.get(id=schedule['id']).exFingerprints, '')
+        service.updateScheduleById(schedule['id'], userId, 'daily', self.code, '', '')
+        times = self.findTimes(schedule['id'])
+        self.assertEqual([time['excluded'] for time in times], [False] * 5)
+
+    def test_keepOnUpdate(self):
+        schedule = service.createSchedule(userId, 'daily', self.code, '', '')
+        service.deleteTimeByIds(userId, [self.findTimes(schedule['id'])[2]['id']])
+        # 时间片仍然存在时保留排除
+        code = f'{self.code};{self.dateCode(self.start + relativedelta(days=9))} 9:00-10:00 UTC'
+        service.updateScheduleById(schedule['id'], userId, 'daily', code, '', '')
+        times = self.findTimes(schedule['id'])
+        self.assertEqual([time['excluded'] for time in times], [False, False, True, False, False, False])
+
+
+class PreviewTest(ServiceTestCase):
+    code = '2023/1/1-2050/12/31 9:00-10:00 UTC daily'
+
+    def setUp(self):
+        super().setUp()
+        timeCodeCache.clear()
+
+    def test_limit(self):
+        res = service.previewTimeCodes(userId, [{'rTime': self.code, 'exTime': '2023/1/2 9:00-10:00 UTC'}], 3)[0]
+        self.assertTrue(res['success'])
+        self.assertEqual([time['end'] for time in res['data']['rTimes']],
+                         ['2023-01-01T10:00:00+00:00', '2023-01-03T10:00:00+00:00'])
+        self.assertEqual([time['end'] for time in res['data']['exTimes']], ['2023-01-02T10:00:00+00:00'])
+        self.assertTrue(res['data']['hasMore'])
+        # 预览不写入解析缓存
+        self.assertEqual(timeCodeCache.info()['size'], 0)
+
+    def test_limitBounds(self):
+        res = service.previewTimeCodes(userId, [{'rTime': self.code}], 1000)[0]
+        self.assertEqual(len(res['data']['rTimes']), service.PREVIEW_MAX_LIMIT)
+        res = service.previewTimeCodes(userId, [{'rTime': self.code}], -1)[0]
+        self.assertEqual(res['data']['rTimes'], [])
+        self.assertTrue(res['data']['hasMore'])
+        res = service.previewTimeCodes(userId, [{'rTime': '2023/1/1 9:00-10:00 UTC'}], 1)[0]
+        self.assertEqual(len(res['data']['rTimes']), 1)
+        self.assertFalse(res['data']['hasMore'])
+
+    def test_errors(self):
+        res = service.previewTimeCodes(userId, [{'rTime': 'foo'}, {'rTime': self.code}], 1)
+        self.assertEqual([item['success'] for item in res], [False, True])
+        with self.assertRaises(ValueError):
+            service.previewTimeCodes(userId, [{'rTime': self.code}] * (service.PREVIEW_MAX_ITEMS + 1), 1)
+
+    def test_view(self):
+        headers = {'HTTP_X_AUTH_TOKEN': 'token', 'HTTP_X_AUTH_USER_ID': userId}
+        with mock.patch('main.decorators.cache.get', return_value=userId):
+            res = self.client.post('/schedule/previewTimeCodes/', {'items': [{'rTime': self.code}], 'limit': 2},
+                                   content_type='application/json', **headers).json()
+            self.assertTrue(res['success'])
+            self.assertEqual(len(res['data'][0]['data']['rTimes']), 2)
+            res = self.client.post('/schedule/previewTimeCodes/', {'items': [{'rTime': self.code}] * 51},
+                                   content_type='application/json', **headers).json()
+            self.assertFalse(res['success'])
+
+
+class FakeRedis:
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def incr(self, key):
+        self.values[key] = int(self.values.get(key, 0)) + 1
+
+
+class EventIndexTest(ServiceTestCase):
+    def setUp(self):
+        super().setUp()
+        for target, value in [('schedule.service.eventIndexCache', EventIndexCache(maxbytes=10 ** 6)),
+                              ('schedule.service.generationConnection', None)]:
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_lazyConnection(self):
+        with mock.patch('schedule.service.get_redis_connection') as getConnection, \
+                mock.patch('schedule.service.eventIndexCache', EventIndexCache(maxbytes=0)):
+            start = datetime.now(tz.gettz('UTC')) + relativedelta(days=1)
+            service.createSchedule(userId, 'event', f'{self.dateCode(start)} 9:00-10:00 UTC', '', '')
+            service.findEventsBetween(userId, isoformat(start), isoformat(start + relativedelta(days=1)))
+        getConnection.assert_not_called()
+
+    def test_cacheHitSkipsHorizon(self):
+        start = datetime.now(tz.gettz('UTC')).replace(hour=0, minute=0, second=0, microsecond=0) + relativedelta(days=1)
+        service.createSchedule(userId, 'event', f'{self.dateCode(start)} 9:00-10:00 UTC', '', '')
+        with mock.patch('schedule.service.get_redis_connection', return_value=FakeRedis()), \
+                mock.patch('schedule.service.extendHorizon', wraps=service.extendHorizon) as extendHorizon:
+            window = (isoformat(start), isoformat(start + relativedelta(days=1)))
+            self.assertEqual(len(service.findEventsBetween(userId, *window)), 1)
+            self.assertEqual(len(service.findEventsBetween(userId, *window)), 1)
+            self.assertEqual(extendHorizon.call_count, 1)
+            # 超出已经物化的范围时仍然补齐
+            later = start + relativedelta(years=1)
+            service.findEventsBetween(userId, isoformat(later), isoformat(later + relativedelta(days=1)))
+            self.assertEqual(extendHorizon.call_count, 2)
+
+
+class OverlapTest(ServiceTestCase):
+    def test_longSyncedTime(self):
+        start = datetime.now(tz.gettz('UTC')).replace(hour=9, minute=0, second=0, microsecond=0) + relativedelta(days=10)
+        schedule = service.createSchedule(userId, 'event', f'{self.dateCode(start)} 9:00-10:00 UTC', '', '')
+        time = service.findTimesByScheduleId(schedule['id'], userId)[0]
+        # 客户端同步来的时间片可能比解析器生成的长
+        time.update(end=toUTCISOString(start + relativedelta(days=3)), version=time['version'] + 1)
+        service.sync(userId, [], [time], [], isoformat(datetime.now(tz.gettz('UTC'))))
+        windowStart = start + relativedelta(days=2)
+        events = service.findEventsBetween(userId, isoformat(windowStart), isoformat(windowStart + relativedelta(hours=12)))
+        self.assertEqual([event['id'] for event in events], [time['id']])
+
+
+class SearchTest(ServiceTestCase):
+    def test_findAllSchedules(self):
+        a = service.createSchedule(userId, 'Weekly Meeting', '2030/1/1 9:00-10:00 UTC', '', '')
+        b = service.createSchedule(userId, 'Meeting', '2030/1/1 9:00-10:00 UTC', '', '')
+        service.createSchedule(userId, 'Gym', '2030/1/1 9:00-10:00 UTC', '', '')
+        # 搜索词不区分大小写
+        conditions = service.FindAllSchedulesConditions({'search': 'MEETING', 'dateRange': None, 'type': None, 'star': None})
+        res = service.findAllSchedules(userId, conditions, 1, 20)
+        self.assertEqual(res['total'], 2)
+        self.assertEqual([schedule['id'] for schedule in res['data']], [b['id'], a['id']])
+        # 其他请求修改的 name 直接从数据库中搜索到
+        service.updateScheduleById(a['id'], userId, 'Standup', '2030/1/1 9:00-10:00 UTC', '', '')
+        res = service.findAllSchedules(userId, conditions, 1, 20)
+        self.assertEqual([schedule['id'] for schedule in res['data']], [b['id']])
+
+    def test_caseSensitiveLookup(self):
+        # PostgreSQL 上 icontains 生成 UPPER(...) LIKE，不能使用 gin_trgm_ops 索引
+        conditions = service.FindAllSchedulesConditions({'search': 'Meeting', 'dateRange': None, 'type': None, 'star': None})
+        lookups = [(child.lookup_name, child.rhs) for child in service.filterSchedules(userId, conditions).query.where.children
+                   if getattr(child, 'lhs', None) is not None and child.lhs.target.name == 'searchDocument']
+        self.assertEqual(lookups, [('contains', 'meeting')])
+
+
+class CursorPaginationTest(ServiceTestCase):
+    conditions = service.FindAllSchedulesConditions({'search': '', 'dateRange': None, 'type': None, 'star': None})
+
+    def findIds(self, after: str | None, pageSize: int) -> tuple[list[str], str | None]:
+        res = service.findSchedulesAfter(userId, self.conditions, after, pageSize)
+        return [schedule['id'] for schedule in res['data']], res['nextCursor']
+
+    def test_pages(self):
+        ids = [service.createSchedule(userId, f'schedule{i}', '2030/1/1 9:00-10:00 UTC', '', '')['id']
+               for i in range(5)]
+        # 同一时刻创建的 schedule 按 id 排序
+        created = datetime(2024, 1, 1, tzinfo=tz.gettz('UTC'))
+        Schedule.objects.filter(id__in=ids[1:4]).update(created=created)
+        expected = [schedule.id for schedule in Schedule.objects.order_by('created', 'id')]
+
+        pages = []
+        cursor = None
+        while True:
+            page, cursor = self.findIds(cursor, 2)
+            pages.append(page)
+            if cursor is None:
+                break
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertEqual([id for page in pages for id in page], expected)
+
+        page, cursor = self.findIds(None, 5)
+        self.assertEqual(page, expected)
+        self.assertIsNone(cursor)
+
+    def test_invalidCursor(self):
+        service.createSchedule(userId, 'schedule', '2030/1/1 9:00-10:00 UTC', '', '')
+
+        def encode(value) -> str:
+            return urlsafe_b64encode(json.dumps(value).encode()).decode()
+
+        for cursor in ['!', encode(['2024-01-01T00:00:00Z']), encode([1, 'id']), encode(['not a date', 'id']),
+                       encode(['2024-01-01T00:00:00Z', 1]), encode({'created': 1}), 1]:
+            with self.assertRaisesMessage(ValueError, 'invalid cursor'):
+                self.findIds(cursor, 2)
+
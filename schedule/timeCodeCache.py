@@ -0,0 +1,55 @@
+from threading import Lock
+
+from cachetools import LRUCache
+
+from schedule.timeCodeParserTypes import TimeCodeSem
+
+
+class TimeCodeCache:
+    """
+    单行时间码展开结果的 LRU 缓存
+
+    key: (规范化后的时间码, wkst, 当天日期)，只有依赖当天日期的行（tdy、tmr、省略年份）才带上日期，
+    跨过用户所在时区的零点后 key 不再命中，旧结果随 LRU 淘汰
+    value: times 为 tuple 的 TimeCodeSem，调用方不能修改
+
+    按缓存的时间片总数而不是行数限制大小，超过 maxOccurrences 的单行不缓存
+    """
+
+    def __init__(self, maxOccurrences: int = 100000):
+        # 没有时间片的行也占一个位置
+        self.cache = LRUCache(maxsize=maxOccurrences, getsizeof=lambda timeCodeSem: max(len(timeCodeSem.times), 1))
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple) -> TimeCodeSem | None:
+        with self.lock:
+            value = self.cache.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def set(self, key: tuple, value: TimeCodeSem):
+        with self.lock:
+            if self.cache.getsizeof(value) > self.cache.maxsize:
+                return
+            self.cache[key] = value
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self) -> dict:
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.cache),
+                'occurrences': self.cache.currsize,
+                'maxOccurrences': self.cache.maxsize,
+            }
@@ -0,0 +1,203 @@
+"""
+基于 NumPy 的批量时间片展开
+
+只处理最常见的 rrule：DAILY / WEEKLY（可带 byweekday）和不带 by 的 MONTHLY，支持 interval、count、until。
+所有时间片以 int64 epoch 秒的数组计算，时区偏移按时区的转换表批量查表。
+无法处理的规则（其他 by 条件、YEARLY、落在夏令时切换区间内的时间等）返回 None，由调用方回退到 dateutil。
+"""
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+import pytz
+from dateutil.rrule import DAILY, WEEKLY, MONTHLY
+
+from schedule.timeCodeParserTypes import TimeRangeObject
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+DAY = 86400
+# 1970-01-01 是星期四，weekday() == 3
+EPOCH_WEEKDAY = 3
+# 超过该天数的范围交给 dateutil，避免生成过大的候选数组
+MAX_SPAN_DAYS = 366 * 200
+SUPPORTED_KEYS = {'dtstart', 'until', 'freq', 'interval', 'count', 'byweekday', 'wkst'}
+
+
+@lru_cache(maxsize=256)
+def getTransitions(timeZone: str):
+    """
+    时区的转换表，以本地时间表示
+
+    :return: (los, his, offsets, lastTransition)
+             [los[i], his[i]) 为第 i 次转换前后偏移不同的本地时间区间，区间内的时间不存在或有歧义；
+             本地时间 t 的偏移为 offsets[已经过的 his 数量]；lastTransition 为最后一次转换的 UTC epoch 秒；
+             时区未知时返回 None
+    """
+    try:
+        zone = pytz.timezone(timeZone)
+    except pytz.UnknownTimeZoneError:
+        return None
+    if not hasattr(zone, '_utc_transition_times'):
+        # 固定偏移的时区
+        offset = int(zone.utcoffset(datetime(2000, 1, 1)).total_seconds())
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, np.array([offset], dtype=np.int64), None
+
+    offsets = np.array([int(info[0].total_seconds()) for info in zone._transition_info], dtype=np.int64)
+    # 第一个转换时间是 datetime.min，跳过
+    trans = np.array([int((t - datetime(1970, 1, 1)).total_seconds()) for t in zone._utc_transition_times[1:]],
+                     dtype=np.int64)
+    before = offsets[:-1]
+    after = offsets[1:]
+    los = trans + np.minimum(before, after)
+    his = trans + np.maximum(before, after)
+    lastTransition = int(trans[-1]) if len(trans) > 0 else None
+    return los, his, offsets, lastTransition
+
+
+def localToUTC(local, timeZone: str):
+    """
+    本地时间（epoch 秒，按 UTC 解释）批量转换为 UTC epoch 秒
+
+    :return: UTC epoch 秒的数组；有时间落在夏令时切换区间，或超出转换表范围时返回 None
+    """
+    transitions = getTransitions(timeZone)
+    if transitions is None:
+        return None
+    los, his, offsets, lastTransition = transitions
+    if len(los) > 0:
+        # 切换区间内的时间不存在或有歧义，交给 dateutil 处理
+        index = np.searchsorted(los, local, side='right') - 1
+        inWindow = (index >= 0) & (local < his[np.maximum(index, 0)])
+        if inWindow.any():
+            return None
+        # 仍在使用夏令时的时区，转换表之后的规则不在表里
+        if lastTransition is not None and lastTransition > datetime.now().timestamp() \
+                and local.max() > lastTransition:
+            return None
+    return local - offsets[np.searchsorted(his, local, side='right')]
+
+
+def weekdayOf(days):
+    return (days + EPOCH_WEEKDAY) % 7
+
+
+def expandDays(rruleConfig: dict):
+    """
+    按 rrule 规则展开日期，返回距 epoch 的天数数组；无法处理时返回 None
+    """
+    dtstart: datetime = rruleConfig['dtstart']
+    until: datetime | None = rruleConfig.get('until')
+    freq = rruleConfig.get('freq', DAILY)
+    interval = rruleConfig.get('interval') or 1
+    count = rruleConfig.get('count')
+    byweekday = rruleConfig.get('byweekday')
+    wkst = rruleConfig.get('wkst')
+
+    if until is None or interval < 1 or (count is not None and count < 1):
+        return None
+    start = (dtstart - datetime(1970, 1, 1)).days
+    end = (until - datetime(1970, 1, 1)).days
+    if end - start > MAX_SPAN_DAYS:
+        return None
+    if end < start:
+        return np.array([], dtype=np.int64)
+
+    weekdays = None
+    if byweekday is not None:
+        # 带 n 的 weekday（如 +1MO）只在 MONTHLY/YEARLY 中有意义
+        if any(day.n is not None for day in byweekday):
+            return None
+        weekdays = np.array(sorted({day.weekday for day in byweekday}), dtype=np.int64)
+
+    if freq == DAILY:
+        days = np.arange(start, end + 1, interval, dtype=np.int64)
+        if weekdays is not None:
+            days = days[np.isin(weekdayOf(days), weekdays)]
+    elif freq == WEEKLY:
+        if weekdays is None:
+            weekdays = np.array([dtstart.weekday()], dtype=np.int64)
+        weekStart = wkst.weekday if wkst is not None else 0
+        days = np.arange(start, end + 1, dtype=np.int64)
+        # 以 wkst 对齐的周为周期
+        periodStart = days - (weekdayOf(days) - weekStart) % 7
+        firstPeriod = start - (weekdayOf(start) - weekStart) % 7
+        keep = (((periodStart - firstPeriod) // 7) % interval == 0) & np.isin(weekdayOf(days), weekdays)
+        days = days[keep]
+    elif freq == MONTHLY:
+        if weekdays is not None:
+            return None
+        firstMonth = dtstart.year * 12 + dtstart.month - 1
+        lastMonth = until.year * 12 + until.month - 1
+        months = np.arange(firstMonth, lastMonth + 1, interval, dtype=np.int64)
+        monthStarts = (months - 1970 * 12).astype('datetime64[M]')
+        candidates = monthStarts.astype('datetime64[D]') + (dtstart.day - 1)
+        # 没有该日期的月份跳过，如 2 月 30 日
+        valid = candidates.astype('datetime64[M]') == monthStarts
+        days = candidates[valid].astype(np.int64)
+        days = days[(days >= start) & (days <= end)]
+    else:
+        return None
+
+    if count is not None:
+        days = days[:count]
+    return days
+
+
+def isSupported(rruleConfig: dict) -> bool:
+    return np is not None and all(key in SUPPORTED_KEYS or value is None for key, value in rruleConfig.items())
+
+
+def expandLastDate(rruleConfig: dict) -> datetime | None:
+    """
+    批量展开日期，返回 rrule 的最后一个日期；没有日期或无法处理时返回 None
+    """
+    if not isSupported(rruleConfig):
+        return None
+    days = expandDays(rruleConfig)
+    if days is None or len(days) == 0:
+        return None
+    return datetime(1970, 1, 1) + timedelta(days=int(days[-1]))
+
+
+def expandOccurrences(rruleConfig: dict, timeRangeObj: TimeRangeObject, timeZone: str):
+    """
+    批量展开时间片
+
+    :param rruleConfig: 传给 dateutil rrule 的参数
+    :return: (starts, ends)，UTC epoch 秒的 int64 数组，todo 的 starts 为 None；无法处理时返回 None
+    """
+    if not isSupported(rruleConfig):
+        return None
+
+    days = expandDays(rruleConfig)
+    if days is None:
+        return None
+    if len(days) == 0:
+        empty = np.array([], dtype=np.int64)
+        return (empty if timeRangeObj.start is not None else None), empty
+
+    base = days * DAY
+    end = timeRangeObj.end
+    endLocal = base + end.hour * 3600 + end.minute * 60
+    startLocal = None
+    if timeRangeObj.start is not None:
+        start = timeRangeObj.start
+        # 如果 start.hour > end.hour，说明跨天了
+        if start.hour > end.hour:
+            endLocal = endLocal + DAY
+        startLocal = base + start.hour * 3600 + start.minute * 60
+
+    ends = localToUTC(endLocal, timeZone)
+    if ends is None:
+        return None
+    starts = None
+    if startLocal is not None:
+        starts = localToUTC(startLocal, timeZone)
+        if starts is None:
+            return None
+    return starts, ends
+
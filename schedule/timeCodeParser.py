@@ -1,4 +1,6 @@
+import heapq
 import re
+from typing import Iterator
 
 import dateutil
 from dateutil import tz
@@ -7,49 +9,115 @@ from datetime import datetime
 
 from dateutil.rrule import DAILY, WEEKLY, MONTHLY, YEARLY, weekdays, weekday, MO, TU, WE, TH, FR, SA, SU, rrule
 
+from schedule.timeCodeCache import TimeCodeCache
+from schedule.timeCodeExpander import expandOccurrences, expandLastDate
 from schedule.timeCodeParserTypes import (EventType, DateRangeObject, TimeRangeObject, TimeUnit, TimeRange,
                                           FreqObject, ByObject, TimeCodeLex, TimeCodeSem, TimeCodeParseResult,
-                                          TimeCodeDao, DateUnit)
-from setting.service import getSettingByPath
-from utils.timeZone import isValidTimeZone, getTimeZoneAbbrMap
-from utils.utils import intersection, difference
-
-timeZoneAbbrMap = getTimeZoneAbbrMap()
+                                          TimeCodeDao, DateUnit, ParserSettings, TimeCodeStream, TimeCodeSyntaxError,
+                                          packMarks)
+from setting.service import getSettingsSnapshot
+from utils.timeZone import resolveTimeZone
+from utils.utils import keyedIntersection, keyedDifference
+
+# 单行时间码展开结果的缓存，同一 worker 内共享，最多缓存的时间片总数
+TIME_CODE_CACHE_OCCURRENCES = 100000
+timeCodeCache = TimeCodeCache(maxOccurrences=TIME_CODE_CACHE_OCCURRENCES)
+
+# 常见规则使用 NumPy 批量展开，不支持的规则回退到 dateutil
+VECTORIZED_EXPANSION = True
+
+# 解析器需要的全部设置
+PARSER_SETTING_PATHS = ['rrule.timeZone', 'rrule.wkst']
+
+
+def loadParserSettings(userId: str) -> ParserSettings:
+    """
+    每个请求只读取一次设置，之后在 lex / sem 解析中传递
+    """
+    settings = getSettingsSnapshot(userId, PARSER_SETTING_PATHS)
+    return ParserSettings(timeZone=settings['rrule.timeZone'], wkst=settings['rrule.wkst'])
+
+
+# 时间码的文法，所有模式只编译一次，每个字段只匹配一次
+#
+# line  := date time [option]{0,3}，字段之间用空白分隔
+# date  := day ['-' day]，day := [[yyyy '/'] m '/'] d | 'tdy' | 'tmr'
+# time  := side ['-' side]，side := 'start' | 's' | 'end' | 'e' | hh [(':' | '.') mm]，hh / mm 可以为空或 '?'
+# option:= freq [',' ('i' | 'c') n]* | 'by[' clause [',' clause]* ']' | 时区或时区缩写
+FIELD_PATTERN = re.compile(r'\S+')
+DATE_DAY = r'(?:(?:(?:(?P<{0}Year>\d+)/)?(?P<{0}Month>\d+)/)?(?P<{0}Day>\d+)|(?P<{0}Sugar>tdy|tmr))'
+DATE_PATTERN = re.compile(rf'(?P<start>{DATE_DAY.format("start")})(?:-(?P<until>{DATE_DAY.format("until")}))?')
+TIME_SIDE = r'(?:(?P<{0}Sugar>start|end|s|e)|(?P<{0}Hour>\d*|\?)(?:(?P<{0}Sep>[:.])(?P<{0}Min>\d*|\?))?)'
+TIME_PATTERN = re.compile(rf'(?:(?P<start>{TIME_SIDE.format("start")})-)?(?P<end>{TIME_SIDE.format("end")})')
+FREQ_PATTERN = re.compile(r'(?P<freq>daily|weekly|monthly|yearly)(?=,|$)')
+FREQ_ARG_PATTERN = re.compile(r',(?P<arg>(?P<kind>[ic])?(?P<value>-?\d+)?[^,]*)')
+BY_CLAUSE_PATTERN = re.compile(r'(?P<key>month|weekno|yearday|monthday|day|setpos)\[(?P<values>-?\d+(?:,-?\d+)*)\]')
+
+DATE_GROUPS = [(side, (f'{side}Year', f'{side}Month', f'{side}Day', f'{side}Sugar')) for side in ['start', 'until']]
+TIME_GROUPS = {side: (f'{side}Sugar', f'{side}Hour', f'{side}Sep', f'{side}Min') for side in ['start', 'end']}
+
+FREQS = {
+    'daily': DAILY,
+    'weekly': WEEKLY,
+    'monthly': MONTHLY,
+    'yearly': YEARLY,
+}
+TIME_SUGAR = {
+    'start': ('0', '0'),
+    's': ('0', '0'),
+    'end': ('23', '59'),
+    'e': ('23', '59'),
+}
+
+
+def matchDateRange(settings: ParserSettings, dateRange: str) -> tuple[DateRangeObject, str, bool]:
+    """
+    :return: (DateRangeObject, 展开 tdy / tmr 后的日期, 是否依赖于当天日期)
+    """
+    match = DATE_PATTERN.fullmatch(dateRange)
+    if match is None:
+        raise TimeCodeSyntaxError(f'invalid date: {dateRange}')
+
+    values = []
+    texts = []
+    relative = False
+    for side, groups in DATE_GROUPS:
+        text, year, month, day, sugar = match.group(side, *groups)
+        if text is None:
+            continue
+        if sugar is not None:
+            now = settings.localNow() + relativedelta(days=1) if sugar == 'tmr' else settings.localNow()
+            values.append({'year': now.year, 'month': now.month, 'day': now.day})
+            texts.append(now.strftime('%Y/%m/%d'))
+            relative = True
+        else:
+            values.append({
+                'year': int(year) if year is not None else None,
+                'month': int(month) if month is not None else None,
+                'day': int(day),
+            })
+            texts.append(text)
 
+    # tdy / tmr 或省略年份时，解析结果依赖于当天日期
+    relative = relative or values[0]['year'] is None
+    return buildDateRange(settings, *values), '-'.join(texts), relative
 
-def parseDateRange(userId, dateRange: str) -> DateRangeObject:
-    def parseDate(date: str) -> {int | None, int | None, int | None}:
-        """
-        日期格式：
-        yyyy/m/d
-        m/d
-        d
-        """
-        dateList: list[str | None] = date.split('/')
-        if len(dateList) > 3 or len(dateList) < 1:
-            raise ValueError(f'invalid date: {date}')
-        while len(dateList) < 3:
-            dateList.insert(0, None)
-        year, month, day = map(lambda x: int(x) if x is not None else None, dateList)
-        return {'year': year, 'month': month, 'day': day}
 
+def buildDateRange(settings: ParserSettings, dtstart: dict, until: dict | None = None) -> DateRangeObject:
     res: DateRangeObject = DateRangeObject(DateUnit())
-    if '-' in dateRange:
-        [dtstart, until] = map(parseDate, dateRange.split('-'))
+    if until is not None:
         for key, value in until.items():
             if value is None:
                 until[key] = dtstart[key]
         res.dtstart = DateUnit(**dtstart)
         res.until = DateUnit(**until)
     else:
-        dtstart = parseDate(dateRange)
         res.dtstart = DateUnit(**dtstart)
     if res.dtstart.year is None:
-        print(getSettingByPath(userId, 'rrule.timeZone'))
-        now = datetime.now().astimezone(tz.gettz(getSettingByPath(userId, 'rrule.timeZone')))
+        now = settings.localNow()
         # 如果 dtstart 没有年份，且 dtstart < now，则 dtstart 的年份为下一年
-        if (res.dtstart.month is not None and res.dtstart.month < now.month
-                and res.dtstart.day is not None and res.dtstart.day < now.day):
+        if (res.dtstart.month is not None and res.dtstart.day is not None
+                and (res.dtstart.month, res.dtstart.day) < (now.month, now.day)):
             res.dtstart.year = now.year + 1
         else:
             res.dtstart.year = now.year
@@ -61,222 +129,224 @@ def parseDateRange(userId, dateRange: str) -> DateRangeObject:
     return res
 
 
-def parseTimeRange(timeRange: str) -> TimeRangeObject:
-    def splitTime(time: str) -> list[str]:
+def parseDateRange(settings: ParserSettings, dateRange: str) -> DateRangeObject:
+    """
+    日期格式：
+    yyyy/m/d
+    m/d
+    d
+    """
+    return matchDateRange(settings, dateRange)[0]
+
+
+def matchTimeRange(timeRange: str) -> tuple[TimeRangeObject, str]:
+    """
+    :return: (TimeRangeObject, 展开 s / e / . 后的时间)
+    """
+    match = TIME_PATTERN.fullmatch(timeRange)
+    if match is None:
+        raise TimeCodeSyntaxError(f'invalid time range: {timeRange}')
+
+    def side(name: str) -> tuple[str, str, str]:
         """
         时间格式：
-        hh: mm
+        hh:mm
         hh
         hh:
         :mm
         :
+
+        :return: (hh, mm, 展开后的文本)
         """
-        timeList: list[str] = time.split(':')
-        if len(timeList) > 2 or len(timeList) < 1:
-            raise ValueError(f'invalid time: {time}')
-        while len(timeList) < 2:
-            timeList.append('0')
-        return timeList
+        sugar, hour, sep, minute = match.group(*TIME_GROUPS[name])
+        if sugar is not None:
+            hour, minute = TIME_SUGAR[sugar]
+            return hour, minute, f'{hour}:{minute}'
+        if sep is None:
+            return hour, '0', hour
+        return hour, minute, f'{hour}:{minute}'
 
     res: TimeRangeObject = TimeRangeObject()
     startMark = 0b11
     endMark = 0b11
-    if '-' in timeRange:
-        start, end = timeRange.split('-')
-        [startHour, startMin] = splitTime(start)
-        [endHour, endMin] = splitTime(end)
-        if '?' in startHour or len(startHour) == 0:
+    endHour, endMin, endText = side('end')
+    if match.group('start') is not None:
+        startHour, startMin, startText = side('start')
+        text = f'{startText}-{endText}'
+        if startHour == '?' or len(startHour) == 0:
             startMark &= 0b01
             startHour = '0'
-        if '?' in startMin or len(startMin) == 0:
+        if startMin == '?' or len(startMin) == 0:
             startMark &= 0b10
             startMin = '0'
-        if '?' in endHour or len(endHour) == 0:
+        if endHour == '?' or len(endHour) == 0:
             endMark &= 0b01
             endHour = '0'
-        if '?' in endMin or len(endMin) == 0:
+        if endMin == '?' or len(endMin) == 0:
             endMark &= 0b10
             endMin = '0'
         if startMark == 0b01 or endMark == 0b01:
-            raise ValueError(f'invalid time range: {timeRange}')
+            raise TimeCodeSyntaxError(f'invalid time range: {text}')
         if (startMark | endMark) >> 1 == 0b1:
             res.start = TimeUnit(int(startHour), int(startMin))
             res.end = TimeUnit(int(endHour), int(endMin))
         else:
-            raise ValueError(f'invalid time range: {timeRange}')
+            raise TimeCodeSyntaxError(f'invalid time range: {text}')
     else:
-        [endHour, endMin] = splitTime(timeRange)
-        if '?' in endHour or '?' in endMin:
-            raise ValueError(f'invalid time: {timeRange}')
+        text = endText
+        if endHour == '?' or endMin == '?' or len(endHour) == 0 or len(endMin) == 0:
+            raise TimeCodeSyntaxError(f'invalid time: {text}')
         res.end = TimeUnit(int(endHour), int(endMin))
 
     # bin 转为二进制字符串，[2:] 去掉 0b 前缀，zfill(2) 补齐两位
     res.startMark = bin(startMark)[2:].zfill(2)
     res.endMark = bin(endMark)[2:].zfill(2)
-    return res
+    return res, text
 
 
-def parseFreq(freqCode: str) -> FreqObject:
-    res = FreqObject()
-    freq: str
-    if ',' in freqCode:
-        _freq, *args = freqCode.split(',')
-        freq = _freq
-        for arg in args:
-            if arg[0] == 'i':
-                # 是 interval
-                try:
-                    interval = int(arg[1:])
-                except ValueError:
-                    raise ValueError(f'invalid interval: {arg}')
-                if interval < 0:
-                    raise ValueError(f'invalid interval: {arg}')
-                res.interval = interval
-            elif arg[0] == 'c':
-                # 是 count
-                try:
-                    count = int(arg[1:])
-                except ValueError:
-                    raise ValueError(f'invalid count: {arg}')
-                if count < 0:
-                    raise ValueError(f'invalid count: {arg}')
-                res.count = count
-            else:
-                raise ValueError(f'invalid option: {args}')
-    else:
-        # 是 freq
-        freq = freqCode
-
-    rruleFreq: int
-    if freq == 'daily':
-        rruleFreq = DAILY
-    elif freq == 'weekly':
-        rruleFreq = WEEKLY
-    elif freq == 'monthly':
-        rruleFreq = MONTHLY
-    elif freq == 'yearly':
-        rruleFreq = YEARLY
-    else:
-        raise ValueError(f'invalid freq: {freq}')
-    res.freq = rruleFreq
-
+def parseTimeRange(timeRange: str) -> TimeRangeObject:
+    return matchTimeRange(timeRange)[0]
+
+
+def matchFreq(freqCode: str) -> FreqObject:
+    match = FREQ_PATTERN.match(freqCode)
+    if match is None:
+        raise TimeCodeSyntaxError(f'invalid freq: {freqCode}')
+    res = FreqObject(freq=FREQS[match.group('freq')])
+    pos = match.end()
+    while pos < len(freqCode):
+        argMatch = FREQ_ARG_PATTERN.match(freqCode, pos)
+        arg = argMatch.group('arg')
+        kind = argMatch.group('kind')
+        if kind is None:
+            raise TimeCodeSyntaxError(f'invalid option: {arg}', argMatch.start('arg'))
+        if argMatch.group('value') is None or argMatch.end('value') != argMatch.end() \
+                or int(argMatch.group('value')) < 0:
+            name = 'interval' if kind == 'i' else 'count'
+            raise TimeCodeSyntaxError(f'invalid {name}: {arg}', argMatch.start('arg'))
+        if kind == 'i':
+            # 是 interval
+            res.interval = int(argMatch.group('value'))
+        else:
+            # 是 count
+            res.count = int(argMatch.group('value'))
+        pos = argMatch.end()
     return res
 
 
-def getWeekdayOffset(userId: str) -> int:
+def parseFreq(freqCode: str) -> FreqObject:
+    return matchFreq(freqCode)
+
+
+def matchByClauses(byCode: str) -> dict[str, list[int]]:
+    """
+    by[day[1,2],month[3]] 解析为 {'day': [1, 2], 'month': [3]}，weekday 的换算依赖于 wkst，在构造 rrule 时进行
+    """
+    if not byCode.startswith('by[') or not byCode.endswith(']'):
+        raise TimeCodeSyntaxError(f'invalid by: {byCode}')
+    clauses: dict[str, list[int]] = {}
+    pos = len('by[')
+    end = len(byCode) - 1
+    while True:
+        match = BY_CLAUSE_PATTERN.match(byCode, pos, end)
+        if match is None:
+            raise TimeCodeSyntaxError(f'invalid by: {byCode}', pos)
+        clauses[match.group('key')] = list(map(int, match.group('values').split(',')))
+        pos = match.end()
+        if pos == end:
+            return clauses
+        if byCode[pos] != ',':
+            raise TimeCodeSyntaxError(f'invalid by: {byCode}', pos)
+        pos += 1
+
+
+def getWeekdayOffset(settings: ParserSettings) -> int:
     weekdays = ['MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU']
-    return weekdays.index(getSettingByPath(userId, 'rrule.wkst'))
+    return weekdays.index(settings.wkst)
 
 
-def parseBy(userId, byCode: str) -> ByObject:
-    bys = ['month', 'weekno', 'yearday', 'monthday', 'day', 'setpos']
+def buildBy(settings: ParserSettings, clauses: dict[str, list[int]]) -> ByObject:
     res = ByObject()
-    for by in bys:
-        index = byCode.find(by)
-        if index != -1:
-            value = byCode[index + len(by) + 1:byCode.find(']', index)]
-            if by != 'day':
-                res.__setattr__(f'by{by}', list(map(int, value.split(','))))
-            else:
-                choices = list(map(int, value.split(',')))
-                offset = getWeekdayOffset(userId)
-                byweekday = list(map(lambda choice: weekdays[choice - 1 + offset], choices))
-                if byweekday[0] is not None and len(byweekday) > 0:
-                    res.byweekday = byweekday
-                else:
-                    raise ValueError(f'invalid byday: {value}')
-    return res
-
-
-def dateSugar(userId: str, date: str) -> str:
-    def repl(match):
-        if match.group(0) == 'tdy':
-            return datetime.now().astimezone(tz.gettz(getSettingByPath(userId, 'rrule.timeZone'))).strftime('%Y/%m/%d')
-        elif match.group(0) == 'tmr':
-            return (datetime.now() + relativedelta(days=1)).astimezone(
-                tz.gettz(getSettingByPath(userId, 'rrule.timeZone'))).strftime('%Y/%m/%d')
-
-    date = re.sub(r'tdy|tmr', repl, date)
-    return date
-
-
-def timeSugar(time: str) -> str:
-    def repl(match):
-        if match.group(0) == 'start' or match.group(0) == 's':
-            return ('0:0')
-        elif match.group(0) == 'end' or match.group(0) == 'e':
-            return ('23:59')
+    for by, choices in clauses.items():
+        if by != 'day':
+            res.__setattr__(f'by{by}', choices)
         else:
-            return ':'
-
-    time = re.sub(r'start|end|s|e|\.', repl, time)
-    return time
+            offset = getWeekdayOffset(settings)
+            res.byweekday = list(map(lambda choice: weekdays[choice - 1 + offset], choices))
+    return res
 
 
-def parseTimeCodeLex(userId: str, timeCode: str) -> TimeCodeLex:
-    timeCode = timeCode.strip()
-    codes = timeCode.split()  # split 默认忽略连续空格
-    if 2 <= len(codes) <= 5:
-        [date, time, *options] = codes
-
-        date = dateSugar(userId, date)
-        time = timeSugar(time)
-
-        freq = ['daily', 'weekly', 'monthly', 'yearly']
-        optionsMark = {
-            'timeZone': 0,
-            'freq': 0,
-            'by': 0,
-        }
-        timeZone = getSettingByPath(userId, 'rrule.timeZone')
-        freqCode: str | None = None
-        byCode: str | None = None
-        while len(options) > 0:
-            code: str = options.pop(0)
-            if code.find('by[') == 0:
+def parseBy(settings: ParserSettings, byCode: str) -> ByObject:
+    return buildBy(settings, matchByClauses(byCode))
+
+
+def fieldColumn(timeCode: str, index: int) -> int:
+    """
+    第 index 个字段的起始列，只在报错时计算
+    """
+    for i, match in enumerate(FIELD_PATTERN.finditer(timeCode)):
+        if i == index:
+            return match.start()
+    return 0
+
+
+def parseTimeCodeLex(settings: ParserSettings, timeCode: str) -> TimeCodeLex:
+    fields = timeCode.split()
+    if not 2 <= len(fields) <= 5:
+        raise TimeCodeSyntaxError('time code error', fieldColumn(timeCode, 5) if len(fields) > 5 else 0)
+
+    timeZone = settings.timeZone
+    timeZoneCode: str | None = None
+    freqCode: str | None = None
+    freqObj: FreqObject | None = None
+    byCode: str | None = None
+    byClauses: dict[str, list[int]] | None = None
+    # 各字段内的错误先按字段内的列号抛出，再加上字段的起始列
+    index = 0
+    try:
+        dateRangeObj, date, relative = matchDateRange(settings, fields[0])
+        index = 1
+        timeRangeObj, time = matchTimeRange(fields[1])
+        for index in range(2, len(fields)):
+            code = fields[index]
+            if code.startswith('by['):
                 # 是 by 函数
-                optionsMark['by'] += 1
+                if byCode is not None:
+                    raise TimeCodeSyntaxError('invalid time code options')
                 byCode = code
-            elif code in freq or code.split(',')[0] in freq:
+                byClauses = matchByClauses(code)
+            elif FREQ_PATTERN.match(code) is not None:
                 # 是 freq + 参数 或 freq
-                optionsMark['freq'] += 1
+                if freqCode is not None:
+                    raise TimeCodeSyntaxError('invalid time code options')
                 freqCode = code
+                freqObj = matchFreq(code)
             else:
-                # 是时区
-                if isValidTimeZone(code):
-                    optionsMark['timeZone'] += 1
-                    timeZone = code
-                else:
-                    # 是时区缩写
-                    if code in timeZoneAbbrMap:
-                        optionsMark['timeZone'] += 1
-                        # 从缩写转换为完整的时区，直接选第一个
-                        timeZone = list(timeZoneAbbrMap[code])[0]
-                    # 是非法内容
-                    else:
-                        raise ValueError(f'invalid time code options: {code}')
-
-        # 如果有超过两次的
-        for key, value in optionsMark.items():
-            if value > 1:
-                raise ValueError('invalid time code options')
-
-        newTimeCode = f'{date} {time} {timeZone}{f" {freqCode}" if freqCode is not None else ""}{f" {byCode}" if byCode is not None else ""}'
-
-        # 开始解析每个部分
-        dateRangeObj = parseDateRange(userId, date)
-        timeRangeObj = parseTimeRange(time)
-        eventType = EventType.EVENT
-        if timeRangeObj.start is None:
-            eventType = EventType.TODO
-
-        return TimeCodeLex(eventType, dateRangeObj, timeRangeObj, timeZone, freqCode, byCode, newTimeCode)
-    else:
-        raise ValueError('time code error')
-
-
-def getWKST(userId: str) -> weekday:
-    weekStart = getSettingByPath(userId, 'rrule.wkst')
+                # 是时区或时区缩写，缩写转换为完整的时区
+                resolved = resolveTimeZone(code)
+                # 是非法内容
+                if resolved is None:
+                    raise TimeCodeSyntaxError(f'invalid time code options: {code}')
+                if timeZoneCode is not None:
+                    raise TimeCodeSyntaxError('invalid time code options')
+                timeZoneCode = code
+                timeZone = resolved
+    except TimeCodeSyntaxError as e:
+        e.column += fieldColumn(timeCode, index)
+        raise
+
+    newTimeCode = f'{date} {time} {timeZone}{f" {freqCode}" if freqCode is not None else ""}{f" {byCode}" if byCode is not None else ""}'
+
+    eventType = EventType.EVENT
+    if timeRangeObj.start is None:
+        eventType = EventType.TODO
+
+    return TimeCodeLex(eventType, dateRangeObj, timeRangeObj, timeZone, freqCode, byCode, newTimeCode, relative,
+                       freqObj, byClauses)
+
+
+def getWKST(settings: ParserSettings) -> weekday:
+    weekStart = settings.wkst
     if weekStart == 'MO':
         return MO
     elif weekStart == 'TU':
@@ -295,20 +365,22 @@ def getWKST(userId: str) -> weekday:
         raise ValueError(f'Unknown wkst: {weekStart}')
 
 
-def parseTimeCodeSem(
-        userId: str,
+def buildRRule(
+        settings: ParserSettings,
         dateRangeObj: DateRangeObject,
-        timeRangeObj: TimeRangeObject,
-        timeZone: str,
-        freqCode: str | None,
-        byCode: str | None) -> TimeCodeSem:
-    times: list[TimeRange] = []
+        freqObj: FreqObject | None,
+        byClauses: dict[str, list[int]] | None) -> tuple[dict, rrule]:
+    """
+    只构造 rrule，不展开时间片
+
+    :return: (传给 rrule 的参数, rrule)
+    """
     rruleConfig = {}
-    dtstart = datetime(**dateRangeObj.dtstart.__dict__)
+    dtstart = datetime(dateRangeObj.dtstart.year, dateRangeObj.dtstart.month, dateRangeObj.dtstart.day)
     rruleConfig['dtstart'] = dtstart
     until: datetime | None = None
     if dateRangeObj.until is not None:
-        until = datetime(**dateRangeObj.until.__dict__)
+        until = datetime(dateRangeObj.until.year, dateRangeObj.until.month, dateRangeObj.until.day)
         rruleConfig['until'] = until
     # 默认 daily
     rruleConfig['freq'] = DAILY
@@ -316,75 +388,153 @@ def parseTimeCodeSem(
     if until is None:
         rruleConfig['count'] = 1
 
-    if freqCode is not None and dateRangeObj.until is not None:
-        freqObj = parseFreq(freqCode)
-        rruleConfig = {**rruleConfig, **freqObj.__dict__}
-    if byCode is not None and dateRangeObj.until is not None:
-        byObj = parseBy(userId, byCode)
+    if freqObj is not None and dateRangeObj.until is not None:
+        # 未指定的 interval / count 使用 rrule 的默认值
+        rruleConfig = {**rruleConfig, **{key: value for key, value in freqObj.__dict__.items() if value is not None}}
+    if byClauses is not None and dateRangeObj.until is not None:
+        byObj = buildBy(settings, byClauses)
         rruleConfig = {**rruleConfig, **byObj.__dict__}
     # wkst
-    rruleConfig['wkst'] = getWKST(userId)
-
-    # rrule
-    rrule = dateutil.rrule.rrule(**rruleConfig)
-
-    for t in rrule:
+    rruleConfig['wkst'] = getWKST(settings)
+
+    return rruleConfig, dateutil.rrule.rrule(**rruleConfig)
+
+
+# 批量展开的结果每次转换为 TimeRange 的数量
+EXPANSION_CHUNK_SIZE = 1024
+
+
+def iterOccurrences(rruleConfig: dict, rruleObject: rrule, timeRangeObj: TimeRangeObject,
+                    timeZone: str) -> Iterator[TimeRange]:
+    """
+    按时间顺序逐个生成时间片，不保存完整的列表
+    """
+    marks = packMarks(timeRangeObj.startMark, timeRangeObj.endMark)
+    if VECTORIZED_EXPANSION:
+        expanded = expandOccurrences(rruleConfig, timeRangeObj, timeZone)
+        if expanded is not None:
+            starts, ends = expanded
+            # epoch 秒的数组很紧凑，分块转换为 TimeRange
+            for i in range(0, len(ends), EXPANSION_CHUNK_SIZE):
+                endList = ends[i:i + EXPANSION_CHUNK_SIZE].tolist()
+                startList = starts[i:i + EXPANSION_CHUNK_SIZE].tolist() if starts is not None else [None] * len(endList)
+                for start, end in zip(startList, endList):
+                    yield TimeRange.fromEpoch(start, end, marks)
+            return
+
+    endUnit = timeRangeObj.end
+    startUnit = timeRangeObj.start
+    for t in rruleObject:
         # t 是 UTC 时区的，更改时区，但不改变时间的值
         tAtTimeZone = t.replace(tzinfo=tz.gettz(timeZone))
         start: datetime | None = None
-        end = tAtTimeZone.replace(**timeRangeObj.end.__dict__)
-        if timeRangeObj.start is not None:
+        end = tAtTimeZone.replace(hour=endUnit.hour, minute=endUnit.minute)
+        if startUnit is not None:
             # 如果 start.hour > end.hour，说明跨天了
-            if timeRangeObj.start.hour > timeRangeObj.end.hour:
-                end = (tAtTimeZone + relativedelta(days=1)).replace(**timeRangeObj.end.__dict__)
-            start = tAtTimeZone.replace(**timeRangeObj.start.__dict__)
-
-        # 转换成 UTC 时区
-        start = start.astimezone(tz.gettz('UTC')) if start is not None else start
-        end = end.astimezone(tz.gettz('UTC'))
-
-        if end.isoformat() is not None:
-            times.append(TimeRange(**{
-                **timeRangeObj.__dict__,
-                'start': start.isoformat() if start is not None else start,
-                'end': end.isoformat()
-            }))
-        else:
-            raise ValueError('The value of end is invalid')
+            if startUnit.hour > endUnit.hour:
+                end = (tAtTimeZone + relativedelta(days=1)).replace(hour=endUnit.hour, minute=endUnit.minute)
+            start = tAtTimeZone.replace(hour=startUnit.hour, minute=startUnit.minute)
 
-    return TimeCodeSem(times=times, rruleObject=rrule)
+        # 直接保存 UTC epoch 秒，ISO 字符串在写库时才生成
+        yield TimeRange.fromEpoch(int(start.timestamp()) if start is not None else None, int(end.timestamp()), marks)
 
 
-def timeCodeParser(userId, timeCode: str) -> TimeCodeParseResult:
+def parseTimeCodeSem(
+        settings: ParserSettings,
+        dateRangeObj: DateRangeObject,
+        timeRangeObj: TimeRangeObject,
+        timeZone: str,
+        freqCode: str | None,
+        byCode: str | None) -> TimeCodeSem:
+    rruleConfig, rruleObject = buildRRule(settings, dateRangeObj,
+                                          parseFreq(freqCode) if freqCode is not None else None,
+                                          matchByClauses(byCode) if byCode is not None else None)
+    times = list(iterOccurrences(rruleConfig, rruleObject, timeRangeObj, timeZone))
+    return TimeCodeSem(times=times, rruleObject=rruleObject)
+
+
+def expandTimeCodeLex(settings: ParserSettings, timeCodeLex: TimeCodeLex) -> TimeCodeSem:
+    """
+    直接使用语法树中已经解析的 freq / by，不再重新扫描字符串
+    """
+    rruleConfig, rruleObject = buildRRule(settings, timeCodeLex.dateRangeObject, timeCodeLex.freqObject,
+                                          timeCodeLex.byClauses)
+    times = list(iterOccurrences(rruleConfig, rruleObject, timeCodeLex.timeRangeObject, timeCodeLex.timeZone))
+    return TimeCodeSem(times=times, rruleObject=rruleObject)
+
+
+def getCacheKey(settings: ParserSettings, timeCodeLex: TimeCodeLex) -> tuple:
+    today: str | None = None
+    if timeCodeLex.relative:
+        today = settings.localNow().strftime('%Y/%m/%d')
+    return timeCodeLex.newTimeCode, settings.wkst, today
+
+
+def compileTimeCodeLine(settings: ParserSettings, timeCodeLex: TimeCodeLex) -> TimeCodeSem:
+    """
+    展开单行时间码，优先使用缓存
+    """
+    key = getCacheKey(settings, timeCodeLex)
+    timeCodeSem = timeCodeCache.get(key)
+    if timeCodeSem is None:
+        timeCodeSem = expandTimeCodeLex(settings, timeCodeLex)
+        timeCodeSem.times = tuple(timeCodeSem.times)
+        timeCodeCache.set(key, timeCodeSem)
+    return timeCodeSem
+
+
+def splitTimeCodeLines(timeCode: str) -> list[str]:
     timeCode = timeCode.strip()
     # 去除 \n \t \r 等符号
     timeCode = re.sub(r'\n\t\r', '', timeCode)
-    lines = timeCode.split(';')
+    return [line for line in timeCode.split(';') if len(line) > 0]
+
+
+def lexTimeCodeLine(settings: ParserSettings, line: str, index: int) -> TimeCodeLex:
+    """
+    解析多行时间码中的一行，语法错误带上行号
+    """
+    try:
+        return parseTimeCodeLex(settings, line)
+    except TimeCodeSyntaxError as e:
+        e.line = index
+        raise
+
+
+def timeCodeParser(settings: ParserSettings, timeCode: str) -> TimeCodeParseResult:
+    lines = splitTimeCodeLines(timeCode)
 
     eventType: EventType | None = None
     times: list[TimeRange] = []
     rruleObjects: list[rrule] = []
     newTimeCodes: list[str] = []
-    for line in lines:
-        if len(line) == 0:
-            continue
-        timeCodeLex = parseTimeCodeLex(userId, line)
+    timeCodeSems: dict[str, TimeCodeSem] = {}
+    relative = False
+    for index, line in enumerate(lines):
+        timeCodeLex = lexTimeCodeLine(settings, line, index)
 
         if eventType is not None and eventType != timeCodeLex.eventType:
             raise ValueError('The event type of each line must be the same')
         eventType = timeCodeLex.eventType
         newTimeCodes.append(timeCodeLex.newTimeCode)
-        timeCodeSem = parseTimeCodeSem(userId, timeCodeLex.dateRangeObject, timeCodeLex.timeRangeObject,
-                                       timeCodeLex.timeZone, timeCodeLex.freqCode, timeCodeLex.byCode)
+        timeCodeSem = compileTimeCodeLine(settings, timeCodeLex)
         times.extend(timeCodeSem.times)
         rruleObjects.append(timeCodeSem.rruleObject)
+        timeCodeSems[timeCodeLex.newTimeCode] = timeCodeSem
+        relative = relative or timeCodeLex.relative
 
-    return TimeCodeParseResult(eventType, times, rruleObjects, newTimeCodes)
+    return TimeCodeParseResult(eventType, times, rruleObjects, newTimeCodes, timeCodeSems, relative)
 
 
-def parseTimeCodes(userId: str, rTimeCodes: str, exTimeCodes: str) -> TimeCodeDao:
-    rTimeCodeParseResult = timeCodeParser(userId, rTimeCodes)
-    exTimeCodeParseResult = timeCodeParser(userId, exTimeCodes)
+def parseTimeCodes(userId: str, rTimeCodes: str, exTimeCodes: str,
+                   settings: ParserSettings | None = None, exFingerprints: set[str] | None = None) -> TimeCodeDao:
+    """
+    :param exFingerprints: 删除单个时间片产生的排除，fingerprint 在其中的时间片与 exTimeCodes 中的一样标记为 excluded
+    """
+    if settings is None:
+        settings = loadParserSettings(userId)
+    rTimeCodeParseResult = timeCodeParser(settings, rTimeCodes)
+    exTimeCodeParseResult = timeCodeParser(settings, exTimeCodes)
 
     if exTimeCodeParseResult.eventType is not None and rTimeCodeParseResult.eventType != exTimeCodeParseResult.eventType:
         raise ValueError('The event type of each line must be the same')
@@ -392,9 +542,12 @@ def parseTimeCodes(userId: str, rTimeCodes: str, exTimeCodes: str) -> TimeCodeDa
     rruleStr = ' '.join(map(lambda obj: str(obj), rTimeCodeParseResult.rruleObjects))
 
     # delete: true, 要去除的时间
-    inter = intersection(rTimeCodeParseResult.times, exTimeCodeParseResult.times, lambda a, b: a == b)
+    inter = keyedIntersection(rTimeCodeParseResult.times, exTimeCodeParseResult.times, TimeRange.key)
     # delete: false, 不要去除的时间
-    diff = difference(rTimeCodeParseResult.times, exTimeCodeParseResult.times, lambda a, b: a == b)
+    diff = keyedDifference(rTimeCodeParseResult.times, exTimeCodeParseResult.times, TimeRange.key)
+    if exFingerprints:
+        inter += [time for time in diff if time.fingerprint() in exFingerprints]
+        diff = [time for time in diff if time.fingerprint() not in exFingerprints]
 
     return TimeCodeDao(
         eventType=rTimeCodeParseResult.eventType,
@@ -402,5 +555,126 @@ def parseTimeCodes(userId: str, rTimeCodes: str, exTimeCodes: str) -> TimeCodeDa
         exTimes=inter,
         rruleStr=rruleStr,
         rTimeCodes=';'.join(rTimeCodeParseResult.newTimeCodes),
-        exTimeCodes=';'.join(exTimeCodeParseResult.newTimeCodes)
+        exTimeCodes=';'.join(exTimeCodeParseResult.newTimeCodes),
+        rLines=rTimeCodeParseResult.lines,
+        exLines=exTimeCodeParseResult.lines,
+        relative=rTimeCodeParseResult.relative or exTimeCodeParseResult.relative
+    )
+
+
+def diffTimeCodeLines(oldLines: dict[str, TimeCodeSem], newLines: dict[str, TimeCodeSem]) -> set[tuple]:
+    """
+    按行比较两次解析的结果，返回新增、删除的行涉及的时间片的 key，没有变化的行不需要展开和同步
+    """
+    keys: set[tuple] = set()
+    for line in oldLines.keys() ^ newLines.keys():
+        timeCodeSem = newLines[line] if line in newLines else oldLines[line]
+        keys.update(timeCodeSem.keySet())
+    return keys
+
+
+def streamTimeCodeLines(settings: ParserSettings, timeCode: str) -> tuple[EventType | None, list[rrule], list[str], Iterator[TimeRange]]:
+    """
+    lex 和构造 rrule 立即完成，语法错误在遍历前抛出；时间片在遍历时才展开，各行按结束时间归并
+
+    :return: (eventType, rruleObjects, newTimeCodes, 按结束时间排序的时间片)
+    """
+    eventType: EventType | None = None
+    rruleObjects: list[rrule] = []
+    newTimeCodes: list[str] = []
+    iterators: list[Iterator[TimeRange]] = []
+    for index, line in enumerate(splitTimeCodeLines(timeCode)):
+        timeCodeLex = lexTimeCodeLine(settings, line, index)
+
+        if eventType is not None and eventType != timeCodeLex.eventType:
+            raise ValueError('The event type of each line must be the same')
+        eventType = timeCodeLex.eventType
+        newTimeCodes.append(timeCodeLex.newTimeCode)
+        # 已经缓存的行直接使用，否则边展开边生成，不写入缓存
+        timeCodeSem = timeCodeCache.get(getCacheKey(settings, timeCodeLex))
+        if timeCodeSem is not None:
+            rruleObjects.append(timeCodeSem.rruleObject)
+            iterators.append(iter(timeCodeSem.times))
+        else:
+            rruleConfig, rruleObject = buildRRule(settings, timeCodeLex.dateRangeObject,
+                                                  timeCodeLex.freqObject, timeCodeLex.byClauses)
+            rruleObjects.append(rruleObject)
+            iterators.append(iterOccurrences(rruleConfig, rruleObject, timeCodeLex.timeRangeObject,
+                                             timeCodeLex.timeZone))
+
+    return eventType, rruleObjects, newTimeCodes, heapq.merge(*iterators, key=TimeRange.sortKey)
+
+
+def occurrenceOn(date: datetime, timeRangeObj: TimeRangeObject, timeZone: str) -> TimeRange:
+    """
+    date 当天的时间片
+    """
+    rruleConfig = {'dtstart': date, 'freq': DAILY, 'count': 1}
+    return next(iterOccurrences(rruleConfig, rrule(**rruleConfig), timeRangeObj, timeZone))
+
+
+def timeCodeBounds(settings: ParserSettings, timeCode: str) -> tuple[int | None, int | None]:
+    """
+    不展开时间片，由每行 rrule 的第一个和最后一个日期得到时间码的最早开始（_todo 为结束）和最晚结束，不考虑排除
+
+    最后一个日期由 NumPy 批量展开日期得到，无法批量展开的 rrule 使用 until，last 可能晚于实际的最后一个时间片
+
+    :return: (first, last)，UTC epoch 秒，没有时间片时都为 None
+    """
+    first: int | None = None
+    last: int | None = None
+    for index, line in enumerate(splitTimeCodeLines(timeCode)):
+        timeCodeLex = lexTimeCodeLine(settings, line, index)
+        rruleConfig, rruleObject = buildRRule(settings, timeCodeLex.dateRangeObject, timeCodeLex.freqObject,
+                                              timeCodeLex.byClauses)
+        firstDate = next(iter(rruleObject), None)
+        if firstDate is None:
+            continue
+        firstTime = occurrenceOn(firstDate, timeCodeLex.timeRangeObject, timeCodeLex.timeZone)
+        firstTs = firstTime.startTs if firstTime.startTs is not None else firstTime.endTs
+        first = firstTs if first is None else min(first, firstTs)
+        # buildRRule 总会设置 until 或 count: 1，没有 until 时只有第一个日期
+        lastDate = expandLastDate(rruleConfig) if VECTORIZED_EXPANSION else None
+        if lastDate is None:
+            lastDate = rruleConfig.get('until') or firstDate
+        lastTs = occurrenceOn(lastDate, timeCodeLex.timeRangeObject, timeCodeLex.timeZone).endTs
+        last = lastTs if last is None else max(last, lastTs)
+    return first, last
+
+
+def excludeTimes(rTimes: Iterator[TimeRange], exTimes: Iterator[TimeRange],
+                 exFingerprints: set[str] | None = None) -> Iterator[tuple[TimeRange, bool]]:
+    """
+    两个按结束时间排序的时间片流做反连接，与 parseTimeCodes 的交集/差集相同，返回 (时间片, excluded)
+    """
+    exTime = next(exTimes, None)
+    for time in rTimes:
+        key = time.sortKey()
+        while exTime is not None and exTime.sortKey() < key:
+            exTime = next(exTimes, None)
+        excluded = exTime is not None and exTime.sortKey() == key
+        if not excluded and exFingerprints:
+            excluded = time.fingerprint() in exFingerprints
+        yield time, excluded
+
+
+def streamTimeCodes(userId: str, rTimeCodes: str, exTimeCodes: str,
+                    settings: ParserSettings | None = None, exFingerprints: set[str] | None = None) -> TimeCodeStream:
+    """
+    与 parseTimeCodes 相同，但时间片以按结束时间排序的流返回，内存占用不随时间片数量增长
+    """
+    if settings is None:
+        settings = loadParserSettings(userId)
+    eventType, rruleObjects, newTimeCodes, rTimes = streamTimeCodeLines(settings, rTimeCodes)
+    exEventType, _, exNewTimeCodes, exTimes = streamTimeCodeLines(settings, exTimeCodes)
+
+    if exEventType is not None and eventType != exEventType:
+        raise ValueError('The event type of each line must be the same')
+
+    return TimeCodeStream(
+        eventType=eventType,
+        times=excludeTimes(rTimes, exTimes, exFingerprints),
+        rruleStr=' '.join(map(lambda obj: str(obj), rruleObjects)),
+        rTimeCodes=';'.join(newTimeCodes),
+        exTimeCodes=';'.join(exNewTimeCodes)
     )
@@ -1,12 +1,72 @@
+from datetime import datetime
+from typing import Iterator
+
+from dateutil import tz
 from dateutil.rrule import rrule, weekday
 
+from utils.timeZone import toEpochSeconds, fromEpochSeconds
+
 
 class EventType:
     EVENT = 'event'
     TODO = 'todo'
 
 
+class TimeCodeSyntaxError(ValueError):
+    """
+    时间码的语法错误，带有出错的位置，显示时行号和列号从 1 开始
+    """
+    message: str
+    column: int  # 从 0 开始
+    line: int | None  # 从 0 开始，多行时间码中才有
+
+    def __init__(self, message: str, column: int = 0, line: int | None = None):
+        super().__init__(message)
+        self.message = message
+        self.column = column
+        self.line = line
+
+    def __str__(self):
+        if self.line is None:
+            return f'{self.message} (column {self.column + 1})'
+        return f'{self.message} (line {self.line + 1}, column {self.column + 1})'
+
+
+class ParserSettings:
+    """
+    解析器用到的用户设置快照，每个请求只从 redis 读取一次
+    """
+    timeZone: str
+    wkst: str
+    # 展开 tdy / tmr 和补全省略的年份时使用的当前时间，None 表示实时的当前时间，测试时固定
+    now: datetime | None
+
+    def __init__(self, timeZone: str = '', wkst: str = 'MO', now: datetime | None = None):
+        self.timeZone = timeZone
+        self.wkst = wkst
+        self.now = now
+
+    def localNow(self) -> datetime:
+        """
+        用户时区的当前时间
+        """
+        now = self.now if self.now is not None else datetime.now()
+        return now.astimezone(tz.gettz(self.timeZone))
+
+    def __eq__(self, other):
+        if not isinstance(other, ParserSettings):
+            return False
+        return self.timeZone == other.timeZone and self.wkst == other.wkst
+
+    def __str__(self):
+        return f'{self.timeZone}-{self.wkst}'
+
+    def __repr__(self):
+        return f'ParserSettings({self.timeZone}, {self.wkst})'
+
+
 class DateUnit:
+    __slots__ = ('year', 'month', 'day')
     year: int
     month: int
     day: int
@@ -50,6 +110,7 @@ class DateRangeObject:
 
 
 class TimeUnit:
+    __slots__ = ('hour', 'minute')
     hour: int
     minute: int
 
@@ -70,6 +131,7 @@ class TimeUnit:
 
 
 class TimeRangeObject:
+    __slots__ = ('start', 'end', 'startMark', 'endMark')
     start: TimeUnit | None
     end: TimeUnit
     startMark: str
@@ -94,22 +156,98 @@ class TimeRangeObject:
         return f'TimeRangeObject({self.start}, {self.end}, {self.startMark}, {self.endMark})'
 
 
+def packMarks(startMark: str, endMark: str) -> int:
+    """
+    把 '11' 形式的 startMark、endMark 压缩为一个整数，startMark 在高 2 位
+    """
+    return int(startMark, 2) << 2 | int(endMark, 2)
+
+
+MARK_STRS = ('00', '01', '10', '11')
+
+
+def toFingerprint(key: tuple) -> str:
+    """
+    时间片 key 的规范化字符串，保存在 Time.fingerprint 中，同一个 schedule 内唯一
+
+    格式为 'start 毫秒:end 毫秒:压缩后的 mark'，todo 没有 start 时为空
+    """
+    start, end, marks = key
+    return f'{start if start is not None else ""}:{end}:{marks}'
+
+
 class TimeRange:
-    start: str | None
-    end: str
-    startMark: str
-    endMark: str
+    """
+    展开后的单个时间片
+
+    内部只保存 UTC epoch 秒和压缩后的 mark，ISO 字符串和 '11' 形式的 mark 只在写库、序列化时通过属性生成
+    """
+    __slots__ = ('startTs', 'endTs', 'marks')
+    startTs: int | None
+    endTs: int | None
+    marks: int
 
     def __init__(self, start: str | None = None, end: str = '', startMark: str = '11', endMark: str = '11'):
-        self.start = start
-        self.end = end
-        self.startMark = startMark
-        self.endMark = endMark
+        self.startTs = toEpochSeconds(start)
+        self.endTs = toEpochSeconds(end) if end else None
+        self.marks = packMarks(startMark, endMark)
+
+    @classmethod
+    def fromEpoch(cls, startTs: int | None, endTs: int, marks: int) -> 'TimeRange':
+        """
+        直接由 epoch 秒和压缩后的 mark 构造，展开时使用，不经过字符串
+        """
+        time = cls.__new__(cls)
+        time.startTs = startTs
+        time.endTs = endTs
+        time.marks = marks
+        return time
+
+    @property
+    def start(self) -> str | None:
+        return fromEpochSeconds(self.startTs)
+
+    @property
+    def end(self) -> str | None:
+        return fromEpochSeconds(self.endTs)
+
+    @property
+    def startMark(self) -> str:
+        return MARK_STRS[self.marks >> 2]
+
+    @property
+    def endMark(self) -> str:
+        return MARK_STRS[self.marks & 0b11]
+
+    def key(self) -> tuple:
+        """
+        可哈希的 key，UTC 毫秒时间戳和压缩后的 mark，与 Time.key 相同
+        """
+        return (self.startTs * 1000 if self.startTs is not None else None,
+                self.endTs * 1000 if self.endTs is not None else None,
+                self.marks)
+
+    def sortKey(self) -> tuple:
+        """
+        按结束时间排序的 key，与 key() 一一对应，todo 的 start 用 end 代替
+        """
+        return self.endTs, self.startTs if self.startTs is not None else self.endTs, self.marks
+
+    def fingerprint(self) -> str:
+        return toFingerprint(self.key())
+
+    def to_dict(self):
+        return {
+            'start': self.start,
+            'end': self.end,
+            'startMark': self.startMark,
+            'endMark': self.endMark,
+        }
 
     def __eq__(self, other):
         if not isinstance(other, TimeRange):
             return False
-        return self.start == other.start and self.end == other.end and self.startMark == other.startMark and self.endMark == other.endMark
+        return self.startTs == other.startTs and self.endTs == other.endTs and self.marks == other.marks
 
     def __str__(self):
         return f'{self.start}-{self.end}'  # TODO time with mark
@@ -179,10 +317,14 @@ class TimeCodeLex:
     freqCode: str | None
     byCode: str | None
     newTimeCode: str
+    relative: bool  # 日期依赖于“今天”，如 tdy、tmr 或省略年份
+    freqObject: FreqObject | None  # 已经解析的 freqCode
+    byClauses: dict[str, list[int]] | None  # 已经解析的 byCode，如 {'day': [1, 2]}
 
     def __init__(self, eventType: EventType = EventType.EVENT, dateRangeObject: DateRangeObject = DateRangeObject(),
                  timeRangeObject: TimeRangeObject = TimeRangeObject(), timeZone: str = '', freqCode: str | None = None,
-                 byCode: str | None = None, newTimeCode: str = ''):
+                 byCode: str | None = None, newTimeCode: str = '', relative: bool = False,
+                 freqObject: FreqObject | None = None, byClauses: dict[str, list[int]] | None = None):
         self.eventType = eventType
         self.dateRangeObject = dateRangeObject
         self.timeRangeObject = timeRangeObject
@@ -190,6 +332,9 @@ class TimeCodeLex:
         self.freqCode = freqCode
         self.byCode = byCode
         self.newTimeCode = newTimeCode
+        self.relative = relative
+        self.freqObject = freqObject
+        self.byClauses = byClauses
 
     def __eq__(self, other):
         if not isinstance(other, TimeCodeLex):
@@ -205,14 +350,24 @@ class TimeCodeLex:
 
 
 class TimeCodeSem:
-    times: list[TimeRange]
+    times: list[TimeRange] | tuple[TimeRange, ...]  # 缓存中的结果为 tuple
     rruleObject: rrule
+    keys: frozenset | None
 
     def __init__(self, rruleObject: rrule, times=None):
         if times is None:
             times = []
         self.times = times
         self.rruleObject = rruleObject
+        self.keys = None
+
+    def keySet(self) -> frozenset:
+        """
+        所有时间片的 key，第一次调用时计算，缓存中的结果可以重复使用
+        """
+        if self.keys is None:
+            self.keys = frozenset(time.key() for time in self.times)
+        return self.keys
 
     def __eq__(self, other):
         if not isinstance(other, TimeCodeSem):
@@ -231,18 +386,25 @@ class TimeCodeParseResult:
     times: list[TimeRange]
     rruleObjects: list[rrule]
     newTimeCodes: list[str]
+    lines: dict[str, TimeCodeSem]  # 规范化后的每一行和它的展开结果
+    relative: bool  # 有依赖于“今天”的行
 
-    def __init__(self, eventType: EventType = EventType.EVENT, times=None, rruleObjects=None, newTimeCodes=None):
+    def __init__(self, eventType: EventType = EventType.EVENT, times=None, rruleObjects=None, newTimeCodes=None,
+                 lines=None, relative: bool = False):
         if times is None:
             times = []
         if rruleObjects is None:
             rruleObjects = []
         if newTimeCodes is None:
             newTimeCodes = []
+        if lines is None:
+            lines = {}
         self.eventType = eventType
         self.times = times
         self.rruleObjects = rruleObjects
         self.newTimeCodes = newTimeCodes
+        self.lines = lines
+        self.relative = relative
 
     def __eq__(self, other):
         if not isinstance(other, TimeCodeParseResult):
@@ -263,18 +425,29 @@ class TimeCodeDao:
     rruleStr: str
     rTimeCodes: str
     exTimeCodes: str
+    rLines: dict[str, TimeCodeSem]
+    exLines: dict[str, TimeCodeSem]
+    relative: bool
 
-    def __init__(self, eventType: EventType = EventType.EVENT, rTimes=None, exTimes=None, rruleStr: str = '', rTimeCodes: str = '', exTimeCodes: str = ''):
+    def __init__(self, eventType: EventType = EventType.EVENT, rTimes=None, exTimes=None, rruleStr: str = '', rTimeCodes: str = '', exTimeCodes: str = '',
+                 rLines=None, exLines=None, relative: bool = False):
         if rTimes is None:
             rTimes = []
         if exTimes is None:
             exTimes = []
+        if rLines is None:
+            rLines = {}
+        if exLines is None:
+            exLines = {}
         self.eventType = eventType
         self.rTimes = rTimes
         self.exTimes = exTimes
         self.rruleStr = rruleStr
         self.rTimeCodes = rTimeCodes
         self.exTimeCodes = exTimeCodes
+        self.rLines = rLines
+        self.exLines = exLines
+        self.relative = relative
 
     def __eq__(self, other):
         if not isinstance(other, TimeCodeDao):
@@ -286,3 +459,26 @@ class TimeCodeDao:
 
     def __repr__(self):
         return f'TimeCodeDao({self.eventType}, {self.rTimes}, {self.exTimes}, {self.rruleStr}, {self.rTimeCodes}, {self.exTimeCodes})'
+
+
+class TimeCodeStream:
+    eventType: EventType
+    times: Iterator[tuple[TimeRange, bool]]  # 按结束时间排序的 (时间片, excluded)，只能遍历一次
+    rruleStr: str
+    rTimeCodes: str
+    exTimeCodes: str
+
+    def __init__(self, eventType: EventType = EventType.EVENT, times=None, rruleStr: str = '', rTimeCodes: str = '', exTimeCodes: str = ''):
+        if times is None:
+            times = iter(())
+        self.eventType = eventType
+        self.times = times
+        self.rruleStr = rruleStr
+        self.rTimeCodes = rTimeCodes
+        self.exTimeCodes = exTimeCodes
+
+    def __str__(self):
+        return f'{self.eventType}-{self.rruleStr}-{self.rTimeCodes}-{self.exTimeCodes}'
+
+    def __repr__(self):
+        return f'TimeCodeStream({self.eventType}, {self.rruleStr}, {self.rTimeCodes}, {self.exTimeCodes})'
@@ -7,6 +7,7 @@ app_name = 'schedule'
 urlpatterns = [
     path('createSchedule/', views.createSchedule, name="createSchedule"),
     path('updateScheduleById/', views.updateScheduleById, name="updateScheduleById"),
+    path('previewTimeCodes/', views.previewTimeCodes, name="previewTimeCodes"),
     path('findEventsBetween/', views.findEventsBetween, name="findEventsBetween"),
     path('findAllTodos/', views.findAllTodos, name="findAllTodos"),
     path('findScheduleById/', views.findScheduleById, name="findScheduleById"),
@@ -26,6 +26,15 @@ def updateScheduleById(request, userId):
     return service.updateScheduleById(id, userId, name, rTimeCode, comment, exTimeCode)
 
 
+@errorHandler
+@checkToken
+@require_http_methods(["POST"])
+def previewTimeCodes(request, userId):
+    data = json.loads(request.body)
+    items, limit = data['items'], data.get('limit', 10)
+    return service.previewTimeCodes(userId, items, limit)
+
+
 @errorHandler
 @checkToken
 @require_http_methods(["POST"])
@@ -101,9 +110,12 @@ def updateTimeCommentById(request, userId):
 @require_http_methods(["POST"])
 def findAllSchedules(request, userId):
     data = json.loads(request.body)
-    conditions, page, pageSize = data['conditions'], data['page'], data['pageSize']
+    conditions, pageSize = data['conditions'], data['pageSize']
     conditions = service.FindAllSchedulesConditions(conditions)
-    return service.findAllSchedules(userId, conditions, page, pageSize)
+    # 传了 after（第一页为 null）时使用 cursor 分页
+    if 'after' in data:
+        return service.findSchedulesAfter(userId, conditions, data['after'], pageSize, data.get('withTotal', False))
+    return service.findAllSchedules(userId, conditions, data['page'], pageSize)
 
 
 @errorHandler
@@ -9,5 +9,4 @@ docker compose -f docker-compose.yml up -d
 
 export DJANGO_SETTINGS_MODULE=main.settings_prod
 
-python manage.py makemigrations
 python manage.py migrate
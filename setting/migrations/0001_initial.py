@@ -0,0 +1,31 @@
+# Generated by Django 5.0.1 on 2026-10-18 22:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Setting',
+            fields=[
+                ('id', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('deleted', models.BooleanField(default=False)),
+                ('created', models.CharField(max_length=255)),
+                ('updated', models.CharField(max_length=255)),
+                ('syncAt', models.CharField(max_length=255, null=True)),
+                ('version', models.IntegerField(default=0)),
+                ('key', models.CharField(max_length=255)),
+                ('value', models.TextField()),
+                ('type', models.CharField(choices=[('string', 'String'), ('number', 'Number'), ('boolean', 'Boolean')], max_length=255)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.0.1 on 2026-10-18 22:24
+
+from django.db import migrations, models
+
+from main.timestampMigration import toTimestampColumns
+
+# 旧版本中以 ISO 字符串保存的时间字段
+TIMESTAMP_COLUMNS = {
+    'setting': ['created', 'updated', 'syncAt'],
+}
+forward, backward = toTimestampColumns('setting', TIMESTAMP_COLUMNS)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('setting', '0002_initial'),
+    ]
+
+    operations = [
+        # 已有的字符串由 RunPython 解析，模型状态与 AlterField 相同
+        migrations.SeparateDatabaseAndState(
+            database_operations=[migrations.RunPython(forward, backward)],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='setting',
+                    name='created',
+                    field=models.DateTimeField(),
+                ),
+                migrations.AlterField(
+                    model_name='setting',
+                    name='updated',
+                    field=models.DateTimeField(),
+                ),
+                migrations.AlterField(
+                    model_name='setting',
+                    name='syncAt',
+                    field=models.DateTimeField(null=True),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.1 on 2026-10-18 22:25
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('setting', '0003_timestamp_columns'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='setting',
+            index=models.Index(fields=['user', 'key'], name='setting_user_key'),
+        ),
+        migrations.AddIndex(
+            model_name='setting',
+            index=models.Index(fields=['user', 'updated'], name='setting_user_updated'),
+        ),
+    ]
@@ -65,6 +65,13 @@ class Setting(Base):
     value = models.TextField()
     type = models.CharField(choices=SettingType.choices, max_length=255)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'key'], name='setting_user_key'),
+            # getUnSynced
+            models.Index(fields=['user', 'updated'], name='setting_user_updated'),
+        ]
+
     def __str__(self):
         return self.key
 
@@ -76,8 +83,8 @@ class Setting(Base):
             'value': fromString(self.key, self.value),
             'type': self.type,
             'deleted': self.deleted,
-            'created': self.created,
-            'updated': self.updated,
-            'syncAt': self.syncAt,
+            'created': isoformat(self.created),
+            'updated': isoformat(self.updated),
+            'syncAt': isoformat(self.syncAt),
             'version': self.version,
         }
@@ -1,12 +1,9 @@
-from datetime import datetime
-
-from dateutil.tz import tz
 from django.db import transaction
 from django_redis import get_redis_connection
 
 from main.models import Base
-from setting.models import Setting, toString, fromString
-from utils.timeZone import isoformat
+from setting.models import Setting, toString, fromString, settingsDict
+from utils.timeZone import utcNow, fromISOString
 
 # 缓存中每个设置是 str
 # 数据库中每个设置是 str
@@ -29,7 +26,7 @@ def setSettings(userId, settings):
         setting = Setting.objects.filter(user_id=userId, key=key).first()
         if setting:
             setting.value = toString(value)  # 接口数据存入数据库, any -> str
-            setting.updated = isoformat(datetime.now().astimezone(tz.gettz('UTC')))
+            setting.updated = utcNow()
             setting.version += 1
             setting.save()
             settingsCache[key] = toString(value)
@@ -45,6 +42,18 @@ def getSettingByPath(userId: str, path: str):
     return fromString(path, value)
 
 
+def getSettingsSnapshot(userId: str, paths: list[str]):
+    """
+    一次 HGETALL 读取多个设置，缓存中没有的使用默认值
+    """
+    settings = settingConnection.hgetall(userId)
+    res = {}
+    for path in paths:
+        value = settings.get(path, settings.get(path.encode()))
+        res[path] = fromString(path, value) if value is not None else settingsDict[path][1]
+    return res
+
+
 @transaction.atomic
 def setSettingByPath(userId: str, path: str, value: any):
     """
@@ -53,7 +62,7 @@ def setSettingByPath(userId: str, path: str, value: any):
     setting = Setting.objects.filter(user_id=userId, key=path).first()
     if setting:
         setting.value = toString(value)  # 接口数据存入数据库, any -> str
-        setting.updated = isoformat(datetime.now().astimezone(tz.gettz('UTC')))
+        setting.updated = utcNow()
         setting.version += 1
         setting.save()
         settingConnection.hset(userId, path, toString(value))  # 接口数据存入缓存, any -> str
@@ -75,7 +84,7 @@ def sync(userId, settings, syncAt):
             return True
         if server.version <= client['version']:
             return True
-        if server.updated <= client['updated']:
+        if server.updated <= fromISOString(client['updated']):
             return True
         return False
 
@@ -114,7 +123,7 @@ def sync(userId, settings, syncAt):
 
 
 def getUnSynced(userId: str, lastSyncAt: str):
-    settings = Setting.objects.filter(user_id=userId, updated__gt=lastSyncAt)
+    settings = Setting.objects.filter(user_id=userId, updated__gt=fromISOString(lastSyncAt))
     return {
         'settings': list(map(lambda setting: setting.to_dict(), settings)),  # 数据库数据转换为接口数据, json -> any
     }
@@ -1,20 +1,201 @@
-from datetime import datetime
+import json
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from pathlib import Path
 
 import pytz
 from dateutil import tz
 
+logger = logging.getLogger(__name__)
 
-def getTimeZoneAbbr(timeZone: str):
+# Environment variable holding the path of the prebuilt time zone index, written by the build_timezone_index command.
+# Without it the index is built in memory once per process.
+TIME_ZONE_INDEX_PATH_ENV = 'TIME_ZONE_INDEX_PATH'
+# Bumped when the layout, the ordering or the year span of the index changes, so old files are rebuilt
+TIME_ZONE_INDEX_FORMAT = 3
+# Abbreviations are collected over these years, so the index does not depend on the current date
+TIME_ZONE_INDEX_YEARS = range(2020, 2031)
+# Time zone preferred for ambiguous abbreviations, other abbreviations prefer canonical zones
+PREFERRED_TIME_ZONES = {
+    'CST': 'America/Chicago',
+    'CDT': 'America/Chicago',
+    'EST': 'America/New_York',
+    'EDT': 'America/New_York',
+    'MST': 'America/Denver',
+    'MDT': 'America/Denver',
+    'PST': 'America/Los_Angeles',
+    'PDT': 'America/Los_Angeles',
+    'AKST': 'America/Anchorage',
+    'AKDT': 'America/Anchorage',
+    'HST': 'Pacific/Honolulu',
+    'AST': 'America/Halifax',
+    'ADT': 'America/Halifax',
+    'NST': 'America/St_Johns',
+    'NDT': 'America/St_Johns',
+    'GMT': 'Europe/London',
+    'BST': 'Europe/London',
+    'IST': 'Asia/Kolkata',
+    'WET': 'Europe/Lisbon',
+    'WEST': 'Europe/Lisbon',
+    'CET': 'Europe/Paris',
+    'CEST': 'Europe/Paris',
+    'EET': 'Europe/Athens',
+    'EEST': 'Europe/Athens',
+    'MSK': 'Europe/Moscow',
+    'WAT': 'Africa/Lagos',
+    'CAT': 'Africa/Maputo',
+    'EAT': 'Africa/Nairobi',
+    'SAST': 'Africa/Johannesburg',
+    'PKT': 'Asia/Karachi',
+    'WIB': 'Asia/Jakarta',
+    'HKT': 'Asia/Hong_Kong',
+    'JST': 'Asia/Tokyo',
+    'KST': 'Asia/Seoul',
+    'AEST': 'Australia/Sydney',
+    'AEDT': 'Australia/Sydney',
+    'ACST': 'Australia/Adelaide',
+    'ACDT': 'Australia/Adelaide',
+    'AWST': 'Australia/Perth',
+    'NZST': 'Pacific/Auckland',
+    'NZDT': 'Pacific/Auckland',
+}
+
+
+class TimeZoneIndex:
+    version: str
+    zones: set[str]
+    abbrs: dict[str, list[str]]
+    lookup: dict[str, str]  # time zone name or abbreviation -> time zone name
+
+    def __init__(self, version: str, zones: list[str], abbrs: dict[str, list[str]]):
+        self.version = version
+        self.zones = set(zones)
+        self.abbrs = abbrs
+        # An abbreviation resolves to its first time zone, names take precedence over abbreviations
+        self.lookup = {abbr: abbrZones[0] for abbr, abbrZones in abbrs.items()}
+        self.lookup.update({zone: zone for zone in zones})
+
+    def to_dict(self):
+        return {
+            'version': self.version,
+            'zones': sorted(self.zones),
+            'abbrs': self.abbrs,
+        }
+
+
+def getTimeZoneAbbr(timeZone: str, time: datetime | None = None):
     """
     Get the abbreviation of the given time zone.
 
     :param timeZone: The time zone to get abbreviation.
     :type timeZone: str
+    :param time: The time at which to get the abbreviation, now by default.
+    :type time: datetime | None
     :return: The abbreviation of the given time zone.
     :rtype: str
     """
-    now = datetime.now(tz.gettz(timeZone))
-    return now.strftime('%Z')
+    if time is None:
+        return datetime.now(tz.gettz(timeZone)).strftime('%Z')
+    return time.replace(tzinfo=tz.gettz(timeZone)).strftime('%Z')
+
+
+def getTimeZoneIndexVersion():
+    """
+    Get the version of the time zone index, which changes with the index format and tzdata.
+
+    :return: The version of the time zone index.
+    :rtype: str
+    """
+    return f'{TIME_ZONE_INDEX_FORMAT}-{pytz.OLSON_VERSION}'
+
+
+def getTimeZoneIndexPath():
+    """
+    Get the path of the prebuilt time zone index from the environment.
+
+    :return: The path of the index, or None to keep the index in memory only.
+    :rtype: Path | None
+    """
+    path = os.environ.get(TIME_ZONE_INDEX_PATH_ENV)
+    return Path(path) if path else None
+
+
+def rankAbbrZones(abbr: str, zones: list[str]):
+    """
+    Order the time zones using an abbreviation, the preferred zone first, then canonical zones.
+
+    :param abbr: The abbreviation.
+    :type abbr: str
+    :param zones: The time zones using the abbreviation, in tzdata order.
+    :type zones: list[str]
+    :return: The ordered time zones.
+    :rtype: list[str]
+    """
+    preferred = PREFERRED_TIME_ZONES.get(abbr)
+    common = set(pytz.common_timezones)
+    return sorted(zones, key=lambda zone: (zone != preferred, zone not in common))
+
+
+def buildTimeZoneIndex():
+    """
+    Build the time zone index, with the abbreviations used in winter and summer of ``TIME_ZONE_INDEX_YEARS``.
+
+    :return: The time zone index.
+    :rtype: TimeZoneIndex
+    """
+    times = [datetime(year, month, 1) for year in TIME_ZONE_INDEX_YEARS for month in (1, 7)]
+    abbrs: dict[str, list[str]] = {}
+    for zone in pytz.all_timezones:
+        for time in times:
+            abbr = getTimeZoneAbbr(zone, time)
+            if abbr not in abbrs:
+                abbrs[abbr] = []
+            if zone not in abbrs[abbr]:
+                abbrs[abbr].append(zone)
+    abbrs = {abbr: rankAbbrZones(abbr, zones) for abbr, zones in abbrs.items()}
+    return TimeZoneIndex(getTimeZoneIndexVersion(), list(pytz.all_timezones), abbrs)
+
+
+def saveTimeZoneIndex(index: TimeZoneIndex, path: Path):
+    """
+    Save the time zone index to the given path, replacing the old file atomically.
+
+    :param index: The time zone index to save.
+    :type index: TimeZoneIndex
+    :param path: The path to save to.
+    :type path: Path
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmpPath = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    with open(tmpPath, 'w') as f:
+        json.dump(index.to_dict(), f)
+    os.replace(tmpPath, path)
+
+
+@lru_cache(maxsize=None)
+def getTimeZoneIndex():
+    """
+    Load the time zone index lazily from the prebuilt file, building it in memory when the file is missing or outdated.
+
+    The file is only written by the build_timezone_index command, never at request time.
+
+    :return: The time zone index.
+    :rtype: TimeZoneIndex
+    """
+    path = getTimeZoneIndexPath()
+    if path is not None:
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            if data['version'] == getTimeZoneIndexVersion():
+                return TimeZoneIndex(data['version'], data['zones'], data['abbrs'])
+            logger.warning('Time zone index %s has version %s, expected %s, building it in memory',
+                           path, data['version'], getTimeZoneIndexVersion())
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning('Time zone index %s cannot be loaded, building it in memory: %r', path, e)
+    return buildTimeZoneIndex()
 
 
 def getTimeZoneAbbrMap():
@@ -24,13 +205,7 @@ def getTimeZoneAbbrMap():
     :return: The abbreviation map of all time zones.
     :rtype: dict[str, list[str]]
     """
-    res = {}
-    for timezone in pytz.all_timezones:
-        abbr = getTimeZoneAbbr(timezone)
-        if abbr not in res:
-            res[abbr] = set()
-        res[abbr].add(timezone)
-    return res
+    return getTimeZoneIndex().abbrs
 
 
 def isValidTimeZone(timeZone: str):
@@ -42,20 +217,132 @@ def isValidTimeZone(timeZone: str):
     :return: True if the time zone is valid, False otherwise.
     :rtype: bool
     """
-    try:
-        tz.gettz(timeZone)
-        return True
-    except:
-        return False
+    return timeZone in getTimeZoneIndex().zones
 
 
-def isoformat(time: datetime) -> str:
+def resolveTimeZone(code: str):
     """
-    Convert the given time to ISO format.
+    Resolve a time zone name or abbreviation to a time zone name.
 
-    :param time: The time to convert.
-    :type time: datetime
-    :return: The ISO format time.
-    :rtype: str
+    :param code: The time zone name or abbreviation.
+    :type code: str
+    :return: The time zone name, or None if the code is neither.
+    :rtype: str | None
+    """
+    return getTimeZoneIndex().lookup.get(code)
+
+
+def isoformat(time: str | datetime | None) -> str | None:
+    """
+    Convert the given time to ISO format in UTC, naive times are treated as UTC.
+
+    :param time: The time to convert, an ISO format time, or None.
+    :type time: str | datetime | None
+    :return: The ISO format time such as ``2023-07-11T05:00:00.000Z``, or None.
+    :rtype: str | None
+    """
+    if time is None:
+        return None
+    return fromISOString(time).astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + 'Z'
+
+
+def utcNow() -> datetime:
+    """
+    Get the current UTC time, truncated to milliseconds so that it round-trips through ``isoformat``.
+
+    :return: The current UTC time.
+    :rtype: datetime
+    """
+    now = datetime.now(timezone.utc)
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
+def fromISOString(time: str | datetime | None) -> datetime | None:
+    """
+    Parse the given ISO format time to an aware datetime, naive times are treated as UTC.
+
+    :param time: The ISO format time, an already parsed datetime, or None.
+    :type time: str | datetime | None
+    :return: The aware datetime, or None.
+    :rtype: datetime | None
+    """
+    if time is None:
+        return None
+    if isinstance(time, str):
+        time = datetime.fromisoformat(time)
+    if time.tzinfo is None:
+        return time.replace(tzinfo=timezone.utc)
+    return time
+
+
+def toUTCISOString(time: str | datetime | None) -> str | None:
+    """
+    Convert the given time to an ISO format UTC time, the same as ``datetime.isoformat()``.
+
+    :param time: The time to convert, an ISO format time, or None.
+    :type time: str | datetime | None
+    :return: The ISO format time such as ``2023-07-11T05:00:00+00:00``, or None.
+    :rtype: str | None
+    """
+    if time is None:
+        return None
+    return fromISOString(time).astimezone(timezone.utc).isoformat()
+
+
+def toEpochMillis(time: str | datetime | None) -> int | None:
+    """
+    Convert the given time to milliseconds since the epoch.
+
+    :param time: The ISO format time, a datetime, or None.
+    :type time: str | datetime | None
+    :return: The milliseconds since the epoch, or None.
+    :rtype: int | None
+    """
+    if time is None:
+        return None
+    return round(fromISOString(time).timestamp() * 1000)
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def toEpochSeconds(time: str | datetime | None) -> int | None:
+    """
+    Convert the given ISO format time to whole seconds since the epoch, naive times are treated as UTC.
+
+    :param time: The ISO format time, an already parsed datetime, or None.
+    :type time: str | datetime | None
+    :return: The seconds since the epoch, or None.
+    :rtype: int | None
+    """
+    if time is None:
+        return None
+    return int(fromISOString(time).timestamp() // 1)
+
+
+def epochSecondsToDatetime(seconds: int | None) -> datetime | None:
+    """
+    Convert the given seconds since the epoch to a UTC datetime.
+
+    :param seconds: The seconds since the epoch, or None.
+    :type seconds: int | None
+    :return: The UTC datetime, or None.
+    :rtype: datetime | None
+    """
+    if seconds is None:
+        return None
+    return EPOCH + timedelta(seconds=seconds)
+
+
+def fromEpochSeconds(seconds: int | None) -> str | None:
+    """
+    Convert the given seconds since the epoch to an ISO format UTC time, the same as ``datetime.isoformat()``.
+
+    :param seconds: The seconds since the epoch, or None.
+    :type seconds: int | None
+    :return: The ISO format time such as ``2023-07-11T05:00:00+00:00``, or None.
+    :rtype: str | None
     """
-    return time.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + 'Z'
+    if seconds is None:
+        return None
+    return epochSecondsToDatetime(seconds).isoformat()
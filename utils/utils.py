@@ -29,3 +29,38 @@ def union(a: list, b: list, equal: callable) -> list:
     :return: 并集
     """
     return a + difference(b, a, equal)
+
+
+def keyedIntersection(a: list, b: list, key: callable) -> list:
+    """
+    求两个数组的交集，元素通过可哈希的 key 比较，O(n+m)，保持 a 中的顺序
+    :param a: 数组a
+    :param b: 数组b
+    :param key: 获取元素 key 的函数
+    :return: 交集
+    """
+    keys = set(map(key, b))
+    return [x for x in a if key(x) in keys]
+
+
+def keyedDifference(a: list, b: list, key: callable) -> list:
+    """
+    求两个数组的差集，元素通过可哈希的 key 比较，O(n+m)，保持 a 中的顺序
+    :param a: 数组a
+    :param b: 数组b
+    :param key: 获取元素 key 的函数
+    :return: 差集
+    """
+    keys = set(map(key, b))
+    return [x for x in a if key(x) not in keys]
+
+
+def keyedUnion(a: list, b: list, key: callable) -> list:
+    """
+    求两个数组的并集，元素通过可哈希的 key 比较，O(n+m)，保持 a、b 中的顺序
+    :param a: 数组a
+    :param b: 数组b
+    :param key: 获取元素 key 的函数
+    :return: 并集
+    """
+    return list(a) + keyedDifference(b, a, key)